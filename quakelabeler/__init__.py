@@ -3,3 +3,5 @@ __version__ = '1.0.1'
 __author__ = 'Hao Mai & Pascal Audet'
 
 from .classes import QuakeLabeler, Interactive, CustomSamples, QueryArrival, BuiltInCatalog, MergeMetadata, GlobalMaps
+from .arrivals import ArrivalTable, PhaseIndex
+from .fdsn import DATA_CENTERS
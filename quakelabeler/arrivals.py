@@ -0,0 +1,609 @@
+# -*- coding: utf-8 -*-
+# MIT License
+#
+# Copyright (c) 2021 Hao Mai & Pascal Audet
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""
+Arrival table
+Columnar storage of arrival recordings with interned station/phase codes.
+@author: Hao Mai & Pascal Audet
+"""
+from __future__ import (absolute_import, division, print_function)
+
+import os
+import sys
+import struct
+import zipfile
+from array import array
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+import numpy as np
+import pandas as pd
+from obspy.core.utcdatetime import UTCDateTime
+
+# storage kind of the ISC arrival fields:
+#   int / float : typed numpy column
+#   category    : int32 codes into a table of interned labels
+#   text        : fixed width unicode column (mostly unique values)
+COLUMN_KINDS = {
+    'EVENTID': 'int',
+    'STA': 'category',
+    'CHN': 'category',
+    'ISCPHASE': 'category',
+    'REPPHASE': 'category',
+    'ARRIVAL_LAT': 'float',
+    'ARRIVAL_LON': 'float',
+    'ARRIVAL_ELEV': 'float',
+    'ARRIVAL_DIST': 'float',
+    'ARRIVAL_BAZ': 'float',
+    'ARRIVAL_DATE': 'category',
+    'ARRIVAL_TIME': 'text',
+    'ORIGIN_LAT': 'float',
+    'ORIGIN_LON': 'float',
+    'ORIGINL_DEPTH': 'float',
+    'ORIGIN_DATE': 'category',
+    'ORIGIN_TIME': 'category',
+    'EVENT_TYPE': 'category',
+    'EVENT_MAG': 'float',
+    'ARRIVAL_EPOCH': 'float',
+    'ORIGIN_EPOCH': 'float',
+    }
+
+# epoch columns (float64 POSIX seconds) and their date / time fields
+EPOCH_FIELDS = (('ARRIVAL_EPOCH', 'ARRIVAL_DATE', 'ARRIVAL_TIME'),
+                ('ORIGIN_EPOCH', 'ORIGIN_DATE', 'ORIGIN_TIME'))
+
+_TYPECODES = {'int': 'q', 'float': 'd', 'category': 'i'}
+_DTYPES = {'int': np.int64, 'float': np.float64, 'category': np.int32}
+
+
+def _day_seconds(dates):
+    days = pd.to_datetime(pd.Series(dates, dtype=str).str.strip(),
+                          format='%Y-%m-%d', errors='coerce')
+    return (days - pd.Timestamp(0)).dt.total_seconds().to_numpy()
+
+
+def _clock_seconds(times):
+    clock = pd.to_timedelta(pd.Series(times, dtype=str).str.strip(),
+                            errors='coerce')
+    return clock.dt.total_seconds().to_numpy()
+
+
+def arrival_epoch(thread):
+    r"""Arrival time of one arrival in POSIX seconds.
+    Uses the ARRIVAL_EPOCH column when present and only parses the date and
+    time strings for plain dicts (e.g. records of former versions).
+    """
+    try:
+        return thread['ARRIVAL_EPOCH']
+    except KeyError:
+        return UTCDateTime(thread['ARRIVAL_DATE'] + 'T' +
+                           thread['ARRIVAL_TIME']).timestamp
+
+
+def _kind_of(value):
+    if isinstance(value, (bool, np.bool_)):
+        return 'category'
+    if isinstance(value, (int, np.integer)):
+        return 'int'
+    if isinstance(value, (float, np.floating)):
+        return 'float'
+    return 'category'
+
+
+class ArrivalRow(Mapping):
+    r"""Read-only view of one arrival of an `ArrivalTable`.
+    Behaves like the former per-arrival dict (``row['STA']``,
+    ``row.copy()``) without storing one dict per arrival.
+    """
+    __slots__ = ('table', 'index')
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    def __getitem__(self, name):
+        return self.table.value(name, self.index)
+
+    def __iter__(self):
+        return iter(self.table.fields)
+
+    def __len__(self):
+        return len(self.table.fields)
+
+    def copy(self):
+        r"""Mutable dict of this arrival.
+        """
+        return dict(self.items())
+
+    def __repr__(self):
+        return repr(self.copy())
+
+
+class ArrivalTable():
+    r"""Columnar table of arrival recordings.
+    Every field is stored as one numpy column. Station, channel, phase,
+    date and event type labels are interned: each column keeps a table of
+    the distinct labels and an int32 code per arrival, which makes
+    filtering, sorting and grouping vectorized operations on integers.
+    Iterating the table yields light `ArrivalRow` views.
+
+    Parameters
+    ----------
+    columns : dict
+        Field name to numpy array (codes for categorical fields).
+    categories : dict, optional
+        Field name to the array of labels of a categorical field.
+    fields : tuple, optional
+        Field order. The default is the order of `columns`.
+    """
+    def __init__(self, columns, categories=None, fields=None):
+        self.fields = tuple(fields) if fields is not None else tuple(columns)
+        self._columns = dict(columns)
+        self._categories = dict(categories or {})
+        self._labels = {}
+        lengths = set(len(self._columns[name]) for name in self.fields)
+        if len(lengths) > 1:
+            raise ValueError('Columns of an ArrivalTable must have the same '
+                             'length.')
+        self._length = lengths.pop() if lengths else 0
+
+    @classmethod
+    def from_records(cls, records, fields=None):
+        r"""Build a table from an iterable of arrival dicts.
+        The iterable is consumed once, so a generator (e.g. a streamed ISC
+        query) never has to be held as a list of dicts.
+        """
+        records = iter(records)
+        first = next(records, None)
+        if first is None:
+            fields = tuple(fields or COLUMN_KINDS)
+            columns = {}
+            categories = {}
+            for name in fields:
+                kind = COLUMN_KINDS.get(name, 'category')
+                if kind == 'text':
+                    columns[name] = np.array([], dtype='U1')
+                else:
+                    columns[name] = np.array([], dtype=_DTYPES[kind])
+                if kind == 'category':
+                    categories[name] = np.array([], dtype='U1')
+            return cls(columns, categories, fields)
+        fields = tuple(fields or first.keys())
+        kinds = [COLUMN_KINDS.get(name) or _kind_of(first[name])
+                 for name in fields]
+        buffers = [array(_TYPECODES[kind]) if kind in _TYPECODES else []
+                   for kind in kinds]
+        lookups = [{} if kind == 'category' else None for kind in kinds]
+        for record in _chain(first, records):
+            for name, buffer, lookup in zip(fields, buffers, lookups):
+                value = record[name]
+                if lookup is not None:
+                    code = lookup.get(value)
+                    if code is None:
+                        code = lookup[value] = len(lookup)
+                    value = code
+                buffer.append(value)
+        columns = {}
+        categories = {}
+        for name, kind, buffer, lookup in zip(fields, kinds, buffers,
+                                              lookups):
+            if kind == 'text':
+                columns[name] = np.array(buffer, dtype=str)
+            else:
+                columns[name] = np.frombuffer(buffer, dtype=_DTYPES[kind]) \
+                    if len(buffer) else np.array([], dtype=_DTYPES[kind])
+            if lookup is not None:
+                labels = [None] * len(lookup)
+                for label, code in lookup.items():
+                    labels[code] = label
+                categories[name] = np.array([str(label) for label in labels],
+                                            dtype=str)
+        return cls(columns, categories, fields)
+
+    @classmethod
+    def from_dataframe(cls, data):
+        r"""Build a table from a pandas.DataFrame.
+        """
+        columns = {}
+        categories = {}
+        for name in data.columns:
+            series = data[name]
+            kind = COLUMN_KINDS.get(name)
+            if kind is None:
+                if pd.api.types.is_integer_dtype(series):
+                    kind = 'int'
+                elif pd.api.types.is_float_dtype(series):
+                    kind = 'float'
+                else:
+                    kind = 'category'
+            if kind == 'category':
+                cat = pd.Categorical(series.astype(str))
+                columns[name] = np.asarray(cat.codes, dtype=np.int32)
+                categories[name] = np.asarray(cat.categories, dtype=str)
+            elif kind == 'text':
+                columns[name] = np.asarray(series.astype(str), dtype=str)
+            else:
+                columns[name] = np.asarray(series, dtype=_DTYPES[kind])
+        return cls(columns, categories, tuple(data.columns))
+
+    @classmethod
+    def concat(cls, tables):
+        r"""Concatenate tables with the same fields, merging label tables.
+        """
+        tables = [table for table in tables if table is not None]
+        if not tables:
+            return cls.from_records([])
+        fields = tables[0].fields
+        columns = {}
+        categories = {}
+        for name in fields:
+            if tables[0].is_categorical(name):
+                labels = np.unique(np.concatenate(
+                    [table._categories[name] for table in tables]))
+                parts = []
+                for table in tables:
+                    remap = np.searchsorted(labels, table._categories[name])
+                    parts.append(remap.astype(np.int32)[table._columns[name]]
+                                 if len(remap) else table._columns[name])
+                columns[name] = np.concatenate(parts).astype(np.int32)
+                categories[name] = labels
+            else:
+                columns[name] = np.concatenate(
+                    [table._columns[name] for table in tables])
+        return cls(columns, categories, fields)
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        for index in range(self._length):
+            yield ArrivalRow(self, index)
+
+    def __getitem__(self, item):
+        if isinstance(item, str):
+            return self.column(item)
+        if isinstance(item, (int, np.integer)):
+            if item < 0:
+                item += self._length
+            if not 0 <= item < self._length:
+                raise IndexError('ArrivalTable index out of range.')
+            return ArrivalRow(self, int(item))
+        return self.take(item)
+
+    def __contains__(self, name):
+        return name in self._columns
+
+    def __repr__(self):
+        return '<ArrivalTable: {0} arrivals, {1} fields>'.format(
+            self._length, len(self.fields))
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for array in self._columns.values()) + \
+            sum(array.nbytes for array in self._categories.values())
+
+    def is_categorical(self, name):
+        return name in self._categories
+
+    def value(self, name, index):
+        r"""Python value of field `name` of arrival `index`.
+        """
+        if name in self._categories:
+            labels = self._labels.get(name)
+            if labels is None:
+                # one shared (interned) str object per label
+                labels = self._labels[name] = \
+                    [sys.intern(label) for label in
+                     self._categories[name].tolist()]
+            return labels[self._columns[name][index]]
+        return self._columns[name][index].item()
+
+    def column(self, name):
+        r"""Decoded numpy column of field `name`.
+        """
+        if name in self._categories:
+            return self._categories[name][self._columns[name]]
+        return self._columns[name]
+
+    def codes(self, name):
+        r"""Integer codes of a categorical field.
+        """
+        return self._columns[name]
+
+    def categories(self, name):
+        r"""Distinct labels of a categorical field.
+        """
+        return self._categories[name]
+
+    def take(self, index):
+        r"""New table of the selected arrivals (slice, mask or indices).
+        The label tables are shared with this table.
+        """
+        columns = {name: self._columns[name][index] for name in self.fields}
+        return ArrivalTable(columns, self._categories, self.fields)
+
+    def where(self, **conditions):
+        r"""Boolean mask of the arrivals matching every condition.
+        A condition is one value or a list of accepted values, e.g.
+        ``table.where(STA='LLLB', ISCPHASE=['P', 'Pn'])``.
+        """
+        mask = np.ones(self._length, dtype=bool)
+        for name, wanted in conditions.items():
+            if isinstance(wanted, (str, bytes)) or not np.iterable(wanted):
+                wanted = [wanted]
+            if name in self._categories:
+                labels = self._categories[name]
+                codes = np.flatnonzero(np.isin(labels, list(wanted)))
+                mask &= np.isin(self._columns[name], codes)
+            else:
+                mask &= np.isin(self._columns[name], list(wanted))
+        return mask
+
+    def filter(self, mask=None, **conditions):
+        r"""Table of the arrivals selected by `mask` and/or `conditions`.
+        """
+        if mask is None:
+            mask = self.where(**conditions)
+        elif conditions:
+            mask = np.asarray(mask) & self.where(**conditions)
+        return self.take(mask)
+
+    def _sortkey(self, name):
+        if name in self._categories:
+            # label order of the codes
+            rank = np.argsort(np.argsort(self._categories[name]))
+            return rank[self._columns[name]]
+        return self._columns[name]
+
+    def argsort(self, *names):
+        keys = [self._sortkey(name) for name in reversed(names)]
+        return np.lexsort(keys) if keys else np.arange(self._length)
+
+    def sort(self, *names):
+        r"""Table sorted on one or several fields (stable).
+        """
+        return self.take(self.argsort(*names))
+
+    def groupby(self, *names):
+        r"""Row indices of every distinct key of the `names` fields.
+
+        Returns
+        -------
+        groups : dict
+            Key tuple (decoded values) to an array of row indices.
+        """
+        if self._length == 0:
+            return {}
+        keys = np.stack([np.unique(self._columns[name],
+                                   return_inverse=True)[1].ravel()
+                         for name in names], axis=1)
+        unique, inverse = np.unique(keys, axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+        order = np.argsort(inverse, kind='stable')
+        bounds = np.cumsum(np.bincount(inverse, minlength=len(unique)))[:-1]
+        groups = {}
+        for rows in np.split(order, bounds):
+            first = rows[0]
+            key = tuple(self.value(name, first) for name in names)
+            groups[key] = rows
+        return groups
+
+    def drop_duplicates(self, *names):
+        r"""Table without repeated keys of the `names` fields, keeping the
+        first occurrence of each key in table order.
+        """
+        if self._length == 0:
+            return self
+        keys = np.stack([np.unique(self._columns[name],
+                                   return_inverse=True)[1].ravel()
+                         for name in (names or self.fields)], axis=1)
+        first = np.unique(keys, axis=0, return_index=True)[1]
+        if len(first) == self._length:
+            return self
+        return self.take(np.sort(first))
+
+    def unique(self, name):
+        r"""Distinct values of a field.
+        """
+        if name in self._categories:
+            return self._categories[name][np.unique(self._columns[name])]
+        return np.unique(self._columns[name])
+
+    def _seconds(self, name, parse):
+        # parse the labels only for categorical fields
+        if name in self._categories:
+            return parse(self._categories[name])[self._columns[name]]
+        return parse(self._columns[name])
+
+    def with_epochs(self):
+        r"""Table with the ARRIVAL_EPOCH and ORIGIN_EPOCH columns.
+        The date and time strings are parsed once, in bulk, into float64
+        POSIX seconds (NaN for blank or invalid stamps). Epoch columns which
+        already exist are kept.
+        """
+        columns = dict(self._columns)
+        fields = list(self.fields)
+        for epoch, date, clock in EPOCH_FIELDS:
+            if epoch in fields or date not in fields or clock not in fields:
+                continue
+            if self._length == 0:
+                columns[epoch] = np.array([], dtype=np.float64)
+            else:
+                columns[epoch] = self._seconds(date, _day_seconds) + \
+                    self._seconds(clock, _clock_seconds)
+            fields.append(epoch)
+        if len(fields) == len(self.fields):
+            return self
+        return ArrivalTable(columns, self._categories, fields)
+
+    def save(self, path):
+        r"""Save the table as an uncompressed .npz of typed columns.
+        No Python object is pickled, so the file is reopened with
+        `ArrivalTable.load` by mapping the columns instead of parsing them.
+        The file is replaced atomically: tables still mapping the former
+        file keep reading valid data.
+        """
+        if not path.endswith('.npz'):
+            path = path + '.npz'
+        arrays = {'fields': np.array(self.fields, dtype=str)}
+        for name in self.fields:
+            arrays['column/' + name] = np.asarray(self._columns[name])
+            if name in self._categories:
+                arrays['labels/' + name] = np.asarray(self._categories[name],
+                                                      dtype=str)
+        temp = path[:-4] + '.tmp.npz'
+        np.savez(temp, **arrays)
+        os.replace(temp, path)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        r"""Open a table saved by `ArrivalTable.save`.
+
+        Parameters
+        ----------
+        path : str
+            .npz file.
+        mmap : bool, optional
+            Memory-map the columns (read-only) rather than reading them. Only
+            the pages of the columns actually used are then read from disk.
+            The default is True.
+        """
+        arrays = _load_npz(path, mmap)
+        fields = tuple(arrays['fields'].tolist())
+        columns = {name: arrays['column/' + name] for name in fields}
+        categories = {name: arrays['labels/' + name] for name in fields
+                      if 'labels/' + name in arrays}
+        return cls(columns, categories, fields)
+
+    def to_records(self):
+        r"""List of per-arrival dicts (former `arrival_recordings`).
+        """
+        return [row.copy() for row in self]
+
+    def to_dataframe(self):
+        r"""pandas.DataFrame with categorical columns.
+        """
+        data = {}
+        for name in self.fields:
+            if name in self._categories:
+                data[name] = pd.Categorical.from_codes(
+                    self._columns[name], categories=self._categories[name])
+            else:
+                data[name] = self._columns[name]
+        return pd.DataFrame(data, columns=list(self.fields))
+
+
+class PhaseIndex():
+    r"""Grouped index of the phases of an `ArrivalTable`.
+    Arrivals are grouped once on the `keys` fields (one event at one
+    station by default, or one waveform file), so every phase of a group is
+    found in constant time instead of scanning the whole table for each
+    arrival, e.g. to pair an S with its P.
+
+    Parameters
+    ----------
+    table : ArrivalTable
+        Indexed arrivals.
+    keys : tuple, optional
+        Grouping fields. The default is ('EVENTID', 'STA').
+    phase : str, optional
+        Phase name field. The default is 'ISCPHASE'.
+    """
+    def __init__(self, table, keys=('EVENTID', 'STA'), phase='ISCPHASE'):
+        self.table = table
+        self.keys = tuple(keys)
+        self.phase = phase
+        self.groups = table.groupby(*self.keys)
+
+    def __len__(self):
+        return len(self.groups)
+
+    def key(self, thread):
+        r"""Group key of an arrival (row, dict or pandas.Series).
+        """
+        return tuple(thread[name] for name in self.keys)
+
+    def rows(self, thread):
+        r"""Row indices of the group of `thread`.
+        """
+        return self.groups.get(self.key(thread), np.array([], dtype=np.intp))
+
+    def phases(self, thread):
+        r"""Arrivals of the group of `thread` as {phase name: ArrivalRow},
+        keeping the first arrival of a repeated phase.
+        """
+        found = {}
+        for index in self.rows(thread):
+            row = self.table[int(index)]
+            found.setdefault(row[self.phase], row)
+        return found
+
+    def find(self, thread, phase):
+        r"""First arrival of the group of `thread` whose phase is `phase`
+        (a name, or a callable testing the name), or None.
+        """
+        match = phase if callable(phase) else (lambda name: name == phase)
+        for index in self.rows(thread):
+            if match(self.table.value(self.phase, int(index))):
+                return self.table[int(index)]
+        return None
+
+
+def _load_npz(path, mmap=True):
+    # arrays of an .npz file, members stored uncompressed are memory-mapped
+    arrays = {}
+    with zipfile.ZipFile(path) as archive, open(path, 'rb') as fp:
+        for info in archive.infolist():
+            name = info.filename
+            if name.endswith('.npy'):
+                name = name[:-4]
+            if not mmap or info.compress_type != zipfile.ZIP_STORED:
+                with archive.open(info) as member:
+                    arrays[name] = np.lib.format.read_array(
+                        member, allow_pickle=False)
+                continue
+            # skip the local file header (30 bytes, name and extra field)
+            fp.seek(info.header_offset)
+            lengths = struct.unpack('<HH', fp.read(30)[26:30])
+            fp.seek(info.header_offset + 30 + sum(lengths))
+            version = np.lib.format.read_magic(fp)
+            if version == (1, 0):
+                shape, fortran, dtype = np.lib.format.read_array_header_1_0(fp)
+            else:
+                shape, fortran, dtype = np.lib.format.read_array_header_2_0(fp)
+            if dtype.hasobject:
+                raise ValueError('Object arrays cannot be loaded from an '
+                                 'ArrivalTable file.')
+            if int(np.prod(shape)) == 0:
+                arrays[name] = np.empty(shape, dtype=dtype)
+            else:
+                arrays[name] = np.memmap(path, dtype=dtype, mode='r',
+                                         offset=fp.tell(), shape=shape,
+                                         order='F' if fortran else 'C')
+    return arrays
+
+
+def _chain(first, rest):
+    yield first
+    for record in rest:
+        yield record
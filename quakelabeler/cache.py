@@ -0,0 +1,510 @@
+# -*- coding: utf-8 -*-
+# MIT License
+#
+# Copyright (c) 2021 Hao Mai & Pascal Audet
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""
+Local caches
+On-disk caches of ISC query results and raw waveforms shared across runs.
+@author: Hao Mai & Pascal Audet
+"""
+from __future__ import (absolute_import, division, print_function)
+
+import os
+import json
+import time
+import hashlib
+import zipfile
+import threading
+import numpy as np
+from obspy import read
+from obspy.core.utcdatetime import UTCDateTime
+from .isc import param_time
+from .arrivals import ArrivalTable
+
+# ISC params which define the event time range of a query
+TIME_KEYS = ('start_year', 'start_month', 'start_day', 'start_time',
+             'end_year', 'end_month', 'end_day', 'end_time')
+
+
+def default_cache_dir(name):
+    r"""Cache folder `name` under $QUAKELABELER_CACHE or ~/.quakelabeler.
+    """
+    root = os.environ.get('QUAKELABELER_CACHE',
+                          os.path.join(os.path.expanduser('~'),
+                                       '.quakelabeler', 'cache'))
+    return os.path.join(root, name)
+
+
+def canonical_params(params, skip=()):
+    r"""Canonical text of a params dict: sorted keys, stripped values and
+    numbers in one notation (e.g. '40.00' and '40' are the same query).
+    """
+    canonical = {}
+    for key, value in params.items():
+        if key in skip:
+            continue
+        text = str(value).strip()
+        try:
+            text = repr(float(text))
+        except ValueError:
+            pass
+        canonical[str(key)] = text
+    return json.dumps(canonical, sort_keys=True)
+
+
+def _time_key(value):
+    return value.strftime('%Y-%m-%dT%H:%M:%S')
+
+
+class QueryCache():
+    r"""Persistent cache of ISC arrivals query results.
+    Results are stored per query (or per planner tile) as `ArrivalTable`
+    .npz files, keyed on a hash of the canonical params. A query is answered from disk if the same params
+    were cached, or if its event time range is fully covered by cached
+    queries which only differ by their time range. Entries expire after
+    `ttl` seconds and the least recently used entries are evicted when the
+    cache grows above `max_bytes`.
+
+    Parameters
+    ----------
+    path : str, optional
+        Cache folder. The default is ~/.quakelabeler/cache/isc.
+    ttl : float, optional
+        Time to live of an entry in seconds. The default is 30 days.
+    max_bytes : int, optional
+        Size limit of the cache. The default is 2 GB.
+    """
+    def __init__(self, path=None, ttl=30*24*3600, max_bytes=2*1024**3):
+        self.path = path or default_cache_dir('isc')
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.RLock()
+        self._index_file = os.path.join(self.path, 'index.json')
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        self.index = self._load_index()
+        self.prune()
+
+    def _load_index(self):
+        try:
+            with open(self._index_file) as fp:
+                return json.load(fp)
+        except (IOError, ValueError):
+            return {}
+
+    def _reconcile(self):
+        # a killed run leaves the windows stored after its last index write
+        # (their requested codes and span are only in the index) and
+        # partial writes: remove them, and the entries without a file
+        names = set(os.listdir(self.path))
+        for name in names:
+            if name.endswith('.tmp') or (name.endswith('.mseed') and
+                                         name[:-6] not in self.index):
+                try:
+                    os.remove(os.path.join(self.path, name))
+                except OSError:
+                    pass
+        for key in [key for key in self.index if key + '.mseed' not in names]:
+            del self.index[key]
+            self._dirty += 1
+
+    def flush(self):
+        r"""Write the index to disk.
+        """
+        with self._lock:
+            temp = self._index_file + '.tmp'
+            with open(temp, 'w') as fp:
+                json.dump(self.index, fp)
+            os.replace(temp, self._index_file)
+
+    def key(self, params):
+        return hashlib.sha1(canonical_params(params).encode()).hexdigest()
+
+    def base_key(self, params):
+        r"""Hash of the params without the event time range.
+        """
+        text = canonical_params(params, skip=TIME_KEYS)
+        return hashlib.sha1(text.encode()).hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.path, key + '.npz')
+
+    def _expired(self, entry, now):
+        return self.ttl is not None and entry['created'] + self.ttl < now
+
+    def _remove(self, key):
+        entry = self.index.pop(key, None)
+        if entry is not None and entry.get('size'):
+            try:
+                os.remove(self._file(key))
+            except OSError:
+                pass
+
+    def _read(self, key):
+        try:
+            # read in memory: entries can be evicted while the table is used
+            return ArrivalTable.load(self._file(key), mmap=False)
+        except (IOError, ValueError, KeyError, zipfile.BadZipfile):
+            return None
+
+    def _entry(self, key, now):
+        entry = self.index.get(key)
+        if entry is None:
+            return None
+        if self._expired(entry, now):
+            self._remove(key)
+            return None
+        return entry
+
+    def _resolve(self, key, now):
+        # records of an entry, following split markers to their children
+        entry = self._entry(key, now)
+        if entry is None:
+            return None
+        if 'children' in entry:
+            parts = []
+            for child in entry['children']:
+                part = self._resolve(child, now)
+                if part is None:
+                    return None
+                parts.append(part)
+            records = ArrivalTable.concat(parts)
+        else:
+            records = self._read(key)
+            if records is None:
+                self._remove(key)
+                return None
+        entry['used'] = now
+        return records
+
+    def get(self, params):
+        r"""Cached `ArrivalTable` of `params`, or None on a cache miss.
+        """
+        now = time.time()
+        with self._lock:
+            records = self._resolve(self.key(params), now)
+            if records is None:
+                records = self.covered(params, now)
+            if records is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return records
+
+    def covered(self, params, now=None):
+        r"""Records of `params` assembled from cached queries whose time
+        ranges cover the requested one, filtered on the origin time.
+        """
+        now = now or time.time()
+        start = param_time(params, 'start')
+        end = param_time(params, 'end')
+        if start is None or end is None:
+            return None
+        start, end = _time_key(start), _time_key(end)
+        base = self.base_key(params)
+        with self._lock:
+            spans = sorted((entry['start'], entry['end'], key)
+                           for key, entry in list(self.index.items())
+                           if entry.get('base') == base and entry.get('start')
+                           and self._entry(key, now) is not None)
+            used = []
+            reach = start
+            for lower, upper, key in spans:
+                if reach >= end:
+                    break
+                if lower <= reach and upper > reach:
+                    used.append(key)
+                    reach = upper
+            if reach < end or not used:
+                return None
+            parts = []
+            for key in used:
+                part = self._resolve(key, now)
+                if part is None:
+                    return None
+                parts.append(part)
+        records = ArrivalTable.concat(parts)
+        if 'ORIGIN_DATE' not in records or 'ORIGIN_TIME' not in records:
+            return None
+        # origin time inside the range (second resolution as ISC)
+        origin = np.char.add(np.char.add(records.column('ORIGIN_DATE'), 'T'),
+                             records.column('ORIGIN_TIME'))
+        return records.filter((origin >= start) & (origin <= end + '.99'))
+
+    def _add(self, params, entry):
+        now = time.time()
+        start = param_time(params, 'start')
+        end = param_time(params, 'end')
+        entry.update({'base': self.base_key(params),
+                      'start': _time_key(start) if start else None,
+                      'end': _time_key(end) if end else None,
+                      'created': now, 'used': now})
+        self.index[self.key(params)] = entry
+
+    def put(self, params, records):
+        r"""Store the records (`ArrivalTable` or arrival dicts) of one query.
+        """
+        if not isinstance(records, ArrivalTable):
+            records = ArrivalTable.from_records(records)
+        key = self.key(params)
+        with self._lock:
+            records.save(self._file(key))
+            self._add(params, {'size': os.path.getsize(self._file(key))})
+            self.prune()
+            self.flush()
+
+    def put_split(self, params, children):
+        r"""Record that the query `params` was answered by the `children`
+        queries (a planner tile which was split).
+        """
+        with self._lock:
+            self._add(params, {'size': 0,
+                               'children': [self.key(child)
+                                            for child in children]})
+            self.flush()
+
+    def size(self):
+        return sum(entry.get('size', 0) for entry in self.index.values())
+
+    def prune(self):
+        r"""Remove expired entries and evict the least recently used ones
+        above the size limit.
+        """
+        now = time.time()
+        with self._lock:
+            for key in [key for key, entry in self.index.items()
+                        if self._expired(entry, now)]:
+                self._remove(key)
+            if self.max_bytes is None:
+                return
+            total = self.size()
+            for key in sorted(self.index, key=lambda k: self.index[k]['used']):
+                if total <= self.max_bytes:
+                    break
+                total -= self.index[key].get('size', 0)
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            for key in list(self.index):
+                self._remove(key)
+            self.flush()
+
+
+class WaveformCache():
+    r"""Persistent cache of raw (unprocessed) waveforms.
+    Each downloaded window is stored as a MiniSEED file, Steim2 compressed
+    when the samples are integers, and indexed by its requested network,
+    station, location and channel codes and time span. Any window contained
+    in a cached span of the same codes is served from disk, so a new recipe
+    (filter, sample length, export format) does not download the data
+    again. The least recently used windows are evicted when the cache grows
+    above `max_bytes`. The index is written and the cache pruned every
+    `sync_every` stored windows and on `close`, not on every window; the
+    files of a killed run missing from the index are removed on opening.
+
+    Parameters
+    ----------
+    path : str, optional
+        Cache folder. The default is ~/.quakelabeler/cache/waveforms.
+    max_bytes : int, optional
+        Size limit of the cache. The default is 20 GB.
+    sync_every : int, optional
+        Stored windows between two writes of the index. The default is 200.
+    """
+    def __init__(self, path=None, max_bytes=20*1024**3, sync_every=200):
+        self.path = path or default_cache_dir('waveforms')
+        self.max_bytes = max_bytes
+        self.sync_every = sync_every
+        self.hits = 0
+        self.misses = 0
+        # changes of the index not written yet, windows stored since the
+        # last sync
+        self._dirty = 0
+        self._puts = 0
+        self._lock = threading.RLock()
+        self._index_file = os.path.join(self.path, 'index.json')
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        self.index = self._load_index()
+        self._reconcile()
+        # codes -> keys of the cached spans
+        self._spans = {}
+        for key, entry in self.index.items():
+            self._spans.setdefault(entry['codes'], []).append(key)
+        self._bytes = sum(entry['size'] for entry in self.index.values())
+
+    def _load_index(self):
+        try:
+            with open(self._index_file) as fp:
+                return json.load(fp)
+        except (IOError, ValueError):
+            return {}
+
+    def _reconcile(self):
+        # a killed run leaves the windows stored after its last index write
+        # (their requested codes and span are only in the index) and
+        # partial writes: remove them, and the entries without a file
+        names = set(os.listdir(self.path))
+        for name in names:
+            if name.endswith('.tmp') or (name.endswith('.mseed') and
+                                         name[:-6] not in self.index):
+                try:
+                    os.remove(os.path.join(self.path, name))
+                except OSError:
+                    pass
+        for key in [key for key in self.index if key + '.mseed' not in names]:
+            del self.index[key]
+            self._dirty += 1
+
+    def flush(self):
+        r"""Write the index to disk.
+        """
+        with self._lock:
+            temp = self._index_file + '.tmp'
+            with open(temp, 'w') as fp:
+                json.dump(self.index, fp)
+            os.replace(temp, self._index_file)
+            self._dirty = 0
+            self._puts = 0
+
+    def close(self):
+        r"""Prune the cache and write the index if it changed.
+        """
+        with self._lock:
+            if self._dirty:
+                self.prune()
+                self.flush()
+
+    def size(self):
+        return self._bytes
+
+    @staticmethod
+    def codes(window):
+        return '.'.join(str(code) for code in window[:4])
+
+    def key(self, window):
+        text = '{0}|{1}|{2}'.format(self.codes(window),
+                                    UTCDateTime(window[4]).timestamp,
+                                    UTCDateTime(window[5]).timestamp)
+        return hashlib.sha1(text.encode()).hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.path, key + '.mseed')
+
+    def _remove(self, key):
+        entry = self.index.pop(key, None)
+        if entry is None:
+            return
+        self._bytes -= entry['size']
+        self._dirty += 1
+        self._spans[entry['codes']].remove(key)
+        try:
+            os.remove(self._file(key))
+        except OSError:
+            pass
+
+    def find(self, window):
+        r"""Key of a cached span which contains `window`, or None.
+        """
+        start = UTCDateTime(window[4]).timestamp
+        end = UTCDateTime(window[5]).timestamp
+        with self._lock:
+            for key in self._spans.get(self.codes(window), ()):
+                entry = self.index[key]
+                if entry['start'] <= start and entry['end'] >= end:
+                    return key
+        return None
+
+    def get(self, window):
+        r"""Cached Stream of `window` (network, station, location, channel,
+        start, end), or None on a cache miss.
+        """
+        key = self.find(window)
+        st = None
+        if key is not None:
+            # read without the lock: files are only replaced atomically
+            try:
+                st = read(self._file(key), format='MSEED')
+            except Exception:
+                with self._lock:
+                    self._remove(key)
+        with self._lock:
+            if st is None:
+                self.misses += 1
+                return None
+            entry = self.index.get(key)
+            if entry is not None:
+                entry['used'] = time.time()
+                self._dirty += 1
+            self.hits += 1
+        return st.slice(UTCDateTime(window[4]), UTCDateTime(window[5]))
+
+    def put(self, window, st):
+        r"""Store the raw Stream downloaded for `window`.
+        """
+        if len(st) == 0:
+            return
+        key = self.key(window)
+        temp = '{0}.{1}.tmp'.format(self._file(key), threading.get_ident())
+        try:
+            st.write(temp, format='MSEED', encoding='STEIM2')
+        except Exception:
+            # Steim2 only compresses integer samples
+            st.write(temp, format='MSEED')
+        now = time.time()
+        with self._lock:
+            if key in self.index:
+                self._remove(key)
+            os.replace(temp, self._file(key))
+            self.index[key] = {'codes': self.codes(window),
+                               'start': UTCDateTime(window[4]).timestamp,
+                               'end': UTCDateTime(window[5]).timestamp,
+                               'size': os.path.getsize(self._file(key)),
+                               'created': now, 'used': now}
+            self._bytes += self.index[key]['size']
+            self._spans.setdefault(self.codes(window), []).append(key)
+            self._dirty += 1
+            self._puts += 1
+            if self._puts >= self.sync_every:
+                self.prune()
+                self.flush()
+
+    def prune(self):
+        r"""Evict the least recently used windows above the size limit.
+        """
+        with self._lock:
+            if self.max_bytes is None:
+                return
+            total = self.size()
+            for key in sorted(self.index, key=lambda k: self.index[k]['used']):
+                if total <= self.max_bytes:
+                    break
+                total -= self.index[key]['size']
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            for key in list(self.index):
+                self._remove(key)
+            self.flush()
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+# MIT License
+#
+# Copyright (c) 2021 Hao Mai & Pascal Audet
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""
+Stored catalogs
+Arrival catalogs kept on disk and extended with only the missing time range.
+@author: Hao Mai & Pascal Audet
+"""
+from __future__ import (absolute_import, division, print_function)
+
+import os
+import json
+from datetime import datetime
+import numpy as np
+from .isc import ARRIVAL_FIELDS, QueryPlanner, param_time, set_param_time
+from .cache import TIME_KEYS, canonical_params
+from .arrivals import ArrivalTable
+from .spatial import local_region, select_region
+
+# one arrival of a stored catalog
+CATALOG_KEY = ('EVENTID', 'STA', 'ISCPHASE')
+
+_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+_EPOCH = datetime(1970, 1, 1)
+
+
+class ArrivalCatalog():
+    r"""Arrival catalog stored on disk and refreshed incrementally.
+    The catalog remembers the query slices it already holds: the region,
+    magnitude and other query params, with the event time ranges stored for
+    them. A refresh only requests the time ranges which are not stored yet
+    and appends them to the catalog, dropping repeated
+    (EVENTID, STA, ISCPHASE) arrivals. The arrivals of slices with an FE
+    region or a station list, which cannot be selected locally, are
+    remembered by their (EVENTID, STA).
+
+    Parameters
+    ----------
+    name : str
+        Catalog name: the arrivals are saved in `name`.npz, the stored
+        slices in `name`.slices.json and the arrivals of the slices only
+        resolved by ISC in `name`.members.npz.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.path = name + '.npz'
+        self._slices_file = name + '.slices.json'
+        self._members_file = name + '.members.npz'
+        self.slices = self._load_slices()
+        self.members = self._load_members()
+
+    def _load_slices(self):
+        try:
+            with open(self._slices_file) as fp:
+                return json.load(fp)
+        except (IOError, ValueError):
+            return {}
+
+    def _save_slices(self):
+        temp = self._slices_file + '.tmp'
+        with open(temp, 'w') as fp:
+            json.dump(self.slices, fp, indent=1, sort_keys=True)
+        os.replace(temp, self._slices_file)
+
+    def _load_members(self):
+        try:
+            with np.load(self._members_file) as data:
+                return {key: data['slice_%d' % i]
+                        for i, key in enumerate(data['keys'].tolist())}
+        except IOError:
+            return {}
+
+    def _save_members(self):
+        keys = sorted(self.members)
+        arrays = {'slice_%d' % i: self.members[key]
+                  for i, key in enumerate(keys)}
+        temp = self._members_file + '.tmp.npz'
+        np.savez(temp, keys=np.array(keys, dtype=str), **arrays)
+        os.replace(temp, self._members_file)
+
+    @staticmethod
+    def _pairs(table):
+        # (EVENTID, STA) of each arrival as one string
+        return np.char.add(np.char.add(
+            table.column('EVENTID').astype(str), ' '),
+            table.column('STA').astype(str))
+
+    def _remember(self, params, table):
+        key = canonical_params(params, skip=TIME_KEYS)
+        self.members[key] = np.union1d(
+            self.members.get(key, np.array([], dtype=str)),
+            self._pairs(table))
+
+    def _time_range(self, params):
+        start = param_time(params, 'start')
+        end = param_time(params, 'end')
+        if start is None or end is None:
+            raise ValueError('A stored catalog needs the start and end time '
+                             'of the query.')
+        return start, end
+
+    def spans(self, params):
+        r"""Stored time ranges of the query slice of `params`, as sorted
+        (start, end) datetimes.
+        """
+        spans = self.slices.get(canonical_params(params, skip=TIME_KEYS), [])
+        return [(datetime.strptime(start, _TIME_FORMAT),
+                 datetime.strptime(end, _TIME_FORMAT)) for start, end in spans]
+
+    def missing(self, params):
+        r"""Time ranges of `params` which are not stored yet.
+        """
+        start, end = self._time_range(params)
+        gaps = []
+        reach = start
+        for lower, upper in self.spans(params):
+            if upper <= reach:
+                continue
+            if lower >= end:
+                break
+            if lower > reach:
+                gaps.append((reach, lower))
+            reach = upper
+        if reach < end:
+            gaps.append((reach, end))
+        return gaps
+
+    def add(self, params):
+        r"""Record the time range of `params` as stored.
+        """
+        start, end = self._time_range(params)
+        spans = sorted(self.spans(params) + [(start, end)])
+        merged = [list(spans[0])]
+        for lower, upper in spans[1:]:
+            if lower <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], upper)
+            else:
+                merged.append([lower, upper])
+        self.slices[canonical_params(params, skip=TIME_KEYS)] = \
+            [[lower.strftime(_TIME_FORMAT), upper.strftime(_TIME_FORMAT)]
+             for lower, upper in merged]
+
+    def load(self):
+        r"""Stored `ArrivalTable`, or None for a new catalog.
+        """
+        if not os.path.exists(self.path):
+            return None
+        return ArrivalTable.load(self.path).with_epochs()
+
+    def select(self, params):
+        r"""Stored arrivals matching the query `params`, selected locally:
+        origin time range, magnitude limits, station region and event
+        region (CIRC, RECT or POLY). FE regions and station lists are
+        selected from the arrivals fetched for the query slice of `params`.
+        No request is sent to ISC.
+        """
+        recordings = self.load()
+        if recordings is None:
+            raise IOError('No stored catalog {0}.'.format(self.path))
+        start, end = self._time_range(params)
+        origin = recordings['ORIGIN_EPOCH']
+        mask = (origin >= (start - _EPOCH).total_seconds()) & \
+            (origin < (end - _EPOCH).total_seconds() + 1)
+        if params.get('min_mag'):
+            mask &= recordings['EVENT_MAG'] >= float(params['min_mag'])
+        if params.get('max_mag'):
+            mask &= recordings['EVENT_MAG'] <= float(params['max_mag'])
+        if not local_region(params):
+            members = self.members.get(
+                canonical_params(params, skip=TIME_KEYS), [])
+            mask &= np.isin(self._pairs(recordings), members)
+            return recordings.filter(mask)
+        return select_region(recordings.filter(mask), params)
+
+    def refresh(self, url, params, fields=ARRIVAL_FIELDS, **kwargs):
+        r"""Bring the catalog up to date for the query `params`.
+        Only the missing time ranges are requested from ISC (through a
+        `QueryPlanner`, `kwargs` are passed to it); they are appended to the
+        stored arrivals and the catalog is saved.
+
+        Returns
+        -------
+        recordings : ArrivalTable
+            The stored arrivals matching `params` (see `select`).
+        """
+        stored = self.load()
+        if stored is None:
+            gaps = [self._time_range(params)]
+        else:
+            gaps = self.missing(params)
+        self.fetched = 0
+        if not gaps:
+            return self.select(params)
+        parts = [stored] if stored is not None else []
+        for start, end in gaps:
+            query = dict(params)
+            set_param_time(query, 'start', start)
+            set_param_time(query, 'end', end)
+            print("Requesting %s - %s ..." % (start, end))
+            table = QueryPlanner(url, query, fields, **kwargs).run()
+            self.fetched += len(table)
+            parts.append(table.with_epochs())
+            if not local_region(params):
+                self._remember(params, table)
+        recordings = ArrivalTable.concat(parts).drop_duplicates(*CATALOG_KEY)
+        recordings.save(self.path)
+        if not local_region(params):
+            self._save_members()
+        self.add(params)
+        self._save_slices()
+        return self.select(params)
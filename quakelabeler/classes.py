@@ -33,18 +33,19 @@ import shutil
 import logging
 import csv
 from obspy.core.utcdatetime import UTCDateTime
-from obspy.clients.fdsn import Client
+from obspy.clients.fdsn.header import FDSNNoDataException
 import warnings
 import random
 import numpy as np
 import pandas as pd
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from scipy.io import savemat
 LOGGER = logging.getLogger(__name__)
 # terminal figure
 import termplotlib as tpl
-# regular expression
-import re
 # get arrival information from webpages
 import requests
 # command line progress
@@ -55,6 +56,32 @@ from art import *
 from obspy import read
 import pygmt
 import h5py
+from .isc import ARRIVAL_FIELDS, ArrivalParser, QueryPlanner
+from .arrivals import ArrivalTable, PhaseIndex, arrival_epoch
+from .cache import QueryCache, WaveformCache
+from .catalog import ArrivalCatalog
+from .store import CatalogStore
+from .fdsn import (CHANNEL_PRIORITY, LOCATION_PRIORITY, AvailabilityIndex,
+                   WindowPlanner, concurrency, fetch_bulk, fetch_segments,
+                   get_client, rate_controller)
+from .process import StreamProcessor, transform_stream, trim_stream
+from .journal import SampleJournal, label_key, noise_key, record_key
+from .stations import NetworkResolver
+
+# messages of the waveform requests without a stream
+NO_DATA = "No data available for request."
+REQUEST_FAILED = "Request failed, retry later."
+# sub-sets of a dataset split by `QuakeLabeler.subfolder`
+SUBSETS = ('Training', 'Test', 'Validation')
+
+
+def _csv_rows(path):
+    # number of samples in a features CSV (0 without the file)
+    if not os.path.exists(path):
+        return 0
+    with open(path) as csvfile:
+        return sum(1 for row in csv.DictReader(csvfile))
+
 
 class QuakeLabeler():
     r""" ``Quake Labeler`` class enables to automatically label ground truth.
@@ -105,6 +132,8 @@ class QuakeLabeler():
         # init
         self.params = query.param
         self.recordings = query.arrival_recordings
+        # catalog database of the query, samples are stored in it as well
+        self.store = getattr(query, 'store', None)
         self.custom_dataset = custom.custom_dataset
         self.custom_waveform = custom.custom_waveform
         self.custom_export = custom.custom_export
@@ -112,6 +141,15 @@ class QuakeLabeler():
         #self.inventory = self.search_stations()
         # targe network names
         self.network = "*"
+        # (EVENTID, STA) index of the phases, built by fetch_all_waveforms
+        self.phase_index = None
+        # station sampling rates, read once by plan_windows
+        self.window_planner = None
+        self.availability = None
+        # raw waveforms of previous runs
+        self.waveform_cache = WaveformCache()
+        # networks of the station codes, for fully qualified requests
+        self.network_resolver = NetworkResolver()
 # =============================================================================
 #         if not self.inventory == False:
 #             self.network = self.search_network()
@@ -122,7 +160,7 @@ class QuakeLabeler():
         If the desired data center does not have available seismograms, this
         module will reminder user to change data center.
         '''
-        client = Client(clientname)
+        client = get_client(clientname)
         try:
             cat = client.get_events(starttime=self.starttime,
                                     endtime=self.endtime,
@@ -158,7 +196,7 @@ class QuakeLabeler():
         inventory : Inventory object
             Return an Inventory object which stored available stations.
         '''
-        client = Client(clientname)
+        client = get_client(clientname)
         sta_params = {}
         if self.params['stnsearch'] == 'RECT':
             sta_params['minlatitude'] = self.params['stn_bot_lat']
@@ -184,9 +222,9 @@ class QuakeLabeler():
         Method to examine if there's available waveform from certain
         data center for download in the target time range.
         """
-        client = Client(clientname)
+        client = get_client(clientname)
         (network, station, location, channel) = self.related_station_info(
-                                                thread['STA'])
+                                                thread['STA'], thread)
         try:
             st = client.get_waveforms(
                                 network, station, location, channel, t1, t2)
@@ -195,6 +233,40 @@ class QuakeLabeler():
         else:
             return st[0]
 
+    def plan_windows(self, clientname="IRIS", stations=()):
+        r"""Read the sampling rates and data availability of `stations`.
+        One bulk metadata request replaces a probe waveform download per
+        sample in `waveform_timewindow`, and the windows without data are
+        not requested at all (see `AvailabilityIndex`).
+        """
+        # metadata of every preferred band, to select one 3-C set per sample
+        bands = self.custom_waveform.get('channel_priority', CHANNEL_PRIORITY)
+        locations = self.custom_waveform.get('location_priority',
+                                             LOCATION_PRIORITY)
+        self.window_planner = WindowPlanner(
+            get_client(clientname), self.network, "*",
+            ','.join(band + "?" for band in bands), locations=locations)
+        self.availability = AvailabilityIndex(self.window_planner)
+        self.availability.prefetch(stations)
+        if getattr(self, 'network_resolver', None) is not None:
+            # networks of the stations missing from the station list
+            self.network_resolver.prefetch(self.window_planner.client,
+                                           stations)
+        return self.window_planner
+
+    def sample_rate(self, thread, time):
+        r"""Sampling rate of a sample: the resample rate if set, else the
+        rate of the station channels from station metadata (None if the
+        station has no metadata).
+        """
+        try:
+            return int(self.custom_waveform['sample_rate'])
+        except Exception:
+            pass
+        if self.window_planner is None:
+            self.plan_windows()
+        return self.window_planner.sampling_rate(thread['STA'], time)
+
     def waveform_timewindow(self, thread, sample_points=50*60):
         r"""Calculate sample's startime and endtime.
         Method to ensure retrieve enough time length waveform.
@@ -211,7 +283,8 @@ class QuakeLabeler():
         endtime : UTCTime
             End time for this waveform.
         """
-        eventTime = thread['ARRIVAL_DATE'] + 'T' + thread['ARRIVAL_TIME']
+        # arrival time in POSIX seconds, parsed once when the catalog loads
+        arrival = arrival_epoch(thread)
         if self.custom_dataset['fixed_length']:
             # random start time option
             if self.custom_waveform['random_arrival']:
@@ -219,51 +292,38 @@ class QuakeLabeler():
                 # default: 10~180 s before first arrival
                 #  30~90 s after arrival
                 start = random.randint(10, 180)
-                starttime = UTCDateTime(eventTime) - start
+                starttime = UTCDateTime(arrival - start)
                 end = random.randint(30, 90)
-                endtime = UTCDateTime(eventTime) + end
-                trace = self.judge_time_range(thread, starttime, endtime)
-                if not trace == False:
-                    try:
-                        resample_rate = int(
-                                self.custom_waveform['sample_rate'])
-                    except Exception:
-                        pass
-                    else:
-                        trace.stats.sampling_rate = resample_rate
+                endtime = UTCDateTime(arrival + end)
+                rate = self.sample_rate(thread, starttime)
+                if rate is not None:
                     # loop: calculate a reasonal starttime
-                    while not trace.stats.sampling_rate*(UTCDateTime(eventTime) - starttime) < self.custom_dataset['sample_length']:
-                        start = random.randint(1,int(self.custom_dataset['sample_length']/trace.stats.sampling_rate))
-                        starttime = UTCDateTime(eventTime) - start
-                        endtime = starttime + int(self.custom_dataset['sample_length']/trace.stats.sampling_rate)
+                    while not rate*(arrival - starttime.timestamp) < self.custom_dataset['sample_length']:
+                        start = random.randint(1,int(self.custom_dataset['sample_length']/rate))
+                        starttime = UTCDateTime(arrival - start)
+                        endtime = starttime + int(self.custom_dataset['sample_length']/rate)
                     else:
-                        endtime = starttime + int(self.custom_dataset['sample_length']/trace.stats.sampling_rate)
+                        endtime = starttime + int(self.custom_dataset['sample_length']/rate)
             else:
                 #fixed startime: t1 sec before arrival
                 #time range might not satisfy fixed npts, need examine and re-crop
-                starttime = UTCDateTime(eventTime) - self.custom_waveform['start_arrival']
-                endtime =  UTCDateTime(eventTime) + self.custom_waveform['end_arrival']
-                trace = self.judge_time_range(thread, starttime, endtime)
-                if not trace == False:
-                    try:
-                        resample_rate = int(self.custom_waveform['sample_rate'])
-                    except Exception as e:
-                        pass
-                    else:
-                        trace.stats.sampling_rate = resample_rate
-                    endtime = starttime + int(self.custom_dataset['sample_length']/trace.stats.sampling_rate)
+                starttime = UTCDateTime(arrival - self.custom_waveform['start_arrival'])
+                endtime =  UTCDateTime(arrival + self.custom_waveform['end_arrival'])
+                rate = self.sample_rate(thread, starttime)
+                if rate is not None:
+                    endtime = starttime + int(self.custom_dataset['sample_length']/rate)
         else:
             # flexible waveform length
             if self.custom_waveform['random_arrival']:
                 # set a random stattime for each event(waveform) default: 10~180 s before first arrival ~ 30~90 s after arrival
                 start = random.randint(10, 90)
-                starttime = UTCDateTime(eventTime) - start
+                starttime = UTCDateTime(arrival - start)
                 end = random.randint(30, 90)
-                endtime = UTCDateTime(eventTime) + end
+                endtime = UTCDateTime(arrival + end)
             else:
-                starttime = UTCDateTime(eventTime) - self.custom_waveform['start_arrival']
-                endtime = UTCDateTime(eventTime) + self.custom_waveform['end_arrival']
-        self.eventtime = UTCDateTime(eventTime)
+                starttime = UTCDateTime(arrival - self.custom_waveform['start_arrival'])
+                endtime = UTCDateTime(arrival + self.custom_waveform['end_arrival'])
+        self.eventtime = UTCDateTime(arrival)
 
         return (starttime, endtime)
 
@@ -275,25 +335,35 @@ class QuakeLabeler():
         network = network[:-1]
         return network
 
-    def related_station_info(self, sta):
+    def related_station_info(self, sta, thread=None):
         # search available station / channel for target events
         station = str(sta)
         network = self.network
         location = "*"
         # all channel codes:
         # https://ds.iris.edu/ds/nodes/dmc/data/formats/seed-channel-naming/
-        channel = "BH?"
-        # drop low sampling rate channels which might not be useful
+        # preferred band first, e.g. ('HH', 'BH', 'EH')
+        bands = self.custom_waveform.get('channel_priority', CHANNEL_PRIORITY)
+        channel = bands[0] + "?"
+        if thread is None:
+            return (network, station, location, channel)
+        resolver = getattr(self, 'network_resolver', None)
+        if network == "*" and resolver is not None:
+            # network of the station at the arrival coordinates and time,
+            # "*" if it is not known
+            network = resolver.network(station, thread.get('ARRIVAL_LAT'),
+                                       thread.get('ARRIVAL_LON'),
+                                       arrival_epoch(thread))
+        if getattr(self, 'window_planner', None) is not None:
+            # one complete 3-C set from the station metadata (by band, then
+            # location preference) instead of every matching stream
+            selected = self.window_planner.select(station, arrival_epoch(thread))
+            if selected is not None:
+                (location, channel) = selected
         return (network, station, location, channel)
 
     def check_export_stream(self, st):
-        if self.custom_dataset['fixed_length']:
-            for tr in st:
-                if tr.stats.npts < self.custom_dataset['sample_length']:
-                    st.remove(tr)
-                if tr.stats.npts > self.custom_dataset['sample_length']:
-                    tr.data = tr.data[:self.custom_dataset['sample_length']]
-        return st
+        return trim_stream(st, self.custom_dataset)
 
     def fetch_waveform(self, thread, clientname="IRIS"):
         r"""Retrieve a target stream of waveforms from specific data center.
@@ -312,53 +382,228 @@ class QuakeLabeler():
         -------
         st : Obspy Stream Object
             Downloaded waveform which save as a obspy.stream object.
-        `No data available for request.` : str
+        `NO_DATA` or `REQUEST_FAILED` : str
             Failed request message.
         """
-        client = Client(clientname)
+        client = get_client(clientname)
         # calculate startime and endtime, must consider trace length, sampling rate to satisfy custom parameters
 
         (start_time, end_time) = self.waveform_timewindow(thread)
         # (start_time,end_time) = self.waveform_timewindow(thread)
-        (network, station, location, channel) = self.related_station_info(thread['STA'])
+        (network, station, location, channel) = self.related_station_info(thread['STA'], thread)
+        window = (network, station, location, channel, start_time, end_time+10)
+        st = self.waveform_cache.get(window)
+        if st is not None:
+            return self.process_waveform(st)
         try:
-            st = client.get_waveforms(network, station, location, channel, start_time, end_time+10)
+            st = client.get_waveforms(*window)
             # param attach_response  NEED UPDATE ONE INTERACTIVE PARAMTER HERE
+        except FDSNNoDataException:
+            return NO_DATA
         except Exception:
-            return "No data available for request."
+            return REQUEST_FAILED
         else:
-            # resample mode
-            try:
-                resample_rate = float(self.custom_waveform['sample_rate'])
-            except Exception:
-                pass
-            else:
-                st.resample(resample_rate)
-            # filter option
-            if self.custom_waveform['filter_type'] == '1':
-                st.filter('lowpass',freq = self.custom_waveform['filter_freqmin'], corners=2, zerophase = True)
-            if self.custom_waveform['filter_type'] == '2':
-                st.filter('highpass',freq = self.custom_waveform['filter_freqmax'], zerophase = True)
-            if self.custom_waveform['filter_type'] == '3':
-                st.filter('bandpass', freqmin = self.custom_waveform['filter_freqmin'], freqmax = self.custom_waveform['filter_freqmax'])
-            # add noise
-            # self.custom_waveform['add_noise'] = 1.0
-            if self.custom_waveform['add_noise'] != 0 :
-                # add noise to trace
-                for tr in st:
-                    length = len(tr.data)
-                    amplitude = max(tr.data)
-                    noise_arr = amplitude*self.custom_waveform['add_noise']*(-1+2*np.random.rand(length))
-                    tr.data = noise_arr + tr.data
-            st = self.check_export_stream(st)
-            if len(st) == 0:
-                return "No data available for request."
+            self.waveform_cache.put(window, st)
+            return self.process_waveform(st)
+
+    def process_waveform(self, st):
+        r"""Resample, filter, add noise, check and detrend a downloaded stream.
+        Parameters
+        ----------
+        st : Obspy Stream Object
+            Downloaded waveform of one thread.
+        Returns
+        -------
+        st : Obspy Stream Object
+            Processed waveform.
+        `No data available for request.` : str
+            No valid trace left.
+        """
+        st = transform_stream(st, self.custom_waveform, self.custom_dataset)
+        return self.accept_waveform(st)
+
+    def accept_waveform(self, st):
+        if len(st) == 0:
+            return NO_DATA
+        else:
+            #valid waveform as a new sample
+            self.starttime = st[0].stats.starttime
+            self.npts = st[0].stats.npts
+            self.sampling_rate = st[0].stats.sampling_rate
+            return st
+
+    def iter_waveforms(self, records, clientname="IRIS", bulk_size=50,
+                       max_workers=None, shift=0, processes=None,
+                       segments=False, pad=0):
+        r"""Download and process the waveforms of `records`.
+        Windows are planned for `bulk_size` threads at a time and requested
+        in one bulk dataselect call per batch, sorted by station and time,
+        then split back into one stream per thread. Up to `max_workers`
+        batches are downloaded concurrently, the streams of the downloaded
+        batches are transformed by a pool of `processes` worker processes
+        and the caller exports the previous batch meanwhile. Streams are
+        still yielded in the order of `records` (of stations and time with
+        `segments`) and no new batch is requested once the caller stops
+        iterating.
+        Parameters
+        ----------
+        records : ArrivalTable
+            Threads to download.
+        clientname : str, optional
+            Name of data center. The default is "IRIS".
+        bulk_size : int, optional
+            Number of windows per bulk request. The default is 50.
+        max_workers : int, optional
+            Number of bulk requests in flight. The default follows the
+            adaptive limit of the data center(s) (see `RateController`).
+        shift : float, optional
+            Time shift of every window in seconds (e.g. -3600 for noise).
+        processes : int, optional
+            Number of worker processes for the transforms, 0 to run them in
+            this process. The default is the number of cores.
+        segments : bool, optional
+            Request the nearby windows of a station as one continuous
+            segment and slice the samples out of it (see `fetch_segments`).
+            The default is False.
+        pad : float, optional
+            Seconds before each window to include in its segment, so that
+            the noise windows are read from the waveform cache later.
+        Yields
+        ------
+        (thread, st) : (ArrivalRow, Obspy Stream Object or str)
+            Processed stream, `NO_DATA` or `REQUEST_FAILED` (request failed
+            after its retries, worth another run).
+        """
+        client = get_client(clientname)
+        batches = self._plan_batches(records, bulk_size, shift, segments)
+        if segments:
+            fetch = partial(fetch_segments, pad=pad)
+        else:
+            fetch = fetch_bulk
+        processor = StreamProcessor(self.custom_waveform, self.custom_dataset,
+                                    processes)
+        # bounded queues between the download, transform and export stages
+        fetching = deque()
+        processing = deque()
+        if max_workers is None:
+            pool = ThreadPoolExecutor(max_workers=rate_controller.maximum)
+        else:
+            pool = ThreadPoolExecutor(max_workers=max(1, int(max_workers)))
+        try:
+            for batch in batches:
+                fetching.append((batch, pool.submit(fetch, client, batch[1],
+                                                    self.waveform_cache)))
+                if len(fetching) < (max_workers or concurrency(client)):
+                    continue
+                processing.append(self._transform_batch(processor,
+                                                        *fetching.popleft()))
+                if len(processing) < 2:
+                    continue
+                for item in self._export_batch(*processing.popleft()):
+                    yield item
+            while fetching:
+                processing.append(self._transform_batch(processor,
+                                                        *fetching.popleft()))
+            while processing:
+                for item in self._export_batch(*processing.popleft()):
+                    yield item
+        finally:
+            # volume reached: drop the work which did not start yet
+            for batch, future in fetching:
+                future.cancel()
+            for batch, (results, future) in processing:
+                future.cancel()
+            pool.shutdown(wait=False)
+            processor.shutdown()
+
+    def _plan_batches(self, records, bulk_size, shift=0, segments=False):
+        # (threads, windows, eventtimes) of every `bulk_size` threads
+        planned = self._plan_windows(records, shift)
+        if segments:
+            # windows of a station together (and never split over batches)
+            # so that they share their segments
+            planned = sorted(planned, key=lambda plan: (plan[1][1], plan[1][4]))
+        threads, windows, eventtimes = [], [], []
+        for thread, window, eventtime in planned:
+            if len(threads) >= bulk_size and \
+                    not (segments and windows[-1][1][1] == window[1]):
+                yield threads, windows, eventtimes
+                threads, windows, eventtimes = [], [], []
+            windows.append((len(threads), window))
+            threads.append(thread)
+            eventtimes.append(eventtime)
+        if threads:
+            yield threads, windows, eventtimes
+
+    def _plan_windows(self, records, shift=0):
+        # (thread, window, eventtime) of the threads with available data
+        for thread in records:
+            (start_time, end_time) = self.waveform_timewindow(thread)
+            if self.availability is not None and \
+                    not self.availability.available(thread['STA'],
+                                                    start_time + shift,
+                                                    end_time + shift):
+                # no channel or no data for this window: do not request it
+                self.availability.skipped += 1
+                continue
+            (network, station, location, channel) = \
+                self.related_station_info(thread['STA'], thread)
+            yield thread, (network, station, location, channel,
+                           start_time + shift, end_time + shift + 10), \
+                self.eventtime
+
+    def _transform_batch(self, processor, batch, future):
+        # submit the downloaded streams of a batch to the worker processes,
+        # together so that they are filtered in a few vectorized calls
+        streams = future.result()
+        results, valid = [], []
+        for key in range(len(batch[0])):
+            st = streams.get(key)
+            if st is None:
+                results.append(REQUEST_FAILED)
+            elif len(st) == 0:
+                results.append(NO_DATA)
             else:
-                #valid waveform as a new sample
-                self.starttime = st[0].stats.starttime
-                self.npts = st[0].stats.npts
-                self.sampling_rate = st[0].stats.sampling_rate
-                return st
+                # position of the stream in the processed batch
+                results.append(len(valid))
+                valid.append(st)
+        return batch, (results, processor.submit_batch(valid))
+
+    def _export_batch(self, batch, futures):
+        threads, windows, eventtimes = batch
+        results, future = futures
+        processed = future.result()
+        for key, thread in enumerate(threads):
+            if isinstance(results[key], str):
+                yield thread, results[key]
+                continue
+            # labels of this thread, not of the last planned window
+            self.eventtime = eventtimes[key]
+            yield thread, self.accept_waveform(processed[results[key]])
+
+    def paired_phase(self, thread):
+        r'''Pair an arrival with the other phase of its event at its station.
+        The S of a P (or the P of an S) is found in the phase index in
+        constant time, without scanning the recordings.
+        Returns
+        -------
+        (phase, point) : (str, float)
+            Phase name and sample point of the paired arrival in the current
+            sample, ('', nan) if not recorded or outside of the sample.
+        '''
+        if self.phase_index is None:
+            return ('', np.nan)
+        if 'S' in thread['ISCPHASE']:
+            pair = self.phase_index.find(thread, lambda name: 'S' not in name)
+        else:
+            pair = self.phase_index.find(thread, lambda name: 'S' in name)
+        if pair is None:
+            return ('', np.nan)
+        point = (arrival_epoch(pair) - self.starttime.timestamp) \
+            * self.sampling_rate
+        if not 0 <= point < self.npts:
+            return ('', np.nan)
+        return (pair['ISCPHASE'], point)
 
     def creatsamplename(self, stream):
         r'''Creat filename for each sample
@@ -485,6 +730,9 @@ class QuakeLabeler():
             data = np.array(st)
             data = data.T
             HDFr = h5py.File(self.output_merge, 'a')
+            if "data/"+filename in HDFr:
+                # partial sample of an interrupted run
+                del HDFr["data/"+filename]
             dsF = HDFr.create_dataset("data/"+filename, data.shape, data=data, dtype=np.float64)   
             dsF.attrs['network_code'] = st[0].stats.network
             dsF.attrs['receiver_code'] = st[0].stats.station
@@ -573,9 +821,12 @@ class QuakeLabeler():
     def openhdf5(self):
         self.output_merge = 'merge.hdf5'
         HDF0 = h5py.File(self.output_merge, 'a')
-        HDF0.create_group("data")
+        # the group exists when a run is resumed
+        HDF0.require_group("data")
         return HDF0            
-    def fetch_all_waveforms(self, records, clientname="IRIS"):
+    def fetch_all_waveforms(self, records, clientname="IRIS", bulk_size=50,
+                            max_workers=None, processes=None, segments=False,
+                            resume=False, extend=False):
         r"""Auto fetch seismograms to produce samples
         This module manage all potential waveforms as threads. Retrive waveform
         from specific data centers, revise trace by customized parameters and
@@ -591,10 +842,36 @@ class QuakeLabeler():
 
         Parameters
         ----------
-        records : list
+        records : ArrivalTable
             `records` saves all potential downloadable waveform.
-        clientname : str, optional
-            The default is "IRIS". Specific data center's name.
+        clientname : str or tuple, optional
+            The default is "IRIS". Specific data center's name, or names of
+            the data centers to route the requests to (e.g. `DATA_CENTERS`).
+        bulk_size : int, optional
+            Number of waveforms per bulk dataselect request. The default is 50.
+        max_workers : int, optional
+            Number of bulk requests downloaded while the samples are
+            processed. The default adapts to the data center(s).
+        processes : int, optional
+            Number of worker processes which resample, filter and detrend
+            the samples. The default is the number of cores.
+        segments : bool, optional
+            Request a few continuous segments per station and slice every
+            sample (and, through the waveform cache, the noise samples of
+            `noisegenerator`) out of them. The default is False.
+        resume : bool, optional
+            Continue a stopped run in the same dataset folder: the records
+            completed in its journal are kept, the others (and the ones which
+            failed with a transient error) are requested again. The default
+            is False.
+        extend : bool, optional
+            Grow the existing dataset of `export_filename` (e.g. a larger
+            volume or new records): the (event, station, phase) keys already
+            exported are skipped, and only the new samples are exported and
+            appended to merge.hdf5 and the features CSV. Datasets without a
+            journal are read from their features CSV. Datasets already split
+            by `subfolder` cannot be extended (ValueError). The default is
+            False.
 
         Returns
         -------
@@ -604,16 +881,28 @@ class QuakeLabeler():
         print('Initialize samples producer module...')
         # selet user preference
 
-        # count loop number, when loop>100 & no available waveform found, break the loop
-        loopnum = 0
         if self.custom_export['export_filename'] == '':
             # if user doesn;t have a preffered folder name:
             today = UTCDateTime()
             FileName = 'MyDataset' + str(today)[:-11]  #filename option —— custom class UPDATE
         else:
             FileName = self.custom_export['export_filename']
+        if (resume or extend) and any(
+                os.path.isdir(os.path.join(FileName, subset))
+                for subset in SUBSETS):
+            # its samples and merge.hdf5 were moved by `subfolder`
+            raise ValueError("Dataset {0} is split into {1} sub-sets and "
+                             "cannot be extended or resumed. Extend it "
+                             "before splitting it, or export a new "
+                             "dataset.".format(FileName, '/'.join(SUBSETS)))
         # num: stream(samples) volume
         num = 0
+        if not isinstance(records, ArrivalTable):
+            records = ArrivalTable.from_records(records).with_epochs()
+        # repeated arrivals would give the same sample
+        records = records.drop_duplicates('EVENTID', 'STA', 'ISCPHASE')
+        self.phase_index = PhaseIndex(records)
+        self.clientname = clientname
         # amount of the samples
         if not self.custom_dataset['volume'] == 'MAX':
             maxnum = int(self.custom_dataset['volume'])
@@ -626,6 +915,25 @@ class QuakeLabeler():
         if not os.path.exists(FileName):
             os.mkdir(FileName)
         os.chdir(FileName)
+        # checkpoint journal of the records, in the dataset folder
+        self.journal = SampleJournal('journal.jsonl', resume or extend)
+        self.exported_samples = 0
+        features = os.path.join(os.pardir, FileName + '_features.csv')
+        if extend and not self.journal.records:
+            self.import_features(features)
+        if resume or extend:
+            self.available_samples = self.journal.samples()
+            num = len([sample for sample in self.available_samples
+                       if sample['ISCPHASE'] != 'Noi'])
+            if _csv_rows(features) == len(self.available_samples):
+                # the CSV is up to date: only the new samples are appended
+                self.exported_samples = len(self.available_samples)
+            records = records.filter(np.array(
+                [self._pending(thread) for thread in records], dtype=bool))
+            print("{0} samples done, {1} records left.".format(num, len(records)))
+        # sample rates and availability of every station, before planning
+        # the windows
+        self.plan_windows(clientname, records.unique('STA'))
         self.hdf = False
         
         if 'hdf5' in self.custom_export['export_type'].lower():
@@ -634,28 +942,98 @@ class QuakeLabeler():
             self.hdf = True           
         #set progress bar
         bar = Bar('Processing', max=maxnum)
-        for thread in records:
-            # request waveform from online clients
-            try:
-                st = self.fetch_waveform(thread, clientname )
-            except KeyboardInterrupt:
-                print(thread)
-            if st == "No data available for request.":
+        try:
+            self._produce_samples(records, clientname, bulk_size, max_workers,
+                                  processes, segments, bar, num, maxnum)
+        except BaseException:
+            # interrupted: keep the outputs consistent with the journal
+            bar.finish()
+            self.journal.close()
+            self._close_cache()
+            os.chdir('../')
+            self.FolderName = FileName
+            if self.available_samples:
+                self.csv_writer()
+            raise
+        self.journal.close()
+        self._close_cache()
+        num = len([sample for sample in self.available_samples
+                   if sample['ISCPHASE'] != 'Noi'])
+        bar.finish()
+        print("All available waveforms are ready!")
+        print("{0} of event-based samples are successfully generated! ".format(num))
+        if self.availability.skipped:
+            print("{0} windows without available data were not requested.".format(self.availability.skipped))
+        os.chdir('../')
+        # save dataset foldername
+        self.FolderName = FileName
+
+    def _close_cache(self):
+        # index of the raw windows downloaded in this run (see
+        # `WaveformCache.close`)
+        cache = getattr(self, 'waveform_cache', None)
+        if cache is not None:
+            cache.close()
+
+    def _pending(self, thread):
+        # record not exported yet (under its phase or, without label_type,
+        # under its P/S label as in older features CSVs)
+        if not self.journal.pending(record_key(thread)):
+            return False
+        if not self.custom_waveform['label_type']:
+            return self.journal.pending(label_key(thread))
+        return True
+
+    def import_features(self, path):
+        r"""Record the samples of a dataset without journal, read from its
+        features CSV, in the journal.
+        """
+        try:
+            frame = pd.read_csv(path)
+        except (IOError, ValueError):
+            return
+        frame = frame.astype(object).where(pd.notnull(frame), None)
+        groups = {}
+        for sample in frame.to_dict('records'):
+            if sample.get('ISCPHASE') == 'Noi':
+                key = noise_key(sample)
+            else:
+                key = record_key(sample)
+            groups.setdefault(key, []).append(sample)
+        for key, samples in groups.items():
+            self.journal.done(key, samples)
+        print("{0} samples read from {1}.".format(len(frame), path))
+
+    def _produce_samples(self, records, clientname, bulk_size, max_workers,
+                         processes, segments, bar, num, maxnum):
+        # export the samples of `records` until `maxnum` samples, journaling
+        # every record (see `fetch_all_waveforms`)
+        # count loop number, when loop>100 & no available waveform found, break the loop
+        loopnum = 0
+        # request waveforms from online clients, in bulk
+        # segments also cover the noise windows, one hour before the events
+        pad = 60*60 + 300 if self.custom_export.get('noise_trace') else 0
+        for thread, st in self.iter_waveforms(records, clientname, bulk_size,
+                                              max_workers,
+                                              processes=processes,
+                                              segments=segments, pad=pad):
+            key = record_key(thread)
+            if isinstance(st, str):
+                self.journal.failed(key, transient=(st == REQUEST_FAILED))
                 loopnum = loopnum+1
                 if loopnum>50:
                     warnings.warn('50+ continuous failed data requests, please quit process and check your parameters.')
             else:
                 # find available waveform
                 loopnum = 0
+                self.journal.attempted(key)
+                first = len(self.available_samples)
                 if self.custom_export['single_trace'] == True:
                     num = num+ len(st)
                     # split each stream as independent trace component
                     for tr in st:
                         updatethread = thread.copy()
                         bar.next()
-                        # detrend (optional)
-                        if self.custom_waveform['detrend']:
-                            tr.detrend()
                         singlesample = st.select(channel=tr.stats.channel)
                         single_filename = self.creatsamplename(singlesample)
                         self.single_sample_export(singlesample, single_filename)
@@ -664,6 +1042,9 @@ class QuakeLabeler():
                         updatethread['arr_point'] = self.arr_point
                         updatethread['npts'] = self.npts
                         updatethread['sampling_rate'] = self.sampling_rate
+                        (updatethread['pair_phase'],
+                         updatethread['pair_arr_point']) = \
+                            self.paired_phase(thread)
                         if not self.custom_waveform['label_type']:
                             if 'S' in updatethread['ISCPHASE']:
                                 updatethread['ISCPHASE'] = 'S'
@@ -674,10 +1055,6 @@ class QuakeLabeler():
                     num += 1
                     updatethread = thread.copy()
                     bar.next()
-                    # detrend (optional)
-                    if self.custom_waveform['detrend']:
-                        for tr in st:
-                            tr.detrend()
                     multi_filename = self.creatsamplename(st)
                     self.multi_sample_export(st, multi_filename)
                     #add record to csv file
@@ -685,72 +1062,50 @@ class QuakeLabeler():
                     updatethread['arr_point'] = self.arr_point
                     updatethread['npts'] = self.npts
                     updatethread['sampling_rate'] = self.sampling_rate
+                    (updatethread['pair_phase'],
+                     updatethread['pair_arr_point']) = self.paired_phase(thread)
                     if not self.custom_waveform['label_type']:
                         if 'S' in thread['ISCPHASE']:
                             updatethread['ISCPHASE'] = 'S'
                         else:
                             updatethread['ISCPHASE'] = 'P'
                     self.available_samples.append(updatethread)
-                print("Save to target folder: {0}".format(FileName))
+                self.journal.done(key, self.available_samples[first:])
+                print("Save to target folder: {0}".format(self.custom_export['folder_name']))
                 print(st)
                 if num >= maxnum and not self.custom_dataset['volume'] == 'MAX':
                     break
-        bar.finish()
-        print("All available waveforms are ready!")
-        print("{0} of event-based samples are successfully generated! ".format(num))
-        os.chdir('../')
-        # save dataset foldername
-        self.FolderName = FileName
-    def fetch_noise_waveform(self,thread):
-        client = Client("IRIS")
+
+    def fetch_noise_waveform(self, thread, clientname="IRIS"):
+        client = get_client(clientname)
         # calculate startime and endtime, must consider trace length, sampling rate to satisfy custom parameters
 
         (start_time, end_time) = self.waveform_timewindow(thread)
         # find noise waveform
         start_time = start_time - 60*60
         end_time = end_time - 60*60
-        (network, station, location, channel) = self.related_station_info(thread['STA'])
+        (network, station, location, channel) = self.related_station_info(thread['STA'], thread)
+        window = (network, station, location, channel, start_time, end_time+10)
+        st = self.waveform_cache.get(window)
+        if st is not None:
+            return self.process_waveform(st)
         try:
-            st = client.get_waveforms(network, station, location, channel, start_time, end_time+10)
+            st = client.get_waveforms(*window)
             # param attach_response  NEED UPDATE ONE INTERACTIVE PARAMTER HERE
+        except FDSNNoDataException:
+            return NO_DATA
         except Exception:
-            return "No data available for request."
+            return REQUEST_FAILED
         else:
-            # resample mode
-            try:
-                resample_rate = float(self.custom_waveform['sample_rate'])
-            except Exception:
-                pass
-            else:
-                st.resample(resample_rate)
-            # filter option
-            if self.custom_waveform['filter_type'] == '1':
-                st.filter('lowpass',freq = self.custom_waveform['filter_freqmin'], corners=2, zerophase = True)
-            if self.custom_waveform['filter_type'] == '2':
-                st.filter('highpass',freq = self.custom_waveform['filter_freqmax'], zerophase = True)
-            if self.custom_waveform['filter_type'] == '3':
-                st.filter('bandpass', freqmin = self.custom_waveform['filter_freqmin'], freqmax = self.custom_waveform['filter_freqmax'])
-            # add noise
-            # self.custom_waveform['add_noise'] = 1.0
-            if self.custom_waveform['add_noise'] != 0 :
-                # add noise to trace
-                for tr in st:
-                    length = len(tr.data)
-                    amplitude = max(tr.data)
-                    noise_arr = amplitude*self.custom_waveform['add_noise']*(-1+2*np.random.rand(length))
-                    tr.data = noise_arr + tr.data
-            st = self.check_export_stream(st)
-            if len(st) == 0:
-                return "No data available for request."
-            else:
-                #valid waveform as a new sample
-                self.starttime = st[0].stats.starttime
-                self.npts = st[0].stats.npts
-                self.sampling_rate = st[0].stats.sampling_rate
-                return st
+            self.waveform_cache.put(window, st)
+            return self.process_waveform(st)
 
-    def noisegenerator(self):
+    def noisegenerator(self, bulk_size=50, max_workers=None, processes=None,
+                       clientname=None):
         r"""Generate noise waveform in same amount
+        Noise windows are taken one hour before the event samples and
+        downloaded concurrently as in `fetch_all_waveforms`, from the data
+        center(s) of the event samples unless `clientname` is given.
         Returns
         -------
         None.
@@ -761,16 +1116,45 @@ class QuakeLabeler():
         os.chdir(orgin_path)
         print('Initialize noise waveform producer module...')
         self.noise = []
-        maxmum = len(self.available_samples)
+        # event samples without noise yet (in the journal of the dataset)
+        self.journal = SampleJournal('journal.jsonl', resume=True)
+        samples, queued = [], set()
+        for sample in self.available_samples:
+            key = noise_key(sample)
+            if sample['ISCPHASE'] != 'Noi' and key not in queued and \
+                    self.journal.pending(key):
+                queued.add(key)
+                samples.append(sample)
+        maxmum = len(samples)
         bar = Bar('Processing', num= maxmum)
         num = 0
-        for thread in self.available_samples:
-            # request waveform from online clients
-            st = self.fetch_noise_waveform(thread)
-            if st == "No data available for request.":
-                pass
+        # request waveforms from online clients, one hour before the events
+        if clientname is None:
+            clientname = getattr(self, 'clientname', "IRIS")
+        try:
+            num = self._produce_noise(samples, clientname, bulk_size,
+                                      max_workers, processes, bar, num, maxmum)
+        finally:
+            self.journal.close()
+            self._close_cache()
+        bar.finish()
+        print("All available waveforms are ready!")
+        print("{0} of event-based samples are successfully generated! ".format(num))
+        os.chdir('../')
+
+    def _produce_noise(self, samples, clientname, bulk_size, max_workers,
+                       processes, bar, num, maxmum):
+        # export the noise samples of the event `samples`, journaling them
+        FileName = self.custom_export['folder_name']
+        for thread, st in self.iter_waveforms(samples, clientname, bulk_size,
+                                              max_workers, shift=-60*60,
+                                              processes=processes):
+            key = noise_key(thread)
+            if isinstance(st, str):
+                self.journal.failed(key, transient=(st == REQUEST_FAILED))
             else:
                 # find available waveform
+                first = len(self.available_samples)
                 if self.custom_export['single_trace'] == True:
                     num +=1
                     # split each stream as independent trace component
@@ -780,8 +1164,6 @@ class QuakeLabeler():
                         # write phase type as noise
                         updatethread['ISCPHASE'] = 'Noi'
                         updatethread['REPPHASE'] = 'Noi'
-                        if self.custom_waveform['detrend']:
-                            tr.detrend()
                         singlesample = st.select(channel=tr.stats.channel)
                         single_filename = self.creatsamplename(singlesample) + "_Noise"
                         self.single_sample_export(singlesample, single_filename)
@@ -790,6 +1172,8 @@ class QuakeLabeler():
                         updatethread['arr_point'] = self.arr_point
                         updatethread['npts'] = self.npts
                         updatethread['sampling_rate'] = self.sampling_rate
+                        updatethread['pair_phase'] = ''
+                        updatethread['pair_arr_point'] = np.nan
                         self.available_samples.append(updatethread)
                         self.noise.append(updatethread)
                 else:
@@ -798,10 +1182,6 @@ class QuakeLabeler():
                     # write phase type as noise
                     updatethread['ISCPHASE'] = 'Noi'
                     updatethread['REPPHASE'] = 'Noi'
-                    # detrend (optional)
-                    if self.custom_waveform['detrend']:
-                        for tr in st:
-                            tr.detrend()
                     multi_filename = self.creatsamplename(st) +"_Noise"
                     self.multi_sample_export(st, multi_filename)
                     #add record to csv file
@@ -809,17 +1189,18 @@ class QuakeLabeler():
                     updatethread['arr_point'] = self.arr_point
                     updatethread['npts'] = self.npts
                     updatethread['sampling_rate'] = self.sampling_rate
+                    updatethread['pair_phase'] = ''
+                    updatethread['pair_arr_point'] = np.nan
                     self.available_samples.append(updatethread)
                     self.noise.append(updatethread)
+                self.journal.done(key, self.available_samples[first:])
                 print("Save to target folder: {0}".format(FileName))
                 print(st)
                 if num>=maxmum:
                     break
                 bar.next()
-        bar.finish()
-        print("All available waveforms are ready!")
-        print("{0} of event-based samples are successfully generated! ".format(num))
-        os.chdir('../')
+        return num
+
     def subfolder(self, trainratio=0.6,testratio=0.2):
         r"""Split dataset
         Divide dataset as a training dataset(80%) and a validation dataset(20%)
@@ -832,7 +1213,8 @@ class QuakeLabeler():
         if not os.path.exists('Training'):
             os.mkdir('Training')
         moved_path = "Training"
-        dir_files = os.listdir()
+        # samples only: the journal of the records stays in the dataset
+        dir_files = [file for file in os.listdir() if file != 'journal.jsonl']
         filessum = len(dir_files)
         trainnum = int(filessum * trainratio)
         testnum = int(filessum * (trainratio+testratio))
@@ -859,10 +1241,25 @@ class QuakeLabeler():
     def csv_writer(self):
         r""" Method to export information of the dataset.
         """
+        # samples already written by an earlier run (extended datasets)
+        exported = getattr(self, 'exported_samples', 0)
+        new_samples = self.available_samples[exported:]
+        if self.store is not None:
+            self.store.add_samples(self.FolderName, new_samples)
+        self.exported_samples = len(self.available_samples)
         if not self.custom_export['export_arrival_csv']:
             return
         print('Save waveform information into CSV file...')
         CSV_Name = self.FolderName+'_features' + '.csv'
+        if exported and os.path.exists(CSV_Name):
+            # append the new samples under the existing header
+            with open(CSV_Name) as csvfile:
+                field_names = next(csv.reader(csvfile))
+            with open(CSV_Name, 'a') as csvfile:
+                writer = csv.DictWriter(csvfile, fieldnames=field_names,
+                                        extrasaction='ignore')
+                writer.writerows(new_samples)
+            return
         dict1 = self.available_samples[0]
         field_names = []
         for k, v in dict1.items():
@@ -2126,6 +2523,10 @@ in QuakeLabeler with different scales (small, medium, large).
 class QueryArrival():
     r"""Auto request online arrivals catalog
     This class fetch users's target arrivals from ISC Bulletin website.
+    With a `catalog` name, the arrivals are kept in a stored catalog and only
+    the time range not stored yet is requested (see `ArrivalCatalog`). With
+    a `source` catalog name, the query is answered locally from that stored
+    catalog.
 
     References
     ----------
@@ -2143,27 +2544,35 @@ class QueryArrival():
         # save params
         for k in kwargs:
             self.param[k] = kwargs[k]  
-        print("Loading time varies on your network connections, search region scale, time range, etc. Please be patient, estimated time: 3 mins ")
-        self.response = requests.get(url = URL, params=self.param)
-        self.response = requests.get(url = self.response.url)
-        self.page_text = self.response.text
-
-        if "No phase data was found." in self.page_text:
-            print("Error: No phase data was found. \n")
-            exit("Please change your parameters and restart of the tool ... \n")
-
+        # name of a stored catalog to refresh with the missing time range
+        catalog = self.param.pop('catalog', None)
+        # name of a stored catalog to select from instead of querying ISC
+        source = self.param.pop('source', None)
+        print("Loading time varies on your network connections, search region scale, time range, etc. Please be patient ...")
         try:
-            self.find_all_vars(self.page_text, 'EVENTID', 'STA','CHN',
-                               'ISCPHASE','REPPHASE',
-                               'ARRIVAL_LAT', 'ARRIVAL_LON',
-                               'ARRIVAL_ELEV','ARRIVAL_DIST','ARRIVAL_BAZ',
-                               'ARRIVAL_DATE','ARRIVAL_TIME',
-                               'ORIGIN_LAT' ,'ORIGIN_LON','ORIGINL_DEPTH',
-                               'ORIGIN_DATE' ,'ORIGIN_TIME',
-                               'EVENT_TYPE','EVENT_MAG')
-        except IndexError:
+            if source:
+                self.arrival_recordings = ArrivalCatalog(source).select(
+                    self.param)
+                self.no_data = len(self.arrival_recordings) == 0
+            elif catalog:
+                self.catalog = ArrivalCatalog(catalog)
+                self.arrival_recordings = self.catalog.refresh(
+                    URL, self.param, cache=QueryCache())
+                print("%d new arrivals fetched." % self.catalog.fetched)
+                self.no_data = len(self.arrival_recordings) == 0
+            else:
+                # time/space tiles are streamed concurrently and merged
+                self.planner = QueryPlanner(URL, self.param, ARRIVAL_FIELDS,
+                                            cache=QueryCache())
+                self.arrival_recordings = self.planner.run().with_epochs()
+                self.no_data = self.planner.no_data
+        except (IndexError, requests.exceptions.RequestException):
+            # no arrivals block, or ISC timed out / failed after the retries
             print('Please try it later. Request failed.')
         else:
+            if self.no_data:
+                print("Error: No phase data was found. \n")
+                exit("Please change your parameters and restart of the tool ... \n")
             print('Request completed！！！')
             print("%d events have been found!" % len(self.arrival_recordings))
             self.endtime = time.time()
@@ -2177,9 +2586,9 @@ class QueryArrival():
             self.saverecord("recordings"+str(int(runtime)))
 
     def saverecord(self, name):
-        np.save(name + ".npy", self.arrival_recordings)
+        self.arrival_recordings.save(name + ".npz")
         #save as pandas.DataFrame
-        data = pd.DataFrame(data=self.arrival_recordings)
+        data = self.arrival_recordings.to_dataframe()
         if not os.path.exists(name):
             os.mkdir(name)
         os.chdir(name)
@@ -2187,6 +2596,10 @@ class QueryArrival():
         self.record_folder = os.getcwd()+'/'
         self.record_filename = name+".csv"
         os.chdir('../')
+        # shared catalog database, indexed for later runs and maps
+        self.record_name = name
+        self.store = CatalogStore()
+        self.store.add_arrivals(self.arrival_recordings, name, self.param)
     def find_all_vars(self, text, *args):
         r"""Store all arrival information
         This method save all fetched information into `recordings`:
@@ -2200,65 +2613,15 @@ class QueryArrival():
             #. EVENT TYPE
             #. EVENT MAG
         """
-        ex = r'MAG (.*) '
-        all_variables = re.findall(ex, text, re.S)
-        all_vars = re.split(r',', all_variables[0])
-        #find last index
-        for index in range(len(all_vars) - 1, 0, -1):
-            if 'Agencies whose data' in all_vars[index]:
-                break
-        # initialization of recording, include all webset information
-        recordings = {
-        'EVENTID' : [] ,
-        'STA' : [],
-        'CHN' : [],
-        'ISCPHASE' : [],
-        'REPPHASE' : [],
-        'ARRIVAL_LAT' : [],
-        'ARRIVAL_LON' : [],
-        'ARRIVAL_ELEV' : [],
-        'ARRIVAL_DIST' : [],
-        'ARRIVAL_BAZ' : [],
-        'ARRIVAL_DATE' : [],
-        'ARRIVAL_TIME' : [],
-        'ORIGIN_LAT' : [],
-        'ORIGIN_LON' : [],
-        'ORIGINL_DEPTH' : [],
-        'ORIGIN_DATE' : [],
-        'ORIGIN_TIME' : [],
-        'EVENT_TYPE' :[],
-        'EVENT_MAG' : [] }
-
-        for i in range(0, index, 26):
-            recordings['EVENTID'].append(int(re.split('\n',all_vars[i])[1]))
-            recordings['STA'].append(str.strip(all_vars[i+3]))
-            recordings['CHN'].append(str.strip(all_vars[i+7]))
-            recordings['ISCPHASE'].append(str.strip(all_vars[i+10]))
-            recordings['REPPHASE'].append(str.strip(all_vars[i+11]))
-            recordings['ARRIVAL_LAT'].append(float(all_vars[i+4]))
-            recordings['ARRIVAL_LON'].append(float(all_vars[i+5]))
-            recordings['ARRIVAL_ELEV'].append(float(all_vars[i+6]))
-            recordings['ARRIVAL_DIST'].append(float(all_vars[i+8]))
-            recordings['ARRIVAL_BAZ'].append(float(all_vars[i+9]))
-            recordings['ARRIVAL_DATE'].append(str.strip(all_vars[i+12]))
-            recordings['ARRIVAL_TIME'].append(str.strip(all_vars[i+13]))
-            recordings['ORIGIN_LAT'].append(float(all_vars[i+21]))
-            recordings['ORIGIN_LON'].append(float(all_vars[i+22]))
-            recordings['ORIGINL_DEPTH'].append(float(all_vars[i+23]) if not all_vars[i+23].isspace() else float("NaN"))
-            recordings['ORIGIN_DATE'].append(str.strip(all_vars[i+19]))
-            recordings['ORIGIN_TIME'].append(str.strip(all_vars[i+20]))
-            recordings['EVENT_TYPE'].append(str.strip(all_vars[i+25]))
-            if str.isspace(re.split('\n', all_vars[i+26])[0]):
-                recordings['EVENT_MAG'].append(float('NaN'))
-            else:
-                recordings['EVENT_MAG'].append(float(re.split('\n', all_vars[i+26])[0]))
-
-        self.arrival_recordings = []
-        for i in range(len(recordings['EVENTID'])):
-            tempdict = {}
-            for var in args:
-                tempdict[var] = recordings[var][i]
-            self.arrival_recordings.append(tempdict)
+        # text can be the whole page or an iterable of lines (streamed)
+        if isinstance(text, str):
+            text = text.splitlines()
+        parser = ArrivalParser(args or ARRIVAL_FIELDS)
+        self.arrival_recordings = ArrivalTable.from_records(
+            parser.parse(text), parser.fields).with_epochs()
+        self.no_data = parser.no_data
+        if parser.columns is None and not parser.no_data:
+            raise IndexError('No arrivals block found in the ISC response.')
         return self.arrival_recordings
 
 
@@ -2270,27 +2633,20 @@ class BuiltInCatalog():
         # ISC Bulletin url
         URL = 'http://www.isc.ac.uk/cgi-bin/web-db-v4'
         self.starttime = time.time()
-        print("Loading time varies on your network connections, search region scale, time range, etc. Please be patient, estimated time: 3 mins ")
-        self.response = requests.get(url = URL, params=self.param)
-        self.page_text = self.response.text
-
-        if "No phase data was found." in self.page_text:
-            print("Error: No phase data was found. \n")
-            exit("Please change your parameters and restart of the tool ... \n")
-
+        print("Loading time varies on your network connections, search region scale, time range, etc. Please be patient ...")
         try:
-            # find all information
-            self.find_all_vars(self.page_text, 'EVENTID', 'STA','CHN',
-                               'ISCPHASE','REPPHASE',
-                               'ARRIVAL_LAT', 'ARRIVAL_LON',
-                               'ARRIVAL_ELEV','ARRIVAL_DIST','ARRIVAL_BAZ',
-                               'ARRIVAL_DATE','ARRIVAL_TIME',
-                               'ORIGIN_LAT' ,'ORIGIN_LON','ORIGINL_DEPTH',
-                               'ORIGIN_DATE' ,'ORIGIN_TIME',
-                               'EVENT_TYPE','EVENT_MAG')
-        except IndexError:
+            # find all information, time/space tiles are fetched concurrently
+            self.planner = QueryPlanner(URL, self.param, ARRIVAL_FIELDS,
+                                        cache=QueryCache())
+            self.arrival_recordings = self.planner.run().with_epochs()
+            self.no_data = self.planner.no_data
+        except (IndexError, requests.exceptions.RequestException):
+            # no arrivals block, or ISC timed out / failed after the retries
             print('Please try it later. Request failed.')
         else:
+            if self.no_data:
+                print("Error: No phase data was found. \n")
+                exit("Please change your parameters and restart of the tool ... \n")
             print('Request completed！！！')
             print("%d events have been found!" % len(self.arrival_recordings))
             self.endtime = time.time()
@@ -2306,9 +2662,9 @@ class BuiltInCatalog():
             self.retrievequery(self.benchmark_name)
 
     def saverecord(self, name):
-        np.save(name + ".npy", self.arrival_recordings)
+        self.arrival_recordings.save(name + ".npz")
         #save as pandas.DataFrame
-        data = pd.DataFrame(data=self.arrival_recordings)
+        data = self.arrival_recordings.to_dataframe()
         if not os.path.exists(name):
             os.mkdir(name)
         os.chdir(name)
@@ -2316,11 +2672,23 @@ class BuiltInCatalog():
         self.record_folder = os.getcwd()+'/'
         os.chdir('../')
         self.record_filename = name+".csv"
+        # shared catalog database, indexed for later runs and maps
+        self.record_name = name
+        self.store = CatalogStore()
+        self.store.add_arrivals(self.arrival_recordings, name, self.param)
         print('benchmark recordings have been saved!')
     def retrievequery(self, name):
-        self.arrival_recordings = {}
-        name = name+".npy"
-        self.arrival_recordings = np.load(name, allow_pickle='TRUE' )
+        if not hasattr(self, 'store'):
+            self.store = CatalogStore()
+        if os.path.exists(name + ".npz"):
+            self.arrival_recordings = ArrivalTable.load(
+                name + ".npz").with_epochs()
+        elif name in self.store:
+            self.arrival_recordings = self.store.arrivals(name=name)
+        else:
+            # recordings saved by former versions (pickled list of dicts)
+            self.arrival_recordings = ArrivalTable.from_records(
+                np.load(name + ".npy", allow_pickle=True)).with_epochs()
         print('benchmark recordings have been recovered!')
 
     def find_all_vars(self, text, *args):
@@ -2336,66 +2704,15 @@ class BuiltInCatalog():
             #. EVENT TYPE
             #. EVENT MAG
         """
-        ex = r'MAG (.*) '
-        all_variables = re.findall(ex, text, re.S)
-        all_vars = re.split(r',', all_variables[0])
-        #find last index
-        for index in range(len(all_vars) - 1, 0, -1):
-            if 'STOP' in all_vars[index]:
-                break
-        # initialization of recording, include all webset information
-        recordings = {
-        'EVENTID' : [] ,
-        'STA' : [],
-        'CHN' : [],
-        'ISCPHASE' : [],
-        'REPPHASE' : [],
-        'ARRIVAL_LAT' : [],
-        'ARRIVAL_LON' : [],
-        'ARRIVAL_ELEV' : [],
-        'ARRIVAL_DIST' : [],
-        'ARRIVAL_BAZ' : [],
-        'ARRIVAL_DATE' : [],
-        'ARRIVAL_TIME' : [],
-        'ORIGIN_LAT' : [],
-        'ORIGIN_LON' : [],
-        'ORIGINL_DEPTH' : [],
-        'ORIGIN_DATE' : [],
-        'ORIGIN_TIME' : [],
-        'EVENT_TYPE' :[],
-        'EVENT_MAG' : [] }
-
-        for i in range(0, index, 25):
-            recordings['EVENTID'].append(int(re.split('\n',all_vars[i])[1]))
-            recordings['STA'].append(str.strip(all_vars[i+2]))
-            recordings['CHN'].append(str.strip(all_vars[i+6]))
-            recordings['ISCPHASE'].append(str.strip(all_vars[i+9]))
-            recordings['REPPHASE'].append(str.strip(all_vars[i+10]))
-            recordings['ARRIVAL_LAT'].append(float(all_vars[i+3]))
-            recordings['ARRIVAL_LON'].append(float(all_vars[i+4]))
-            recordings['ARRIVAL_ELEV'].append(float(all_vars[i+5]))
-            recordings['ARRIVAL_DIST'].append(float(all_vars[i+7]))
-            recordings['ARRIVAL_BAZ'].append(float(all_vars[i+8]))
-            recordings['ARRIVAL_DATE'].append(str.strip(all_vars[i+11]))
-            recordings['ARRIVAL_TIME'].append(str.strip(all_vars[i+12]))
-            recordings['ORIGIN_LAT'].append(float(all_vars[i+20]))
-            recordings['ORIGIN_LON'].append(float(all_vars[i+21]))
-            recordings['ORIGINL_DEPTH'].append(float(all_vars[i+22]) if not all_vars[i+22].isspace() else float("NaN"))
-            recordings['ORIGIN_DATE'].append(str.strip(all_vars[i+18]))
-            recordings['ORIGIN_TIME'].append(str.strip(all_vars[i+19]))
-            recordings['EVENT_TYPE'].append(str.strip(all_vars[i+24]))
-            if str.isspace(re.split('\n', all_vars[i+25])[0]):
-                recordings['EVENT_MAG'].append(float('NaN'))
-            else:
-                recordings['EVENT_MAG'].append(float(re.split('\n', all_vars[i+25])[0]))
-        # save ful list
-        # save as csv file
-        self.arrival_recordings = []
-        for i in range(len(recordings['EVENTID'])):
-            tempdict = {}
-            for var in args:
-                tempdict[var] = recordings[var][i]
-            self.arrival_recordings.append(tempdict)
+        # text can be the whole page or an iterable of lines (streamed)
+        if isinstance(text, str):
+            text = text.splitlines()
+        parser = ArrivalParser(args or ARRIVAL_FIELDS)
+        self.arrival_recordings = ArrivalTable.from_records(
+            parser.parse(text), parser.fields).with_epochs()
+        self.no_data = parser.no_data
+        if parser.columns is None and not parser.no_data:
+            raise IndexError('No arrivals block found in the ISC response.')
 
         return self.arrival_recordings
 class MergeMetadata():
@@ -2405,12 +2722,15 @@ class MergeMetadata():
         merge arrivals
         merge stations
     '''
-    def __init__(self,folder):
+    def __init__(self,folder, store=None, name=None):
         # *.csv folder
         self.path = folder
         self.filelist = self.select_folder()
         self.station = pd.DataFrame()
         self.event = pd.DataFrame()
+        # catalog database and query name: indexed queries instead of CSVs
+        self.store = store
+        self.name = name
     # choose folder
     def select_folder(self):
         filelist = os.listdir(self.path)
@@ -2418,6 +2738,8 @@ class MergeMetadata():
     # merge each station's events
     def merge_station(self,filelist):
         #merge all station from a folder path(filelist)
+        if self.store is not None:
+            return self.store.frame(name=self.name, distinct='STA')
         sta_cat = self.load_metadata(filelist[0])
         for file in filelist[1:]:
             if file[-4:] != '.csv':
@@ -2435,6 +2757,8 @@ class MergeMetadata():
          return meta_pd
     def merge_event(self,filelist):
         # merge all event from a folder path(filelist)
+        if self.store is not None:
+            return self.store.frame(name=self.name, distinct='EVENTID')
         sta_cat = self.load_metadata(filelist[0])
         for file in filelist[1:]:
             if file[-4:] != '.csv':
@@ -0,0 +1,987 @@
+# -*- coding: utf-8 -*-
+# MIT License
+#
+# Copyright (c) 2021 Hao Mai & Pascal Audet
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""
+FDSN access
+Station metadata and waveform request planning for FDSN data centers.
+@author: Hao Mai & Pascal Audet
+"""
+from __future__ import (absolute_import, division, print_function)
+
+import io
+import os
+import json
+import logging
+import time
+import random
+import hashlib
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib.parse import parse_qs, urlparse
+from obspy import Stream
+from obspy.core.utcdatetime import UTCDateTime
+from obspy.clients.fdsn import Client
+from obspy.clients.fdsn.client import raise_on_error
+from obspy.clients.fdsn.header import (FDSNNoDataException,
+                                       FDSNTooManyRequestsException,
+                                       FDSNServiceUnavailableException,
+                                       FDSNBadGatewayException,
+                                       FDSNTimeoutException, URL_MAPPINGS)
+from .cache import default_cache_dir
+
+LOGGER = logging.getLogger(__name__)
+
+# shared clients of get_client: (name, options) -> PooledClient
+_clients = {}
+_clients_lock = threading.Lock()
+
+# data centers tried by a RoutedClient for stations without a known route
+DATA_CENTERS = ('IRIS', 'GFZ', 'ORFEUS', 'RESIF', 'INGV', 'ETH', 'NCEDC',
+                'SCEDC')
+FEDCATALOG = 'http://service.iris.edu/irisws/fedcatalog/1/query'
+# hosts of the routing answers which are not the ObsPy URL of a center
+_HOST_ALIASES = {'service.iris.edu': 'IRIS', 'geofon.gfz-potsdam.de': 'GFZ'}
+# preferred channel bands and location codes of the samples, best first
+# (e.g. ('HH', 'BH', 'EH') for high rates first); '' is the blank location
+CHANNEL_PRIORITY = ('BH', 'HH', 'EH')
+LOCATION_PRIORITY = ('00', '10', '')
+# answers of an overloaded data center: retried later, at a lower rate
+TRANSIENT_ERRORS = (FDSNTooManyRequestsException,
+                    FDSNServiceUnavailableException, FDSNBadGatewayException,
+                    FDSNTimeoutException)
+
+
+class RateController():
+    r"""Adaptive number of concurrent requests per data center and station.
+    The limit of a data center grows additively (one request per window of
+    limit successes) while its latency stays close to its mean, and is
+    halved on throttling (HTTP 429/503/502) or timeout; such requests are
+    retried after a jittered exponential delay. A station never has more
+    than `station_limit` requests in flight.
+
+    Parameters
+    ----------
+    start : float, optional
+        Initial limit of a data center. The default is 4.
+    maximum : int, optional
+        Highest limit of a data center. The default is 32.
+    station_limit : int, optional
+        Requests in flight per station. The default is 2.
+    retries : int, optional
+        Retries of a throttled request. The default is 4.
+    backoff : float, optional
+        Base retry delay in seconds, doubled on every retry. The default is 1.
+    max_backoff : float, optional
+        Longest retry delay in seconds. The default is 60.
+    """
+    def __init__(self, start=4, maximum=32, station_limit=2, retries=4,
+                 backoff=1.0, max_backoff=60.0):
+        self.start = float(start)
+        self.maximum = maximum
+        self.station_limit = station_limit
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._cond = threading.Condition()
+        # center -> limit, requests in flight, mean latency (s)
+        self.limits = {}
+        self.active = {}
+        self.latency = {}
+        # (center, station) -> requests in flight
+        self.stations = {}
+
+    def limit(self, center):
+        r"""Current number of concurrent requests allowed to `center`.
+        """
+        with self._cond:
+            return int(self.limits.get(center, self.start))
+
+    def acquire(self, center, station=None):
+        with self._cond:
+            while self.active.get(center, 0) >= self.limit(center) or \
+                    (station is not None and
+                     self.stations.get((center, station), 0)
+                     >= self.station_limit):
+                self._cond.wait()
+            self.active[center] = self.active.get(center, 0) + 1
+            if station is not None:
+                self.stations[(center, station)] = \
+                    self.stations.get((center, station), 0) + 1
+
+    def release(self, center, station=None, elapsed=None, throttled=False):
+        r"""End a request: halve the limit if `throttled`, raise it if it
+        answered (in `elapsed` seconds) about as fast as usual.
+        """
+        with self._cond:
+            self.active[center] -= 1
+            if station is not None:
+                self.stations[(center, station)] -= 1
+            limit = self.limits.get(center, self.start)
+            if throttled:
+                self.limits[center] = max(1.0, limit / 2)
+            elif elapsed is not None:
+                mean = self.latency.get(center, elapsed)
+                if elapsed <= 2 * mean:
+                    self.limits[center] = min(self.maximum, limit + 1 / limit)
+                self.latency[center] = 0.8 * mean + 0.2 * elapsed
+            self._cond.notify_all()
+
+    def delay(self, attempt):
+        r"""Retry delay: full jitter over an exponential backoff.
+        """
+        return random.uniform(0, min(self.max_backoff,
+                                     self.backoff * 2 ** attempt))
+
+    def call(self, center, station, func, *args, **kwargs):
+        r"""`func(*args, **kwargs)` within the limits of `center` and
+        `station`, retried on throttling and timeouts.
+        """
+        attempt = 0
+        while True:
+            self.acquire(center, station)
+            start = time.time()
+            try:
+                result = func(*args, **kwargs)
+            except TRANSIENT_ERRORS:
+                self.release(center, station, throttled=True)
+                if attempt >= self.retries:
+                    raise
+                time.sleep(self.delay(attempt))
+                attempt += 1
+                continue
+            except FDSNNoDataException:
+                # a valid (empty) answer
+                self.release(center, station, time.time() - start)
+                raise
+            except Exception:
+                self.release(center, station)
+                raise
+            self.release(center, station, time.time() - start)
+            return result
+
+
+# limits shared by every PooledClient of the process
+rate_controller = RateController()
+
+
+def _station_of(url):
+    # single station of a GET request, None for bulk or wildcard requests
+    query = parse_qs(urlparse(url).query)
+    station = query.get('station', query.get('sta', [None]))[0]
+    if station is None or set(',*?') & set(station):
+        return None
+    return station
+
+
+class PooledClient(Client):
+    r"""FDSN client sending its requests through a keep-alive HTTP pool.
+    The ObsPy client opens a new connection for every request; this one
+    reuses the connections of one `requests.Session`, which is shared by
+    all the threads using the client.
+
+    Parameters
+    ----------
+    base_url : str, optional
+        Data center name or URL. The default is "IRIS".
+    pool_size : int, optional
+        Maximum number of connections kept alive. The default is 32.
+    controller : RateController, optional
+        Concurrency limits and retries of the requests. The default is the
+        `rate_controller` shared by the process.
+    kwargs
+        Options of `obspy.clients.fdsn.Client`.
+    """
+    def __init__(self, base_url="IRIS", pool_size=32, controller=None,
+                 **kwargs):
+        self._http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self._http.mount('http://', adapter)
+        self._http.mount('https://', adapter)
+        self.controller = controller or rate_controller
+        super(PooledClient, self).__init__(base_url, **kwargs)
+
+    def concurrency(self):
+        r"""Number of requests this data center accepts in flight now.
+        """
+        return self.controller.limit(self.base_url)
+
+    def _download(self, url, return_string=False, data=None, use_gzip=None,
+                  content_type=None):
+        return self.controller.call(self.base_url, _station_of(url),
+                                    self._request, url, return_string, data,
+                                    use_gzip, content_type)
+
+    def _request(self, url, return_string=False, data=None, use_gzip=None,
+                 content_type=None):
+        if use_gzip is None:
+            use_gzip = self.use_gzip
+        headers = self.request_headers.copy()
+        if content_type:
+            headers['Content-Type'] = content_type
+        if not use_gzip:
+            headers['Accept-Encoding'] = 'identity'
+        try:
+            if data is None:
+                response = self._http.get(url, headers=headers,
+                                          timeout=self.timeout)
+            else:
+                response = self._http.post(url, headers=headers, data=data,
+                                           timeout=self.timeout)
+        except requests.exceptions.RequestException as error:
+            code, body = None, error
+        else:
+            code = response.status_code
+            if code == 200:
+                body = response.content
+            else:
+                body = '{0}\n{1}'.format(response.reason, response.text)
+        raise_on_error(code, body)
+        return body if return_string else io.BytesIO(body)
+
+
+def get_client(name="IRIS", **kwargs):
+    r"""Shared `PooledClient` of a data center.
+    One client is built per data center (and options) in the process: the
+    service discovery runs once and every caller, including worker threads,
+    shares its connections. A list of data centers gives a shared
+    `RoutedClient` over them.
+    """
+    if isinstance(name, list):
+        name = tuple(name)
+    key = (name, tuple(sorted(kwargs.items())))
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            if isinstance(name, tuple):
+                client = RoutedClient(name, **kwargs)
+            else:
+                client = PooledClient(name, **kwargs)
+            _clients[key] = client
+    return client
+
+
+def provider_name(url):
+    r"""ObsPy name of the data center at `url` (its base URL if unknown).
+    """
+    base = url.split('/fdsnws/')[0].rstrip('/')
+    host = base.split('://')[-1]
+    if host in _HOST_ALIASES:
+        return _HOST_ALIASES[host]
+    for name, known in URL_MAPPINGS.items():
+        if known.split('://')[-1].rstrip('/') == host:
+            return name
+    return base
+
+
+def parse_routes(text):
+    r"""Data centers of each station in a fedcatalog 'request' answer.
+
+    Returns
+    -------
+    routes : dict
+        Station code -> names of the data centers which serve it.
+    """
+    routes = {}
+    provider = None
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('DATACENTER='):
+            provider = None
+        elif line.startswith('DATASELECTSERVICE='):
+            provider = provider_name(line.split('=', 1)[1])
+        elif '=' not in line and provider is not None:
+            fields = line.split()
+            if len(fields) > 1:
+                providers = routes.setdefault(fields[1], [])
+                if provider not in providers:
+                    providers.append(provider)
+    return routes
+
+
+class RoutedClient():
+    r"""FDSN requests routed to the data centers which serve each station.
+    The routes come from the IRIS fedcatalog routing service, are requested
+    in bulk once per station and kept on disk for `ttl` seconds. Each
+    request goes to the healthy center with the lowest observed latency
+    among those of its station, and fails over to the next one on error or
+    timeout; a failing center is skipped for `cooldown` seconds (doubled
+    on every new failure). It has the request methods of an ObsPy client.
+
+    Parameters
+    ----------
+    providers : tuple, optional
+        Data centers, in order of preference, of the stations without a
+        route. The default is `DATA_CENTERS`.
+    path : str, optional
+        Routing table file. The default is
+        ~/.quakelabeler/cache/routing/routes.json.
+    ttl : float, optional
+        Time to live of a route in seconds. The default is 30 days.
+    cooldown : float, optional
+        Seconds a center is skipped after a failure. The default is 60.
+    kwargs
+        Options of the `PooledClient` of every center (e.g. timeout).
+    """
+    def __init__(self, providers=DATA_CENTERS, path=None, ttl=30*24*3600,
+                 cooldown=60, **kwargs):
+        self.providers = list(providers)
+        self.path = path or os.path.join(default_cache_dir('routing'),
+                                         'routes.json')
+        self.ttl = ttl
+        self.cooldown = cooldown
+        self.options = kwargs
+        # center -> mean latency (s), consecutive failures, skipped until
+        self.latency = {}
+        self.failures = {}
+        self.down_until = {}
+        self._lock = threading.RLock()
+        self._http = requests.Session()
+        self.base_url = ','.join(self.providers)
+        self.routes = self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as fp:
+                routes = json.load(fp)
+        except (IOError, ValueError):
+            return {}
+        now = time.time()
+        return dict((sta, entry) for sta, entry in routes.items()
+                    if self.ttl is None or entry['fetched'] + self.ttl >= now)
+
+    def flush(self):
+        r"""Write the routing table to disk.
+        """
+        with self._lock:
+            folder = os.path.dirname(self.path)
+            if folder and not os.path.exists(folder):
+                os.makedirs(folder)
+            temp = self.path + '.tmp'
+            with open(temp, 'w') as fp:
+                json.dump(self.routes, fp)
+            os.replace(temp, self.path)
+
+    def client(self, provider):
+        return get_client(provider, **self.options)
+
+    def concurrency(self):
+        r"""Number of requests the data centers accept in flight now.
+        """
+        controller = self.options.get('controller') or rate_controller
+        return sum(controller.limit(URL_MAPPINGS.get(provider, provider))
+                   for provider in self.providers)
+
+    def route(self, stations, chunk=200):
+        r"""Read the data centers of the `stations` not routed yet.
+        """
+        with self._lock:
+            missing = sorted(set(str(sta) for sta in stations
+                                 if '*' not in str(sta) and '?' not in str(sta))
+                             - set(self.routes))
+        if not missing:
+            return
+        found = {}
+        for i in range(0, len(missing), chunk):
+            try:
+                response = self._http.get(FEDCATALOG, timeout=60, params={
+                    'sta': ','.join(missing[i:i + chunk]),
+                    'format': 'request'})
+            except requests.exceptions.RequestException:
+                # no routing service: every center is a candidate
+                return
+            if response.status_code == 200:
+                found.update(parse_routes(response.text))
+            elif response.status_code != 204:
+                return
+        now = time.time()
+        with self._lock:
+            for sta in missing:
+                self.routes[sta] = {'providers': found.get(sta, []),
+                                    'fetched': now}
+            self.flush()
+
+    def candidates(self, station):
+        r"""Data centers of `station`: the healthy ones by increasing
+        latency, then the ones in cooldown.
+        """
+        entry = self.routes.get(str(station))
+        providers = entry['providers'] if entry and entry['providers'] \
+            else self.providers
+        now = time.time()
+        with self._lock:
+            order = dict((provider, i) for i, provider in
+                         enumerate(providers))
+            return sorted(providers, key=lambda provider: (
+                self.down_until.get(provider, 0) > now,
+                self.latency.get(provider, 0), order[provider]))
+
+    def _record(self, provider, elapsed=None):
+        with self._lock:
+            if elapsed is None:
+                failures = self.failures.get(provider, 0) + 1
+                self.failures[provider] = failures
+                self.down_until[provider] = time.time() + \
+                    self.cooldown * 2 ** min(failures - 1, 6)
+                return
+            self.failures[provider] = 0
+            self.down_until.pop(provider, None)
+            mean = self.latency.get(provider)
+            self.latency[provider] = elapsed if mean is None \
+                else 0.8 * mean + 0.2 * elapsed
+
+    def _call(self, providers, method, *args, **kwargs):
+        # first answer of the `providers`, in order
+        error = None
+        for provider in providers:
+            start = time.time()
+            try:
+                result = getattr(self.client(provider), method)(*args,
+                                                                **kwargs)
+            except FDSNNoDataException as no_data:
+                # the center answered: it is healthy but has no data
+                self._record(provider, time.time() - start)
+                error = error or no_data
+                continue
+            except Exception as failure:
+                self._record(provider)
+                error = failure
+                continue
+            self._record(provider, time.time() - start)
+            return result
+        raise error or FDSNNoDataException('No data available for request.')
+
+    def _groups(self, stations):
+        # stations grouped by their candidate centers
+        self.route(stations)
+        groups = {}
+        for sta in stations:
+            groups.setdefault(tuple(self.candidates(sta)), []).append(sta)
+        return groups
+
+    def get_waveforms(self, network, station, location, channel, starttime,
+                      endtime, **kwargs):
+        return self._call(self.candidates(station), 'get_waveforms', network,
+                          station, location, channel, starttime, endtime,
+                          **kwargs)
+
+    def get_waveforms_bulk(self, bulk, **kwargs):
+        stream = Stream()
+        # a window is only reported as empty when every center said so
+        failure = None
+        groups = self._groups(sorted(set(line[1] for line in bulk)))
+        for providers, stations in groups.items():
+            lines = [line for line in bulk if line[1] in stations]
+            try:
+                stream += self._call(providers, 'get_waveforms_bulk', lines,
+                                     **kwargs)
+            except FDSNNoDataException:
+                continue
+            except TRANSIENT_ERRORS as error:
+                failure = error
+            except Exception:
+                # every center rejected the bulk request: route each window
+                for line in lines:
+                    try:
+                        stream += self.get_waveforms(*line, **kwargs)
+                    except FDSNNoDataException:
+                        continue
+                    except Exception as error:
+                        failure = error
+        if failure is not None:
+            raise failure
+        if len(stream) == 0:
+            raise FDSNNoDataException('No data available for request.')
+        return stream
+
+    def get_stations(self, station='*', **kwargs):
+        inventory = None
+        groups = self._groups(station.split(','))
+        for providers, stations in groups.items():
+            try:
+                part = self._call(providers, 'get_stations',
+                                  station=','.join(stations), **kwargs)
+            except FDSNNoDataException:
+                continue
+            inventory = part if inventory is None else inventory + part
+        if inventory is None:
+            raise FDSNNoDataException('No data available for request.')
+        return inventory
+
+
+def _active(start, end, time):
+    # channel epoch from `start` to `end` (open if None) running at `time`
+    return time is None or ((start is None or start <= time) and
+                            (end is None or time <= end))
+
+
+class WindowPlanner():
+    r"""Sampling rates and channels of stations read from station metadata.
+    Channel metadata is requested once per station, in bulk for all the
+    stations of a catalog, so a sample window of `sample_length` points is
+    known before its waveform is requested (no probe download), and so is
+    the one 3-C channel set of a station to request (see `select`).
+
+    Parameters
+    ----------
+    client : obspy.clients.fdsn.Client
+        Data center client.
+    network, location, channel : str, optional
+        Channel selection of the metadata requests. The channel bands
+        (e.g. 'HH?,BH?,EH?') are also the preferred bands of `select`,
+        best first. The defaults are '*', '*' and 'BH?'.
+    chunk : int, optional
+        Number of stations per metadata request. The default is 200.
+    locations : sequence of str, optional
+        Preferred location codes of `select`, best first; the other codes
+        come after them. The default is `LOCATION_PRIORITY`.
+    """
+    def __init__(self, client, network='*', location='*', channel='BH?',
+                 chunk=200, locations=LOCATION_PRIORITY):
+        self.client = client
+        self.network = network
+        self.location = location
+        self.channel = channel
+        self.chunk = chunk
+        self.bands = tuple(code.strip()[:2] for code in channel.split(','))
+        self.locations = tuple(locations)
+        # station code -> [(start, end, sampling rate)] of its channels
+        self.channels = {}
+        # station code -> [(location, channel, start, end, sampling rate)]
+        self.streams = {}
+        # stations whose metadata request failed (not retried in this run)
+        self.unknown = set()
+
+    def prefetch(self, stations):
+        r"""Read the channel metadata of the `stations` not known yet.
+        """
+        stations = sorted(set(str(sta) for sta in stations)
+                          - set(self.channels) - self.unknown)
+        for i in range(0, len(stations), self.chunk):
+            part = stations[i:i + self.chunk]
+            try:
+                inventory = self.client.get_stations(
+                    network=self.network, station=','.join(part),
+                    location=self.location, channel=self.channel,
+                    level='channel')
+            except FDSNNoDataException:
+                # no metadata (e.g. none of the stations in this center)
+                inventory = []
+            except Exception as error:
+                # timeout, throttling, connection reset: unknown stations
+                LOGGER.warning("Station metadata request failed (%s), "
+                               "metadata of %d stations unknown.",
+                               error, len(part))
+                self.unknown.update(part)
+                continue
+            for sta in part:
+                self.channels[sta] = []
+                self.streams[sta] = []
+            for net in inventory:
+                for sta in net:
+                    epochs = self.channels.setdefault(sta.code, [])
+                    streams = self.streams.setdefault(sta.code, [])
+                    for cha in sta:
+                        if cha.sample_rate:
+                            epochs.append((cha.start_date, cha.end_date,
+                                           float(cha.sample_rate)))
+                            streams.append((cha.location_code, cha.code,
+                                            cha.start_date, cha.end_date,
+                                            float(cha.sample_rate)))
+
+    def _rank(self, location):
+        if location in self.locations:
+            return (self.locations.index(location), location)
+        return (len(self.locations), location)
+
+    def select(self, station, time=None):
+        r"""(location, channel) of the preferred complete 3-C channel set
+        (Z with N/E or 1/2) of `station` at `time`, e.g. ('00', 'HH?'), or
+        None if the station has no such set.
+        """
+        station = str(station)
+        if station not in self.channels:
+            self.prefetch([station])
+        if time is not None:
+            time = UTCDateTime(time)
+        components = {}
+        for location, channel, start, end, rate in \
+                self.streams.get(station, []):
+            if _active(start, end, time):
+                components.setdefault((channel[:2], location),
+                                      set()).add(channel[2:])
+        locations = sorted(set(location for band, location in components),
+                           key=self._rank)
+        for band in self.bands:
+            for location in locations:
+                found = components.get((band, location), set())
+                if 'Z' in found and (found >= set('NE') or
+                                     found >= set('12')):
+                    return location, band + '?'
+        return None
+
+    def sampling_rate(self, station, time=None):
+        r"""Sampling rate of `station` at `time`: the rate of its `select`
+        channel set, else the highest one of its channels, or None without
+        metadata.
+        """
+        station = str(station)
+        if station not in self.channels:
+            self.prefetch([station])
+        if time is not None:
+            time = UTCDateTime(time)
+        selected = self.select(station, time)
+        if selected is not None:
+            location, channel = selected
+            rates = [rate for loc, cha, start, end, rate
+                     in self.streams[station]
+                     if (loc, cha[:2]) == (location, channel[:2]) and
+                     _active(start, end, time)]
+            if rates:
+                return max(rates)
+        epochs = self.channels.get(station, [])
+        if time is not None:
+            active = [rate for start, end, rate in epochs
+                      if (start is None or start <= time) and
+                      (end is None or time <= end)]
+            if active:
+                return max(active)
+        if epochs:
+            return max(rate for start, end, rate in epochs)
+        return None
+
+
+def _timestamp(value):
+    return None if value is None else UTCDateTime(value).timestamp
+
+
+class AvailabilityIndex():
+    r"""Time spans with data of stations, to skip requests bound to fail.
+    Built from the channel epochs of a `WindowPlanner` and, where the data
+    center runs one, from the extents of the FDSN availability service.
+    Both are requested once per station and kept on disk for `ttl`
+    seconds, so the stations of a region are not requested again in the
+    next runs.
+
+    Parameters
+    ----------
+    planner : WindowPlanner
+        Channel epochs (and channel selection) of the stations.
+    path : str, optional
+        Cache file. The default is one file per data center and channel
+        selection in ~/.quakelabeler/cache/availability.
+    ttl : float, optional
+        Time to live of a station in seconds. The default is 7 days.
+    """
+    def __init__(self, planner, path=None, ttl=7*24*3600):
+        self.planner = planner
+        self.ttl = ttl
+        if path is None:
+            selection = '|'.join([str(getattr(planner.client, 'base_url', '')),
+                                  planner.network, planner.location,
+                                  planner.channel])
+            path = os.path.join(default_cache_dir('availability'),
+                                hashlib.sha1(selection.encode()).hexdigest()
+                                + '.json')
+        self.path = path
+        # station code -> [(earliest, latest)] of its channels; stations
+        # missing here have no extents (service not available)
+        self.extents = {}
+        self.service = True
+        self.skipped = 0
+        self.index = self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as fp:
+                index = json.load(fp)
+        except (IOError, ValueError):
+            return {}
+        now = time.time()
+        # entries of former versions have no channel codes
+        return dict((sta, entry) for sta, entry in index.items()
+                    if 'streams' in entry and
+                    (self.ttl is None or entry['fetched'] + self.ttl >= now))
+
+    def flush(self):
+        r"""Write the cached stations to disk.
+        """
+        folder = os.path.dirname(self.path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        temp = self.path + '.tmp'
+        with open(temp, 'w') as fp:
+            json.dump(self.index, fp)
+        os.replace(temp, self.path)
+
+    def prefetch(self, stations):
+        r"""Read the epochs and extents of `stations`, from the disk cache
+        or in bulk from the data center.
+        """
+        stations = sorted(set(str(sta) for sta in stations))
+        missing = []
+        for sta in stations:
+            entry = self.index.get(sta)
+            if entry is None:
+                # stations whose metadata request failed are not retried
+                if sta not in self.planner.unknown:
+                    missing.append(sta)
+                continue
+            self.planner.channels[sta] = [
+                (start and UTCDateTime(start), end and UTCDateTime(end), rate)
+                for start, end, rate in entry['epochs']]
+            self.planner.streams[sta] = [
+                (location, channel, start and UTCDateTime(start),
+                 end and UTCDateTime(end), rate)
+                for location, channel, start, end, rate in entry['streams']]
+            if entry['extents'] is not None:
+                self.extents[sta] = [tuple(span) for span in entry['extents']]
+        if not missing:
+            return
+        self.planner.prefetch(missing)
+        # stations whose metadata request failed are not cached
+        missing = [sta for sta in missing if sta in self.planner.channels]
+        if not missing:
+            return
+        chunk = self.planner.chunk
+        for i in range(0, len(missing), chunk):
+            self.fetch_extents(missing[i:i + chunk])
+        now = time.time()
+        for sta in missing:
+            self.index[sta] = {
+                'epochs': [(_timestamp(start), _timestamp(end), rate)
+                           for start, end, rate in self.planner.channels[sta]],
+                'streams': [(location, channel, _timestamp(start),
+                             _timestamp(end), rate)
+                            for location, channel, start, end, rate
+                            in self.planner.streams.get(sta, [])],
+                'extents': self.extents.get(sta), 'fetched': now}
+        self.flush()
+
+    def fetch_extents(self, stations):
+        r"""Request the availability extents of `stations`.
+        """
+        if not self.service:
+            return
+        url = '{0}/fdsnws/availability/1/extent?network={1}&station={2}' \
+            '&location={3}&channel={4}&format=text'.format(
+                self.planner.client.base_url, self.planner.network,
+                ','.join(stations), self.planner.location,
+                self.planner.channel)
+        try:
+            text = self.planner.client._download(url, return_string=True)
+        except FDSNNoDataException:
+            text = b''
+        except Exception:
+            # no availability service (or several data centers through a
+            # RoutedClient): rely on the station epochs
+            self.service = False
+            return
+        for sta in stations:
+            self.extents[sta] = []
+        for line in text.decode('utf-8', 'replace').splitlines():
+            if not line.strip() or line.startswith('#'):
+                continue
+            fields = line.split()
+            times = []
+            for field in fields[2:]:
+                if 'T' in field:
+                    try:
+                        times.append(UTCDateTime(field).timestamp)
+                    except Exception:
+                        pass
+            if len(fields) > 1 and len(times) >= 2:
+                self.extents.setdefault(fields[1], []).append(
+                    (times[0], times[1]))
+
+    def available(self, station, start, end):
+        r"""Whether `station` may have data from `start` to `end`: one of
+        its channel epochs and, if known, one of its extents cover it.
+        Stations without known metadata may have data.
+        """
+        station = str(station)
+        if station in self.planner.unknown:
+            return True
+        if station not in self.planner.channels:
+            self.prefetch([station])
+        if station not in self.planner.channels:
+            # metadata unknown (failed request): try the download
+            return True
+        start, end = UTCDateTime(start), UTCDateTime(end)
+        if not any((lower is None or lower <= start) and
+                   (upper is None or end <= upper)
+                   for lower, upper, rate in self.planner.channels[station]):
+            return False
+        extents = self.extents.get(station)
+        if extents is None:
+            return True
+        return any(lower <= start.timestamp and end.timestamp <= upper
+                   for lower, upper in extents)
+
+
+def concurrency(client, default=4):
+    r"""Number of requests `client` may have in flight now (`default` for
+    clients without adaptive limits).
+    """
+    limit = getattr(client, 'concurrency', None)
+    return default if limit is None else limit()
+
+
+def demultiplex(stream, window):
+    r"""Traces of a bulk request `stream` for one requested `window`
+    (network, station, location, channel, start, end), copied so that they
+    can be processed independently.
+    """
+    network, station, location, channel, start, end = window
+    part = stream.select(network=network, station=station,
+                         location=location, channel=channel)
+    part = part.slice(UTCDateTime(start), UTCDateTime(end)).copy()
+    # overlapping windows of one bulk request may return the same data twice
+    part.merge(method=-1)
+    return part
+
+
+def fetch_bulk(client, windows, cache=None):
+    r"""Request windows with one get_waveforms_bulk call.
+
+    Parameters
+    ----------
+    client : obspy.clients.fdsn.Client
+        Data center client.
+    windows : list
+        (key, (network, station, location, channel, start, end)) pairs.
+    cache : WaveformCache, optional
+        Raw waveform cache: cached windows are not requested and the
+        downloaded ones are stored.
+
+    Returns
+    -------
+    streams : dict
+        Key to the Stream of its window (empty without data, None if the
+        request failed).
+    """
+    streams = {}
+    if cache is not None:
+        for key, window in windows:
+            st = cache.get(window)
+            if st is not None:
+                streams[key] = st
+        windows = [(key, window) for key, window in windows
+                   if key not in streams]
+        if not windows:
+            return streams
+    bulk = sorted((window for key, window in windows),
+                  key=lambda window: (window[1], window[0], window[4]))
+    try:
+        stream = client.get_waveforms_bulk(bulk)
+    except FDSNNoDataException:
+        stream = Stream()
+    except TRANSIENT_ERRORS:
+        # the center is overloaded: the windows are retried later
+        for key, window in windows:
+            streams[key] = None
+        return streams
+    except Exception:
+        # one bad window fails the whole bulk request: retry them one by one
+        for key, window in windows:
+            try:
+                streams[key] = client.get_waveforms(*window)
+            except FDSNNoDataException:
+                streams[key] = Stream()
+            except Exception:
+                streams[key] = None
+                continue
+            if cache is not None:
+                cache.put(window, streams[key])
+        return streams
+    for key, window in windows:
+        streams[key] = demultiplex(stream, window)
+        if cache is not None:
+            cache.put(window, streams[key])
+    return streams
+
+
+def plan_segments(windows, max_gap=3600, max_length=24*3600, pad=0):
+    r"""Merge the windows of each channel selection into continuous segments.
+
+    Parameters
+    ----------
+    windows : list
+        (key, (network, station, location, channel, start, end)) pairs.
+    max_gap : float, optional
+        Longest gap (s) between two windows of one segment. The default is
+        one hour.
+    max_length : float, optional
+        Longest segment (s). The default is one day.
+    pad : float, optional
+        Seconds before every window to include in its segment (e.g. to
+        cover the noise windows). The default is 0.
+
+    Returns
+    -------
+    segments : list
+        (segment window, keys of the windows it contains) pairs.
+    """
+    spans = sorted(((tuple(window[:4]), UTCDateTime(window[4]) - pad,
+                     UTCDateTime(window[5]), key) for key, window in windows),
+                   key=lambda span: (span[0][1], span[0], span[1]))
+    segments = []
+    for codes, start, end, key in spans:
+        if segments:
+            segment = segments[-1]
+            if segment[0] == codes and start - segment[2] <= max_gap and \
+                    max(end, segment[2]) - segment[1] <= max_length:
+                segment[2] = max(end, segment[2])
+                segment[3].append(key)
+                continue
+        segments.append([codes, start, end, [key]])
+    return [(codes + (start, end), keys)
+            for codes, start, end, keys in segments]
+
+
+def fetch_segments(client, windows, cache=None, max_gap=3600,
+                   max_length=24*3600, pad=0):
+    r"""Request windows as a few continuous segments and slice them locally.
+    Nearby windows of a station are requested once (see `plan_segments`)
+    with `fetch_bulk`; with a `cache`, the segments are stored whole so that
+    later windows inside them (e.g. noise) are not requested either.
+
+    Returns
+    -------
+    streams : dict
+        Key to the Stream of its window (empty without data, None if the
+        request failed).
+    """
+    segments = plan_segments(windows, max_gap, max_length, pad)
+    parts = fetch_bulk(client, list(enumerate(segment for segment, keys
+                                              in segments)), cache)
+    lookup = dict(windows)
+    streams = {}
+    for i, (segment, keys) in enumerate(segments):
+        for key in keys:
+            if parts[i] is None:
+                streams[key] = None
+            else:
+                streams[key] = demultiplex(parts[i], lookup[key])
+    return streams
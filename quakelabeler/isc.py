@@ -0,0 +1,584 @@
+# -*- coding: utf-8 -*-
+# MIT License
+#
+# Copyright (c) 2021 Hao Mai & Pascal Audet
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""
+ISC Bulletin access
+Streaming request, incremental parser and tiled query planner for ISC
+arrivals catalogs.
+@author: Hao Mai & Pascal Audet
+"""
+from __future__ import (absolute_import, division, print_function)
+
+import math
+import threading
+import time
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime, timedelta
+import requests
+from .arrivals import ArrivalTable
+
+# field names of an arrival recording, in the order used by QuakeLabeler
+ARRIVAL_FIELDS = ('EVENTID', 'STA', 'CHN', 'ISCPHASE', 'REPPHASE',
+                  'ARRIVAL_LAT', 'ARRIVAL_LON', 'ARRIVAL_ELEV',
+                  'ARRIVAL_DIST', 'ARRIVAL_BAZ',
+                  'ARRIVAL_DATE', 'ARRIVAL_TIME',
+                  'ORIGIN_LAT', 'ORIGIN_LON', 'ORIGINL_DEPTH',
+                  'ORIGIN_DATE', 'ORIGIN_TIME',
+                  'EVENT_TYPE', 'EVENT_MAG')
+
+# ISC header names for each field: (column name, n-th occurrence).
+# Station and origin coordinates share the LAT/LON names in some versions
+# of the bulletin output, so the occurrence picks the right one.
+HEADER_ALIASES = {
+    'EVENTID': (('EVENTID', 0),),
+    'STA': (('STA', 0),),
+    'CHN': (('CHN', 0),),
+    'ISCPHASE': (('ISCPHASE', 0),),
+    'REPPHASE': (('REPPHASE', 0),),
+    'ARRIVAL_LAT': (('LAT', 0), ('STA_LAT', 0)),
+    'ARRIVAL_LON': (('LON', 0), ('STA_LON', 0)),
+    'ARRIVAL_ELEV': (('ELEV', 0), ('STA_ELEV', 0)),
+    'ARRIVAL_DIST': (('DIST', 0),),
+    'ARRIVAL_BAZ': (('BAZ', 0),),
+    'ARRIVAL_DATE': (('DATE', 0),),
+    'ARRIVAL_TIME': (('TIME', 0),),
+    'ORIGIN_LAT': (('LAT', 1),),
+    'ORIGIN_LON': (('LON', 1),),
+    'ORIGINL_DEPTH': (('ORIGIN_DEPTH', 0), ('DEPTH', 0)),
+    'ORIGIN_DATE': (('DATE', 1),),
+    'ORIGIN_TIME': (('TIME', 1),),
+    'EVENT_TYPE': (('ETYPE', 0),),
+    'EVENT_MAG': (('MAG', 0),),
+    }
+
+INT_FIELDS = ('EVENTID',)
+FLOAT_FIELDS = ('ARRIVAL_LAT', 'ARRIVAL_LON', 'ARRIVAL_ELEV',
+                'ARRIVAL_DIST', 'ARRIVAL_BAZ',
+                'ORIGIN_LAT', 'ORIGIN_LON', 'ORIGINL_DEPTH', 'EVENT_MAG')
+
+# markers of the ISC result page
+NO_DATA_MARKER = 'No phase data was found.'
+END_MARKERS = ('STOP', '</pre>', 'Agencies whose data')
+
+
+def _to_float(value):
+    value = value.strip()
+    if value == '':
+        return float('NaN')
+    return float(value)
+
+
+def _to_int(value):
+    return int(value.strip())
+
+
+class ArrivalParser():
+    r"""Incremental parser for the CSV block of an ISC arrivals page.
+    Lines are fed one at a time, so records are produced while the page is
+    still being downloaded and only the current line is kept in memory.
+    The column order is taken from the CSV header line instead of fixed
+    column strides, which makes the parser independent of the bulletin
+    version.
+
+    Parameters
+    ----------
+    fields : tuple, optional
+        Field names to keep in every record. The default is
+        `ARRIVAL_FIELDS`.
+
+    Attributes
+    ----------
+    columns : dict
+        Column index of each field. ``None`` until the header is found.
+    no_data : bool
+        True if ISC reported that no phase data was found.
+    """
+    def __init__(self, fields=ARRIVAL_FIELDS):
+        self.fields = tuple(fields)
+        self.columns = None
+        self.no_data = False
+        self.finished = False
+        self.count = 0
+        self._converters = []
+        self._width = 0
+
+    def resolve_header(self, header):
+        r"""Map field names to column indices of a CSV header line.
+        """
+        names = [name.strip().upper() for name in header.split(',')]
+        seen = {}
+        occurrence = []
+        for name in names:
+            occurrence.append(seen.get(name, 0))
+            seen[name] = seen.get(name, 0) + 1
+        columns = {}
+        for field in self.fields:
+            candidates = ((field, 0),) + HEADER_ALIASES.get(field, ())
+            for name, nth in candidates:
+                for index, (col, occ) in enumerate(zip(names, occurrence)):
+                    if col == name and occ == nth:
+                        columns[field] = index
+                        break
+                if field in columns:
+                    break
+            if field not in columns:
+                raise IndexError('Column {0} is missing in the ISC header.'
+                                 .format(field))
+        return columns
+
+    def _set_columns(self, columns):
+        self.columns = columns
+        self._converters = []
+        for field in self.fields:
+            if field in INT_FIELDS:
+                convert = _to_int
+            elif field in FLOAT_FIELDS:
+                convert = _to_float
+            else:
+                convert = str.strip
+            self._converters.append((field, columns[field], convert))
+        self._width = max(columns.values()) + 1
+
+    def feed(self, line):
+        r"""Parse one line of the page.
+
+        Returns
+        -------
+        record : dict or None
+            Arrival record if `line` is a data row, otherwise None.
+        """
+        if self.finished:
+            return None
+        if self.columns is None:
+            if NO_DATA_MARKER in line:
+                self.no_data = True
+                self.finished = True
+            elif 'EVENTID' in line and ',' in line:
+                self._set_columns(self.resolve_header(line))
+            return None
+        values = line.split(',')
+        if len(values) < self._width or not values[0].strip().isdigit():
+            for marker in END_MARKERS:
+                if marker in line:
+                    self.finished = True
+                    break
+            return None
+        record = {}
+        for field, index, convert in self._converters:
+            record[field] = convert(values[index])
+        self.count += 1
+        return record
+
+    def parse(self, lines):
+        r"""Generate arrival records from an iterable of text lines.
+        """
+        for line in lines:
+            record = self.feed(line)
+            if record is not None:
+                yield record
+            elif self.finished:
+                break
+
+
+def stream_lines(url, params, session=None, timeout=None, chunk_size=64*1024):
+    r"""Send one streamed GET request and generate the decoded text lines.
+
+    Parameters
+    ----------
+    url : str
+        ISC web service url.
+    params : dict
+        Query parameters.
+    session : requests.Session, optional
+        Reuse an existing session (keep-alive connection pool).
+    timeout : float or tuple, optional
+        Passed to `requests`.
+    """
+    http = session if session is not None else requests
+    response = http.get(url, params=params, stream=True, timeout=timeout)
+    try:
+        if response.encoding is None:
+            response.encoding = 'utf-8'
+        for line in response.iter_lines(chunk_size=chunk_size,
+                                        decode_unicode=True):
+            yield line
+    finally:
+        response.close()
+
+
+def iter_arrivals(url, params, fields=ARRIVAL_FIELDS, parser=None, **kwargs):
+    r"""Query ISC once and generate arrival records while downloading.
+    Pass a `parser` to inspect `no_data` / `columns` after the iteration.
+    """
+    if parser is None:
+        parser = ArrivalParser(fields)
+    for record in parser.parse(stream_lines(url, params, **kwargs)):
+        yield record
+
+
+# station-region parameters of a circular search, dropped in RECT tiles
+CIRC_KEYS = ('stn_ctr_lat', 'stn_ctr_lon', 'stn_radius', 'max_stn_dist_units')
+# fields which identify one arrival when merging tiles
+MERGE_KEY = ('EVENTID', 'STA', 'CHN', 'ISCPHASE', 'REPPHASE',
+             'ARRIVAL_DATE', 'ARRIVAL_TIME')
+
+
+def param_time(params, prefix):
+    r"""Read `<prefix>_year/month/day/time` ISC params as a datetime.
+    Returns None if the date is missing or invalid.
+    """
+    try:
+        year = int(params[prefix + '_year'])
+        month = int(params[prefix + '_month'])
+        day = int(params[prefix + '_day'])
+        clock = str(params.get(prefix + '_time', '') or '00:00:00').strip()
+        hms = [int(float(x)) for x in clock.split(':')] + [0, 0, 0]
+        return datetime(year, month, day, hms[0], hms[1], hms[2])
+    except (KeyError, ValueError, TypeError):
+        return None
+
+
+def set_param_time(params, prefix, value):
+    params[prefix + '_year'] = str(value.year)
+    params[prefix + '_month'] = str(value.month)
+    params[prefix + '_day'] = str(value.day)
+    params[prefix + '_time'] = value.strftime('%H:%M:%S')
+
+
+def great_circle(lat1, lon1, lat2, lon2):
+    r"""Great circle distance in degrees.
+    """
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (math.sin((lat2 - lat1) / 2)**2 +
+         math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2)**2)
+    return math.degrees(2 * math.asin(min(1.0, math.sqrt(a))))
+
+
+def _wrap_lon(lon):
+    return (lon + 180.0) % 360.0 - 180.0
+
+
+def _is_timeout(error):
+    if isinstance(error, requests.exceptions.Timeout):
+        return True
+    return 'timed out' in str(error).lower()
+
+
+class _SplitTile(Exception):
+    # raised by a tile which returned too many rows or timed out
+    pass
+
+
+class QueryTile():
+    r"""One space/time tile of an ISC query.
+
+    Parameters
+    ----------
+    params : dict
+        Full ISC parameters of the tile.
+    start, end : datetime or None
+        Event time range of the tile.
+    region : tuple or None
+        (bottom, top, left, right) station rectangle, None if the station
+        region of the original query is kept.
+    circle : tuple or None
+        (lat, lon, radius_deg) of the original circular search, used to
+        filter the rows of a rectangle tile cut out of the circle.
+    """
+    def __init__(self, params, start=None, end=None, region=None,
+                 circle=None, depth=0):
+        self.params = params
+        self.start = start
+        self.end = end
+        self.region = region
+        self.circle = circle
+        self.depth = depth
+        self.no_data = False
+
+    def sortkey(self):
+        return (self.start or datetime.min,
+                self.region[0] if self.region else 0.0,
+                self.region[2] if self.region else 0.0)
+
+    def with_time(self, start, end):
+        params = dict(self.params)
+        set_param_time(params, 'start', start)
+        set_param_time(params, 'end', end)
+        return QueryTile(params, start, end, self.region, self.circle,
+                         self.depth + 1)
+
+    def with_region(self, region, circle=None):
+        params = dict(self.params)
+        for key in CIRC_KEYS:
+            params.pop(key, None)
+        params['stnsearch'] = 'RECT'
+        params['stn_bot_lat'] = '%.4f' % region[0]
+        params['stn_top_lat'] = '%.4f' % region[1]
+        params['stn_left_lon'] = '%.4f' % region[2]
+        params['stn_right_lon'] = '%.4f' % region[3]
+        return QueryTile(params, self.start, self.end, region,
+                         circle or self.circle, self.depth + 1)
+
+    def keep(self, record):
+        if self.circle is None:
+            return True
+        lat, lon, radius = self.circle
+        return great_circle(lat, lon, record['ARRIVAL_LAT'],
+                            record['ARRIVAL_LON']) <= radius
+
+
+class QueryPlanner():
+    r"""Adaptive space/time sharding of an ISC arrivals query.
+    The `start_*` to `end_*` time range is cut into tiles of `tile_days`,
+    which are requested concurrently by at most `max_workers` threads. A
+    tile which returns more than `max_rows` arrivals or times out is split
+    again, first in time and then in space (RECT or CIRC station regions),
+    and the tiles are finally merged and deduplicated into one
+    `ArrivalTable` in time order.
+
+    Parameters
+    ----------
+    url : str
+        ISC web service url.
+    params : dict
+        ISC query parameters.
+    fields : tuple, optional
+        Fields of every arrival record.
+    tile_days : float, optional
+        Initial time span of a tile. The default is 31 days.
+    max_workers : int, optional
+        Politeness cap of concurrent requests. The default is 3.
+    max_rows : int, optional
+        Split a tile which returns more rows. The default is 200,000.
+    min_span : timedelta, optional
+        Tiles shorter than `2*min_span` are split in space instead of time.
+    min_degrees : float, optional
+        Smallest station rectangle side of a tile.
+    timeout : tuple, optional
+        (connect, read) timeout of each request in seconds.
+    delay : float, optional
+        Minimum seconds between two request starts.
+    cache : QueryCache, optional
+        Answer tiles from a local cache and store the fetched ones.
+    """
+    def __init__(self, url, params, fields=ARRIVAL_FIELDS, tile_days=31,
+                 max_workers=3, max_rows=200000,
+                 min_span=timedelta(hours=6), min_degrees=0.5,
+                 timeout=(30, 600), delay=1.0, retries=2, cache=None):
+        self.url = url
+        self.params = dict(params)
+        self.fields = tuple(fields)
+        self.tile_days = tile_days
+        self.max_workers = max(1, int(max_workers))
+        self.max_rows = max_rows
+        self.min_span = min_span
+        self.min_degrees = min_degrees
+        self.timeout = timeout
+        self.delay = delay
+        self.retries = retries
+        self.cache = cache
+        self.no_data = False
+        self.tiles = []
+        self._lock = threading.Lock()
+        self._last_request = 0.0
+        self._local = threading.local()
+
+    def station_region(self):
+        r"""Station rectangle of the query, or the bounding rectangle and
+        circle of a circular search. Returns (region, circle).
+        """
+        params = self.params
+        try:
+            if params.get('stnsearch') == 'RECT':
+                return (float(params['stn_bot_lat']),
+                        float(params['stn_top_lat']),
+                        float(params['stn_left_lon']),
+                        float(params['stn_right_lon'])), None
+            if params.get('stnsearch') != 'CIRC':
+                return None, None
+            lat = float(params['stn_ctr_lat'])
+            lon = float(params['stn_ctr_lon'])
+            radius = float(params['stn_radius'])
+        except (KeyError, ValueError):
+            return None, None
+        if params.get('max_stn_dist_units') == 'km':
+            radius = radius / 111.195
+        # circle tiles are filtered on the station coordinates
+        if 'ARRIVAL_LAT' not in self.fields or 'ARRIVAL_LON' not in self.fields:
+            return None, None
+        if abs(lat) + radius >= 90.0:
+            return None, None
+        half = math.degrees(math.asin(min(1.0, math.sin(
+            math.radians(radius)) / math.cos(math.radians(lat)))))
+        if half >= 90.0:
+            return None, None
+        region = (lat - radius, lat + radius,
+                  _wrap_lon(lon - half), _wrap_lon(lon + half))
+        return region, (lat, lon, radius)
+
+    def plan(self):
+        r"""Initial tiles of the query, in time order.
+        """
+        root = QueryTile(dict(self.params))
+        start = param_time(self.params, 'start')
+        end = param_time(self.params, 'end')
+        if start is None or end is None or end <= start \
+                or not self.tile_days:
+            self.tiles = [root]
+            return self.tiles
+        step = timedelta(days=self.tile_days)
+        self.tiles = []
+        current = start
+        while current < end:
+            upper = min(current + step, end)
+            tile = root.with_time(current, upper)
+            tile.depth = 0
+            self.tiles.append(tile)
+            current = upper
+        return self.tiles
+
+    def split(self, tile):
+        r"""Split a tile in two, in time if possible, otherwise in space.
+        Returns an empty list if the tile cannot be split any further.
+        """
+        if tile.start is not None and tile.end - tile.start >= 2*self.min_span:
+            middle = tile.start + (tile.end - tile.start) / 2
+            middle = middle.replace(microsecond=0)
+            return [tile.with_time(tile.start, middle),
+                    tile.with_time(middle, tile.end)]
+        region, circle = tile.region, None
+        if region is None:
+            region, circle = self.station_region()
+            if region is None:
+                return []
+        bot, top, left, right = region
+        width = (right - left) % 360.0 or (360.0 if right != left else 0.0)
+        height = top - bot
+        if max(width, height) < 2*self.min_degrees:
+            return []
+        if width >= height:
+            middle = _wrap_lon(left + width / 2)
+            halves = [(bot, top, left, middle), (bot, top, middle, right)]
+        else:
+            middle = bot + height / 2
+            halves = [(bot, middle, left, right), (middle, top, left, right)]
+        return [tile.with_region(half, circle) for half in halves]
+
+    def _session(self):
+        # requests.Session is not thread safe, keep one per worker thread
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            self._local.session = session
+        return session
+
+    def _throttle(self):
+        with self._lock:
+            wait_time = self._last_request + self.delay - time.time()
+            if wait_time > 0:
+                time.sleep(wait_time)
+            self._last_request = time.time()
+
+    def fetch_tile(self, tile):
+        r"""Request one tile and return its `ArrivalTable`.
+        """
+        if self.cache is not None:
+            records = self.cache.get(tile.params)
+            if records is not None:
+                tile.no_data = len(records) == 0
+                return records
+        for attempt in range(self.retries + 1):
+            self._throttle()
+            parser = ArrivalParser(self.fields)
+            records = []
+            lines = stream_lines(self.url, tile.params,
+                                 session=self._session(),
+                                 timeout=self.timeout)
+            try:
+                with closing(lines):
+                    for record in parser.parse(lines):
+                        records.append(record)
+                        if self.max_rows and len(records) > self.max_rows:
+                            raise _SplitTile('too many rows')
+            except requests.exceptions.RequestException as error:
+                if _is_timeout(error):
+                    raise _SplitTile('timeout')
+                if attempt == self.retries:
+                    raise
+                continue
+            if parser.no_data:
+                tile.no_data = True
+                records = []
+            elif parser.columns is not None:
+                records = [record for record in records if tile.keep(record)]
+            else:
+                continue
+            records = ArrivalTable.from_records(records, self.fields)
+            if self.cache is not None:
+                self.cache.put(tile.params, records)
+            return records
+        raise IndexError('No arrivals block found in the ISC response.')
+
+    def merge(self, results):
+        r"""Merge tile results in time order and drop duplicated arrivals
+        of tiles which share a boundary.
+        """
+        tables = [results[tile] for tile in
+                  sorted(results, key=lambda tile: tile.sortkey())]
+        merged = ArrivalTable.concat(tables) if tables else \
+            ArrivalTable.from_records([], self.fields)
+        keys = [field for field in MERGE_KEY if field in merged.fields]
+        return merged.drop_duplicates(*keys)
+
+    def run(self):
+        r"""Fetch every tile and return the merged `ArrivalTable`.
+        """
+        tiles = self.plan()
+        if len(tiles) > 1:
+            print("Query is split into %d tiles." % len(tiles))
+        results = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            pending = {pool.submit(self.fetch_tile, tile): tile
+                       for tile in tiles}
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    tile = pending.pop(future)
+                    try:
+                        results[tile] = future.result()
+                    except _SplitTile as error:
+                        children = self.split(tile)
+                        if not children:
+                            raise requests.exceptions.Timeout(
+                                'ISC tile cannot be split any further: '
+                                '{0}'.format(error))
+                        if self.cache is not None:
+                            self.cache.put_split(tile.params,
+                                                 [child.params
+                                                  for child in children])
+                        for child in children:
+                            pending[pool.submit(self.fetch_tile, child)] = child
+        if self.cache is not None:
+            self.cache.flush()
+        self.no_data = all(tile.no_data for tile in results)
+        return self.merge(results)
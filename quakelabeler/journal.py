@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+# MIT License
+#
+# Copyright (c) 2021 Hao Mai & Pascal Audet
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""
+Checkpoint journal
+Append-only record of the dataset generation, to resume a stopped run.
+@author: Hao Mai & Pascal Audet
+"""
+from __future__ import (absolute_import, division, print_function)
+
+import os
+import json
+import numpy as np
+
+# states of a record: the last line of a record wins
+ATTEMPTED = 'attempted'
+DONE = 'done'
+NO_DATA = 'no_data'
+ERROR = 'error'
+
+
+def record_key(thread):
+    r"""Key of an arrival record in the journal.
+    """
+    return '|'.join(str(thread[field])
+                    for field in ('EVENTID', 'STA', 'ISCPHASE'))
+
+
+def noise_key(sample):
+    r"""Key of the noise samples of an event sample (or of a noise sample,
+    which keeps the arrival of its event sample) in the journal.
+    """
+    return 'noise|' + '|'.join(str(sample.get(field)) for field in
+                               ('EVENTID', 'STA', 'ARRIVAL_EPOCH'))
+
+
+def label_key(thread):
+    r"""Key of an arrival record with its phase reduced to the P or S label
+    (as written in the features CSV without `label_type`).
+    """
+    phase = 'S' if 'S' in str(thread['ISCPHASE']) else 'P'
+    return '|'.join([str(thread['EVENTID']), str(thread['STA']), phase])
+
+
+def _plain(value):
+    # JSON value of a sample field (numpy scalars, UTCDateTime, ...)
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and value != value:
+        return None
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    return str(value)
+
+
+class SampleJournal():
+    r"""Crash-safe journal of the records of a dataset.
+    Every record gets one JSON line when its waveform is requested
+    (`attempted`) and one when it is finished: `done` with its samples and
+    output files, `no_data` when the data center has no data, or `error`
+    when the request failed (throttling, timeout, ...). Lines are flushed
+    to disk as they are written, so after a crash the journal tells which
+    records are complete; a truncated last line is ignored.
+
+    Parameters
+    ----------
+    path : str
+        Journal file, e.g. journal.jsonl in the dataset folder.
+    resume : bool, optional
+        Keep the records of a previous run. The default is False (the
+        journal starts empty).
+    """
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.records = {}
+        # keys of the `done` records, in order of completion
+        self.order = []
+        if resume:
+            self._load()
+        self._fp = open(path, 'a' if resume else 'w')
+
+    def _load(self):
+        try:
+            fp = open(self.path)
+        except IOError:
+            return
+        with fp:
+            for line in fp:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # partial line of an interrupted write
+                    continue
+                self.records[entry['key']] = entry
+                if entry['state'] == DONE:
+                    if entry['key'] in self.order:
+                        self.order.remove(entry['key'])
+                    self.order.append(entry['key'])
+
+    def _write(self, entry):
+        self.records[entry['key']] = entry
+        self._fp.write(json.dumps(entry) + '\n')
+        self._fp.flush()
+        os.fsync(self._fp.fileno())
+
+    def state(self, key):
+        entry = self.records.get(key)
+        return None if entry is None else entry['state']
+
+    def pending(self, key):
+        r"""Whether the record `key` still has to be requested: never
+        finished, or failed with a transient error.
+        """
+        return self.state(key) not in (DONE, NO_DATA)
+
+    def attempted(self, key):
+        self._write({'key': key, 'state': ATTEMPTED})
+
+    def done(self, key, samples):
+        r"""Record the `samples` (dicts with their output `filename`) of the
+        record `key`.
+        """
+        samples = [dict((name, _plain(value)) for name, value in
+                        sample.items()) for sample in samples]
+        self._write({'key': key, 'state': DONE, 'samples': samples,
+                     'files': [sample.get('filename') for sample in samples]})
+        self.order.append(key)
+
+    def failed(self, key, transient=False):
+        self._write({'key': key, 'state': ERROR if transient else NO_DATA})
+
+    def samples(self):
+        r"""Samples of the `done` records, in order of completion.
+        """
+        return [sample for key in self.order
+                for sample in self.records[key]['samples']]
+
+    def close(self):
+        if not self._fp.closed:
+            self._fp.close()
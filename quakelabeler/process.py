@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+# MIT License
+#
+# Copyright (c) 2021 Hao Mai & Pascal Audet
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""
+Waveform processing
+CPU-bound transforms of downloaded streams, run in worker processes.
+@author: Hao Mai & Pascal Audet
+"""
+from __future__ import (absolute_import, division, print_function)
+
+from concurrent.futures import Future, ProcessPoolExecutor
+from functools import lru_cache
+import numpy as np
+from scipy.signal import iirfilter, sosfilt, zpk2sos
+
+
+def trim_stream(st, custom_dataset):
+    r"""Remove the traces shorter than the fixed sample length and cut the
+    longer ones to it.
+    """
+    if custom_dataset['fixed_length']:
+        for tr in st:
+            if tr.stats.npts < custom_dataset['sample_length']:
+                st.remove(tr)
+            if tr.stats.npts > custom_dataset['sample_length']:
+                tr.data = tr.data[:custom_dataset['sample_length']]
+    return st
+
+
+@lru_cache(maxsize=None)
+def filter_design(kind, corners, rate, freqmin=None, freqmax=None):
+    r"""Second-order sections of a Butterworth filter, as designed by the
+    ObsPy filters of the same name, designed once per set of arguments.
+    Parameters
+    ----------
+    kind : str
+        'lowpass' and 'highpass' (corner `freqmin`) or 'bandpass'.
+    corners : int
+        Filter order.
+    rate : float
+        Sampling rate in Hz.
+    freqmin, freqmax : float, optional
+        Corner frequencies in Hz.
+    Returns
+    -------
+    sos : numpy.ndarray
+        Filter sections, None for the corners ObsPy adjusts or rejects
+        (at or above Nyquist), which are left to `Trace.filter`.
+    """
+    nyquist = 0.5 * rate
+    if kind == 'bandpass':
+        if freqmax / nyquist - 1.0 > -1e-6 or freqmin / nyquist > 1:
+            return None
+        band = [freqmin / nyquist, freqmax / nyquist]
+        btype = 'band'
+    else:
+        if freqmin / nyquist > 1:
+            return None
+        band = freqmin / nyquist
+        btype = kind
+    z, p, k = iirfilter(corners, band, btype=btype, ftype='butter',
+                        output='zpk')
+    return zpk2sos(z, p, k)
+
+
+def filter_streams(streams, kind, freqmin=None, freqmax=None, corners=4,
+                   zerophase=False):
+    r"""Filter every trace of `streams` in place, with one vectorized call
+    per group of traces of the same sampling rate and length.
+    Gives the same data as ``st.filter(kind, ...)``, with the `freq` of
+    'lowpass' and 'highpass' as `freqmin`.
+    """
+    groups = {}
+    for st in streams:
+        for tr in st:
+            key = (float(tr.stats.sampling_rate), tr.stats.npts)
+            groups.setdefault(key, []).append(tr)
+    for (rate, npts), traces in groups.items():
+        sos = filter_design(kind, corners, rate, freqmin, freqmax)
+        if sos is None:
+            options = {'freqmin': freqmin, 'freqmax': freqmax} \
+                if kind == 'bandpass' else {'freq': freqmin}
+            for tr in traces:
+                tr.filter(kind, corners=corners, zerophase=zerophase,
+                          **options)
+            continue
+        data = np.array([tr.data for tr in traces], dtype=np.float64)
+        data = sosfilt(sos, data, axis=-1)
+        if zerophase:
+            data = sosfilt(sos, data[:, ::-1], axis=-1)[:, ::-1]
+        for tr, row in zip(traces, data):
+            tr.data = np.ascontiguousarray(row)
+    return streams
+
+
+def transform_streams(streams, custom_waveform, custom_dataset, seeds=None):
+    r"""`transform_stream` of a batch of streams, filtered together (see
+    `filter_streams`).
+    Parameters
+    ----------
+    streams : list of Obspy Stream Object
+        Downloaded waveforms.
+    custom_waveform : dict
+        Waveform options of `QuakeLabeler`.
+    custom_dataset : dict
+        Dataset options of `QuakeLabeler`.
+    seeds : list of int, optional
+        Seed of the added noise of each stream.
+    Returns
+    -------
+    streams : list of Obspy Stream Object
+        Processed waveforms, without traces if none is valid.
+    """
+    if seeds is None:
+        seeds = [None] * len(streams)
+    # resample mode
+    try:
+        resample_rate = float(custom_waveform['sample_rate'])
+    except Exception:
+        pass
+    else:
+        for st in streams:
+            st.resample(resample_rate)
+    # filter option
+    if custom_waveform['filter_type'] == '1':
+        filter_streams(streams, 'lowpass', custom_waveform['filter_freqmin'], corners=2, zerophase=True)
+    if custom_waveform['filter_type'] == '2':
+        filter_streams(streams, 'highpass', custom_waveform['filter_freqmax'], zerophase=True)
+    if custom_waveform['filter_type'] == '3':
+        filter_streams(streams, 'bandpass', custom_waveform['filter_freqmin'], custom_waveform['filter_freqmax'])
+    return [_finish_stream(st, custom_waveform, custom_dataset, seed)
+            for st, seed in zip(streams, seeds)]
+
+
+def _finish_stream(st, custom_waveform, custom_dataset, seed=None):
+    # add noise
+    if custom_waveform['add_noise'] != 0 :
+        random = np.random.RandomState(seed)
+        # add noise to trace
+        for tr in st:
+            length = len(tr.data)
+            amplitude = max(tr.data)
+            noise_arr = amplitude*custom_waveform['add_noise']*(-1+2*random.rand(length))
+            tr.data = noise_arr + tr.data
+    st = trim_stream(st, custom_dataset)
+    # detrend (optional)
+    if custom_waveform.get('detrend'):
+        for tr in st:
+            tr.detrend()
+    return st
+
+
+def transform_stream(st, custom_waveform, custom_dataset, seed=None):
+    r"""Resample, filter, add noise, trim and detrend a downloaded stream.
+    Parameters
+    ----------
+    st : Obspy Stream Object
+        Downloaded waveform.
+    custom_waveform : dict
+        Waveform options of `QuakeLabeler`.
+    custom_dataset : dict
+        Dataset options of `QuakeLabeler`.
+    seed : int, optional
+        Seed of the added noise (worker processes share the parent state).
+    Returns
+    -------
+    st : Obspy Stream Object
+        Processed waveform, without traces if none is valid.
+    """
+    return transform_streams([st], custom_waveform, custom_dataset, [seed])[0]
+
+
+class StreamProcessor():
+    r"""Pool of worker processes for `transform_stream`.
+    Streams are submitted as they are downloaded and their results are
+    collected in the same order, so that the network requests, the
+    transforms and the export of the samples overlap.
+
+    Parameters
+    ----------
+    custom_waveform : dict
+        Waveform options of `QuakeLabeler`.
+    custom_dataset : dict
+        Dataset options of `QuakeLabeler`.
+    processes : int, optional
+        Number of worker processes, 0 to transform in the calling thread.
+        The default is the number of cores.
+    """
+    def __init__(self, custom_waveform, custom_dataset, processes=None):
+        self.options = (dict(custom_waveform), dict(custom_dataset))
+        self.pool = None
+        if processes != 0:
+            self.pool = ProcessPoolExecutor(max_workers=processes)
+
+    def submit(self, st):
+        r"""Future of the processed `st`.
+        """
+        seed = np.random.randint(2**31 - 1)
+        if self.pool is not None:
+            return self.pool.submit(transform_stream, st, self.options[0],
+                                    self.options[1], seed)
+        future = Future()
+        future.set_result(transform_stream(st, self.options[0],
+                                           self.options[1], seed))
+        return future
+
+    def submit_batch(self, streams):
+        r"""Future of the processed `streams`, transformed together.
+        """
+        seeds = [np.random.randint(2**31 - 1) for st in streams]
+        if self.pool is not None:
+            return self.pool.submit(transform_streams, streams,
+                                    self.options[0], self.options[1], seeds)
+        future = Future()
+        future.set_result(transform_streams(streams, self.options[0],
+                                            self.options[1], seeds))
+        return future
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
@@ -79,7 +79,8 @@ def main():
     # earthquake maps
     map_option = input("Do you want to display query results: [y]/n?")
     if not map_option.lower() == 'n':
-        MT = MergeMetadata(query.record_folder)
+        MT = MergeMetadata(query.record_folder, store=query.store,
+                           name=query.record_name)
         filelist = MT.select_folder()
         temp_pd = MT.merge_event(filelist)
         event_pd = MT.event_clean(temp_pd)
@@ -105,8 +106,9 @@ def main():
     
     # auto-production of dataset
     auto_dataset = QuakeLabeler(query, custom)
-    # data collect and process
-    auto_dataset.fetch_all_waveforms(auto_dataset.recordings)
+    # data collect and process, from the data centers serving each station
+    auto_dataset.fetch_all_waveforms(auto_dataset.recordings,
+                                     clientname=DATA_CENTERS)
     # waveform graph
     if custom.custom_export['export_type'] == 'SAC':
         auto_dataset.waveform_display()
@@ -56,6 +56,9 @@ auto_dataset.local_label(auto_dataset.recordings)
 
 #%% local label detail
 records = auto_dataset.recordings
+# FILENAME index of the phases: no table scan to pair P and S
+phase_index = PhaseIndex(ArrivalTable.from_dataframe(records),
+                         keys=('FILENAME',), phase='PHASE')
 #%%
 print('Initialize samples producer module...')
 # selet user preference
@@ -131,9 +134,8 @@ if thread['PHASE'] == 'P':
     # pick a P event
     p_phase = thread['ARRIVAL_DATE'] + 'T' + thread['ARRIVAL_TIME']
     # check if S exists
-    s_thread = records.loc[(records['FILENAME']==thread['FILENAME'] )&( records['PHASE']=='S') ]
-    if not s_thread.empty:
-        s_thread = s_thread.squeeze()
+    s_thread = phase_index.find(thread, 'S')
+    if s_thread is not None:
         s_phase = s_thread['ARRIVAL_DATE'] + 'T' + s_thread['ARRIVAL_TIME']
         # UTCDate
         p_time = UTCDateTime(p_phase)
@@ -155,9 +157,8 @@ if thread['PHASE'] == 'P':
 #%% S phase
 if thread['PHASE'] == 'S':
     s_phase = thread['ARRIVAL_DATE'] + 'T' + thread['ARRIVAL_TIME']
-    p_thread = records.loc[(records['FILENAME']==thread['FILENAME'] )&( records['PHASE']=='P') ]
-    if not p_thread.empty:
-        p_thread = p_thread.squeeze()
+    p_thread = phase_index.find(thread, 'P')
+    if p_thread is not None:
         p_phase = p_thread['ARRIVAL_DATE'] + 'T' + p_thread['ARRIVAL_TIME']
         # UTCDate
         p_time = UTCDateTime(p_phase)
@@ -8,9 +8,13 @@ Created on Mon May 30 16:49:05 2022
 import pandas as pd
 from obspy.core.utcdatetime import UTCDateTime
 from obspy.core import read
+from quakelabeler import ArrivalTable, PhaseIndex
 #%% load pandas
 
 records = pd.read_csv("/Users/hao/Downloads/dataset_test/catalog_test_1.csv",index_col=0)
+# FILENAME index of the phases: no table scan to pair P and S
+phase_index = PhaseIndex(ArrivalTable.from_dataframe(records),
+                         keys=('FILENAME',), phase='PHASE')
 #%%
 def picktimewindow(total, windowtime, p_time, s_time, t0, te):
     if total== windowtime:
@@ -43,9 +47,8 @@ for ind,thread in records.iterrows():
         # pick a P event
         p_phase = thread['ARRIVAL_DATE'] + 'T' + thread['ARRIVAL_TIME']
         # check if S exists
-        s_thread = records.loc[(records['FILENAME']==thread['FILENAME'] )&( records['PHASE']=='S') ]
-        if not s_thread.empty:
-            s_thread = s_thread.squeeze()
+        s_thread = phase_index.find(thread, 'S')
+        if s_thread is not None:
             s_phase = s_thread['ARRIVAL_DATE'] + 'T' + s_thread['ARRIVAL_TIME']
             # UTCDate
             p_time = UTCDateTime(p_phase)
@@ -66,9 +69,8 @@ for ind,thread in records.iterrows():
             sample_generator(st,starttime, endtime, p_time, None)
     if thread['PHASE'] == 'S':
         s_phase = thread['ARRIVAL_DATE'] + 'T' + thread['ARRIVAL_TIME']
-        p_thread = records.loc[(records['FILENAME']==thread['FILENAME'] )&( records['PHASE']=='P') ]
-        if not p_thread.empty:
-            p_thread = p_thread.squeeze()
+        p_thread = phase_index.find(thread, 'P')
+        if p_thread is not None:
             p_phase = p_thread['ARRIVAL_DATE'] + 'T' + _thread['ARRIVAL_TIME']
             # UTCDate
             p_time = UTCDateTime(p_phase)
@@ -95,9 +97,9 @@ for ind,thread in records.iterrows():
 
 #%%
 p_phase = thread['ARRIVAL_DATE'] + 'T' + thread['ARRIVAL_TIME']
-temp = records.loc[records['FILENAME']==thread['FILENAME']]
-if len(temp)>1:
-    s_thread = temp.loc[temp.index(temp['PHASE']=='S').tolist()]
+# files without an S pick are skipped
+s_thread = phase_index.phases(thread).get('S')
+if s_thread is not None:
     s_phase = s_thread['ARRIVAL_DATE'] + 'T' + s_thread['ARRIVAL_TIME']
     print(s_phase)
     
@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+# MIT License
+#
+# Copyright (c) 2021 Hao Mai & Pascal Audet
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""
+Spatial index
+KD-tree over stations and arrivals to select ISC style regions locally.
+@author: Hao Mai & Pascal Audet
+"""
+from __future__ import (absolute_import, division, print_function)
+
+import os
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+from matplotlib.path import Path
+
+EARTH_RADIUS = 6371.0
+# largest distance in degrees between the coordinates of an arrival and the
+# listed coordinates of its station, for a network to be resolved
+NETWORK_TOLERANCE = 0.1
+
+# region shapes selected locally, the others are only resolved by ISC
+LOCAL_SHAPES = (None, '', 'GLOBAL', 'RECT', 'CIRC', 'POLY')
+
+
+def unit_vectors(lat, lon):
+    r"""Points on the unit sphere of latitudes and longitudes in degrees.
+    """
+    lat = np.radians(np.asarray(lat, dtype=float))
+    lon = np.radians(np.asarray(lon, dtype=float))
+    return np.column_stack((np.cos(lat) * np.cos(lon),
+                            np.cos(lat) * np.sin(lon), np.sin(lat)))
+
+
+def _chord(degrees):
+    # straight line distance on the unit sphere of an arc in degrees
+    return 2 * np.sin(np.radians(np.minimum(degrees, 180.0)) / 2)
+
+
+def parse_coordvals(text):
+    r"""Latitudes and longitudes of an ISC `coordvals` polygon string
+    ('lat1,lon1,lat2,lon2,...').
+    """
+    values = [float(value) for value in
+              str(text).replace('[', '').replace(']', '').split(',')
+              if value.strip()]
+    if len(values) < 6 or len(values) % 2:
+        raise ValueError('A polygon needs at least three lat,lon pairs.')
+    return np.array(values[0::2]), np.array(values[1::2])
+
+
+class SpatialIndex():
+    r"""KD-tree of points on the unit sphere.
+    Radius (CIRC), rectangle (RECT) and polygon (POLY) regions are selected
+    locally, in the way ISC evaluates them for a query. Repeated coordinates
+    (e.g. one station in many arrivals) are indexed once; points without
+    coordinates are never selected.
+
+    Parameters
+    ----------
+    lat, lon : array_like
+        Coordinates of the points in degrees.
+    """
+    def __init__(self, lat, lon):
+        lat = np.asarray(lat, dtype=float)
+        lon = np.asarray(lon, dtype=float)
+        valid = np.isfinite(lat) & np.isfinite(lon)
+        points, first, inverse = np.unique(
+            np.column_stack((lat[valid], lon[valid])), axis=0,
+            return_index=True, return_inverse=True)
+        self._length = len(lat)
+        self._points = points.reshape(-1, 2)
+        # row of every point (-1 without coordinates) and first row of every
+        # distinct coordinate
+        self._inverse = np.full(len(lat), -1, dtype=np.intp)
+        self._inverse[valid] = inverse.ravel()
+        self._first = np.flatnonzero(valid)[first]
+        self.tree = cKDTree(unit_vectors(self._points[:, 0],
+                                         self._points[:, 1]))
+
+    @classmethod
+    def from_arrivals(cls, table, origin=False):
+        r"""Index of the stations (or the events with `origin`) of an
+        `ArrivalTable`.
+        """
+        prefix = 'ORIGIN' if origin else 'ARRIVAL'
+        return cls(table[prefix + '_LAT'], table[prefix + '_LON'])
+
+    def __len__(self):
+        return self._length
+
+    def _mask(self, ids):
+        # mask of the points of the distinct coordinates `ids`
+        hit = np.zeros(len(self._points) + 1, dtype=bool)
+        hit[np.asarray(ids, dtype=np.intp)] = True
+        # the extra last slot is read by the points without coordinates
+        return hit[self._inverse]
+
+    def radius(self, lat, lon, radius, units='deg'):
+        r"""Mask of the points within `radius` (great circle distance in
+        degrees, or km with `units`='km') of (lat, lon).
+        """
+        if units == 'km':
+            radius = np.degrees(float(radius) / EARTH_RADIUS)
+        if len(self._points) == 0:
+            return np.zeros(self._length, dtype=bool)
+        center = unit_vectors([lat], [lon])[0]
+        ids = self.tree.query_ball_point(center,
+                                         _chord(float(radius)) * (1 + 1e-12))
+        return self._mask(ids)
+
+    def rect(self, bot, top, left, right):
+        r"""Mask of the points of a latitude/longitude rectangle. A left
+        longitude larger than the right one crosses the antimeridian.
+        """
+        lat, lon = self._points[:, 0], self._points[:, 1]
+        inside = (lat >= bot) & (lat <= top)
+        if left <= right:
+            inside &= (lon >= left) & (lon <= right)
+        else:
+            inside &= (lon >= left) | (lon <= right)
+        return self._mask(np.flatnonzero(inside))
+
+    def polygon(self, lats, lons):
+        r"""Mask of the points inside a polygon of latitudes/longitudes.
+        """
+        lats = np.asarray(lats, dtype=float)
+        lons = np.asarray(lons, dtype=float)
+        lat, lon = self._points[:, 0], self._points[:, 1]
+        ids = np.flatnonzero((lat >= lats.min()) & (lat <= lats.max()) &
+                             (lon >= lons.min()) & (lon <= lons.max()))
+        path = Path(np.column_stack((lons, lats)))
+        inside = path.contains_points(self._points[ids][:, ::-1])
+        return self._mask(ids[inside])
+
+    def nearest(self, lat, lon, k=1):
+        r"""Rows of the `k` nearest distinct coordinates to (lat, lon) and
+        their distances in degrees.
+        """
+        k = min(k, len(self._points))
+        if k == 0:
+            return np.array([], dtype=np.intp), np.array([])
+        chord, ids = self.tree.query(unit_vectors([lat], [lon])[0], k=k)
+        distance = np.degrees(2 * np.arcsin(np.minimum(chord / 2, 1.0)))
+        return self._first[np.atleast_1d(ids)], np.atleast_1d(distance)
+
+    def select(self, params, station=False):
+        r"""Mask of the points in the event region of ISC query `params`
+        (`searchshape`), or in its station region (`stnsearch`) with
+        `station`.
+        """
+        if station:
+            shape = params.get('stnsearch', 'GLOBAL')
+            prefix = 'stn_'
+            units = params.get('max_stn_dist_units', 'deg')
+        else:
+            shape = params.get('searchshape', 'GLOBAL')
+            prefix = ''
+            units = params.get('max_dist_units', 'deg')
+        if shape in (None, '', 'GLOBAL'):
+            return np.ones(self._length, dtype=bool)
+        if shape == 'RECT':
+            return self.rect(float(params[prefix + 'bot_lat']),
+                             float(params[prefix + 'top_lat']),
+                             float(params[prefix + 'left_lon']),
+                             float(params[prefix + 'right_lon']))
+        if shape == 'CIRC':
+            return self.radius(float(params[prefix + 'ctr_lat']),
+                               float(params[prefix + 'ctr_lon']),
+                               float(params[prefix + 'radius']), units)
+        if shape == 'POLY':
+            return self.polygon(*parse_coordvals(params[prefix + 'coordvals']))
+        raise ValueError('{0} regions can only be resolved by ISC.'.format(
+            shape))
+
+
+class StationIndex(SpatialIndex):
+    r"""Spatial index of a station list (by default the global station list
+    static/gmap-stations.txt shipped with QuakeLabeler).
+
+    Parameters
+    ----------
+    stations : pandas.DataFrame
+        Stations with 'Latitude' and 'Longitude' columns (and 'Network',
+        'Station', 'StartTime' and 'EndTime' for `networks`).
+    """
+    def __init__(self, stations):
+        self.stations = stations.reset_index(drop=True)
+        super(StationIndex, self).__init__(self.stations['Latitude'],
+                                           self.stations['Longitude'])
+        # station code -> rows, built on first use
+        self._codes = None
+
+    def rows(self, station):
+        r"""Rows of the stations with the code `station`.
+        """
+        if self._codes is None:
+            self._codes = {}
+            codes = self.stations['Station'].astype(str).str.strip()
+            for row, code in enumerate(codes):
+                self._codes.setdefault(code, []).append(row)
+        return self._codes.get(str(station).strip(), [])
+
+    def __contains__(self, station):
+        return len(self.rows(station)) > 0
+
+    def networks(self, station, lat=None, lon=None, time=None,
+                 tolerance=NETWORK_TOLERANCE):
+        r"""Network codes of the station `station` running at `time` (ISO
+        text, e.g. '2010-01-01T00:00:00'), nearest to (lat, lon) first.
+        Networks farther than `tolerance` degrees from given coordinates
+        are left out.
+        """
+        part = self.stations.iloc[self.rows(station)]
+        if time is not None:
+            start = part['StartTime'].fillna('').astype(str).str.strip()
+            end = part['EndTime'].fillna('').astype(str).str.strip()
+            part = part[(start <= time) & ((end == '') | (time <= end))]
+        try:
+            lat, lon = float(lat), float(lon)
+        except (TypeError, ValueError):
+            distance = np.zeros(len(part))
+        else:
+            chord = np.linalg.norm(unit_vectors(part['Latitude'],
+                                                part['Longitude'])
+                                   - unit_vectors([lat], [lon]), axis=1)
+            distance = np.degrees(2 * np.arcsin(np.minimum(chord / 2, 1.0)))
+        nearest = {}
+        for network, offset in zip(part['Network'].astype(str).str.strip(),
+                                   distance):
+            if offset <= tolerance:
+                nearest[network] = min(offset, nearest.get(network, offset))
+        return sorted(nearest, key=lambda network: (nearest[network], network))
+
+    @classmethod
+    def from_file(cls, path=None):
+        if path is None:
+            path = os.path.join(os.path.dirname(__file__), 'static',
+                                'gmap-stations.txt')
+        stations = pd.read_table(path, sep='|')
+        stations.columns = [name.strip(' #') for name in stations.columns]
+        return cls(stations)
+
+    def region(self, params):
+        r"""Stations in the station region of ISC query `params`.
+        """
+        return self.stations[self.select(params, station=True)]
+
+
+def local_region(params):
+    r"""True when the station and event regions of ISC query `params` can
+    be selected locally (GLOBAL, RECT, CIRC or POLY). FE regions and station
+    lists are only resolved by ISC.
+    """
+    return params.get('stnsearch', 'GLOBAL') in LOCAL_SHAPES and \
+        params.get('searchshape', 'GLOBAL') in LOCAL_SHAPES
+
+
+def select_region(table, params):
+    r"""Arrivals of an `ArrivalTable` in the station region and the event
+    region of ISC query `params`, selected locally.
+    """
+    mask = np.ones(len(table), dtype=bool)
+    if params.get('stnsearch', 'GLOBAL') not in (None, '', 'GLOBAL'):
+        mask &= SpatialIndex.from_arrivals(table).select(params, station=True)
+    if params.get('searchshape', 'GLOBAL') not in (None, '', 'GLOBAL'):
+        mask &= SpatialIndex.from_arrivals(table, origin=True).select(params)
+    return table.filter(mask)
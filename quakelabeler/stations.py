@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+# MIT License
+#
+# Copyright (c) 2021 Hao Mai & Pascal Audet
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""
+Station networks
+Network codes of the stations of a catalog, resolved locally.
+@author: Hao Mai & Pascal Audet
+"""
+from __future__ import (absolute_import, division, print_function)
+
+import os
+import json
+import time
+import logging
+import pandas as pd
+from obspy.core.utcdatetime import UTCDateTime
+from obspy.clients.fdsn.header import FDSNNoDataException
+from .cache import default_cache_dir
+from .spatial import NETWORK_TOLERANCE, StationIndex
+
+LOGGER = logging.getLogger(__name__)
+
+# columns of the station list used to resolve networks
+_COLUMNS = ['Network', 'Station', 'Latitude', 'Longitude', 'StartTime',
+            'EndTime']
+
+
+def _isotime(value):
+    # ISO text of a time, comparable with the epochs of the station list
+    if value is None:
+        return None
+    if isinstance(value, str) and 'T' in value:
+        return value[:19]
+    return UTCDateTime(value).strftime('%Y-%m-%dT%H:%M:%S')
+
+
+class NetworkResolver():
+    r"""Networks of station codes, to request fully qualified channels
+    instead of resolving `network='*'` on the data center (which may also
+    return the same station of several networks).
+    Station codes are looked up in the station list index (see
+    `spatial.StationIndex`), then in an index of the stations missing from
+    it, built from an inventory requested once and kept on disk for `ttl`
+    seconds. A code used by several networks is resolved with the station
+    coordinates and the time of the arrival.
+
+    Parameters
+    ----------
+    index : spatial.StationIndex, optional
+        Station list. The default is static/gmap-stations.txt.
+    cache : str, optional
+        Inventory cache file. The default is
+        ~/.quakelabeler/cache/stations/inventory.json.
+    ttl : float, optional
+        Time to live of the inventory stations in seconds. The default is
+        30 days.
+    tolerance : float, optional
+        Largest distance in degrees between the arrival and station
+        coordinates of a network. The default is `NETWORK_TOLERANCE`.
+    """
+    def __init__(self, index=None, cache=None, ttl=30*24*3600,
+                 tolerance=NETWORK_TOLERANCE):
+        self.index = index if index is not None else StationIndex.from_file()
+        if cache is None:
+            cache = os.path.join(default_cache_dir('stations'),
+                                 'inventory.json')
+        self.cache = cache
+        self.ttl = ttl
+        self.tolerance = tolerance
+        self.inventory = self._load()
+        self._build()
+        # stations already reported without network
+        self._unresolved = set()
+
+    def _load(self):
+        try:
+            with open(self.cache) as fp:
+                inventory = json.load(fp)
+        except (IOError, ValueError):
+            return {}
+        now = time.time()
+        return dict((sta, entry) for sta, entry in inventory.items()
+                    if self.ttl is None or entry['fetched'] + self.ttl >= now)
+
+    def _build(self):
+        # index of the inventory stations
+        rows = [[network, sta, lat, lon, start, end]
+                for sta, entry in self.inventory.items()
+                for network, lat, lon, start, end in entry['epochs']]
+        self.extra = StationIndex(pd.DataFrame(rows, columns=_COLUMNS)) \
+            if rows else None
+
+    def flush(self):
+        r"""Write the inventory stations to disk.
+        """
+        folder = os.path.dirname(self.cache)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        temp = self.cache + '.tmp'
+        with open(temp, 'w') as fp:
+            json.dump(self.inventory, fp)
+        os.replace(temp, self.cache)
+
+    def prefetch(self, client, stations, chunk=200):
+        r"""Request the inventory of the `stations` which are neither in
+        the station list nor in the inventory cache.
+        """
+        missing = sorted(set(str(sta) for sta in stations
+                             if str(sta) not in self.index)
+                         - set(self.inventory))
+        if not missing:
+            return
+        now = time.time()
+        for i in range(0, len(missing), chunk):
+            part = missing[i:i + chunk]
+            try:
+                inventory = client.get_stations(
+                    network='*', station=','.join(part), level='station')
+            except FDSNNoDataException:
+                # unknown to the data center: requested with network '*'
+                inventory = []
+            except Exception as error:
+                # not cached: requested again in the next run
+                LOGGER.warning("Station inventory request failed (%s).",
+                               error)
+                continue
+            found = dict((sta, []) for sta in part)
+            for net in inventory:
+                for sta in net:
+                    found.setdefault(sta.code, []).append(
+                        (net.code, sta.latitude, sta.longitude,
+                         _isotime(sta.start_date), _isotime(sta.end_date)))
+            for sta, epochs in found.items():
+                self.inventory[sta] = {'epochs': epochs, 'fetched': now}
+        self._build()
+        self.flush()
+
+    def networks(self, station, latitude=None, longitude=None, time=None):
+        r"""Network codes of `station` running at `time`, nearest to the
+        arrival coordinates first (see `spatial.StationIndex.networks`).
+        """
+        index = self.index
+        if station not in index:
+            index = self.extra
+        if index is None:
+            return []
+        return index.networks(station, latitude, longitude, _isotime(time),
+                              self.tolerance)
+
+    def network(self, station, latitude=None, longitude=None, time=None,
+                default='*'):
+        r"""Network code of `station` (see `networks`), or `default` if
+        it cannot be resolved.
+        """
+        networks = self.networks(station, latitude, longitude, time)
+        if networks:
+            return networks[0]
+        if station not in self._unresolved:
+            self._unresolved.add(station)
+            LOGGER.warning("No network of station %s within %g degrees of "
+                           "(%s, %s), requesting network '%s'.", station,
+                           self.tolerance, latitude, longitude, default)
+        return default
@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+# MIT License
+#
+# Copyright (c) 2021 Hao Mai & Pascal Audet
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""
+Catalog store
+SQLite database of events, stations, arrivals and samples shared across runs.
+@author: Hao Mai & Pascal Audet
+"""
+from __future__ import (absolute_import, division, print_function)
+
+import os
+import json
+import time
+import sqlite3
+import numpy as np
+import pandas as pd
+from .isc import ARRIVAL_FIELDS
+from .arrivals import ArrivalTable
+
+EVENT_FIELDS = ('EVENTID', 'ORIGIN_LAT', 'ORIGIN_LON', 'ORIGINL_DEPTH',
+                'ORIGIN_DATE', 'ORIGIN_TIME', 'ORIGIN_EPOCH', 'EVENT_TYPE',
+                'EVENT_MAG')
+STATION_FIELDS = ('STA', 'ARRIVAL_LAT', 'ARRIVAL_LON', 'ARRIVAL_ELEV')
+SAMPLE_FIELDS = ('EVENTID', 'STA', 'ISCPHASE', 'ARRIVAL_EPOCH', 'filename',
+                 'arr_point', 'npts', 'sampling_rate', 'pair_phase',
+                 'pair_arr_point')
+# fields of a stored arrival, as in an ArrivalTable with epoch columns
+RECORD_FIELDS = ARRIVAL_FIELDS + ('ARRIVAL_EPOCH', 'ORIGIN_EPOCH')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    EVENTID INTEGER PRIMARY KEY, ORIGIN_LAT REAL, ORIGIN_LON REAL,
+    ORIGINL_DEPTH REAL, ORIGIN_DATE TEXT, ORIGIN_TIME TEXT,
+    ORIGIN_EPOCH REAL, EVENT_TYPE TEXT, EVENT_MAG REAL);
+CREATE INDEX IF NOT EXISTS events_time ON events (ORIGIN_EPOCH);
+CREATE INDEX IF NOT EXISTS events_mag ON events (EVENT_MAG);
+
+CREATE TABLE IF NOT EXISTS stations (
+    STATION_ID INTEGER PRIMARY KEY, STA TEXT, ARRIVAL_LAT REAL,
+    ARRIVAL_LON REAL, ARRIVAL_ELEV REAL);
+CREATE INDEX IF NOT EXISTS stations_sta ON stations (STA);
+
+CREATE TABLE IF NOT EXISTS arrivals (
+    ARRIVAL_ID INTEGER PRIMARY KEY, EVENTID INTEGER, STATION_ID INTEGER,
+    CHN TEXT, ISCPHASE TEXT, REPPHASE TEXT, ARRIVAL_DIST REAL,
+    ARRIVAL_BAZ REAL, ARRIVAL_DATE TEXT, ARRIVAL_TIME TEXT,
+    ARRIVAL_EPOCH REAL,
+    UNIQUE (EVENTID, STATION_ID, CHN, ISCPHASE, REPPHASE, ARRIVAL_DATE,
+            ARRIVAL_TIME));
+CREATE INDEX IF NOT EXISTS arrivals_time ON arrivals (ARRIVAL_EPOCH);
+CREATE INDEX IF NOT EXISTS arrivals_station ON arrivals (STATION_ID);
+
+CREATE TABLE IF NOT EXISTS queries (
+    NAME TEXT PRIMARY KEY, PARAMS TEXT, CREATED REAL);
+CREATE TABLE IF NOT EXISTS query_arrivals (
+    NAME TEXT, ARRIVAL_ID INTEGER, PRIMARY KEY (NAME, ARRIVAL_ID))
+    WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS samples (
+    DATASET TEXT, filename TEXT, EVENTID INTEGER, STA TEXT, ISCPHASE TEXT,
+    ARRIVAL_EPOCH REAL, arr_point REAL, npts INTEGER, sampling_rate REAL,
+    pair_phase TEXT, pair_arr_point REAL, CREATED REAL,
+    PRIMARY KEY (DATASET, filename));
+CREATE INDEX IF NOT EXISTS samples_event ON samples (EVENTID, STA);
+
+CREATE VIEW IF NOT EXISTS records AS
+    SELECT a.ARRIVAL_ID, a.EVENTID, s.STA, a.CHN, a.ISCPHASE, a.REPPHASE,
+           s.ARRIVAL_LAT, s.ARRIVAL_LON, s.ARRIVAL_ELEV, a.ARRIVAL_DIST,
+           a.ARRIVAL_BAZ, a.ARRIVAL_DATE, a.ARRIVAL_TIME, e.ORIGIN_LAT,
+           e.ORIGIN_LON, e.ORIGINL_DEPTH, e.ORIGIN_DATE, e.ORIGIN_TIME,
+           e.EVENT_TYPE, e.EVENT_MAG, a.ARRIVAL_EPOCH, e.ORIGIN_EPOCH
+    FROM arrivals a JOIN events e ON a.EVENTID = e.EVENTID
+    JOIN stations s ON a.STATION_ID = s.STATION_ID;
+"""
+
+
+def default_store_path():
+    r"""Catalog database $QUAKELABELER_STORE or ~/.quakelabeler/catalog.sqlite.
+    """
+    return os.environ.get('QUAKELABELER_STORE',
+                          os.path.join(os.path.expanduser('~'),
+                                       '.quakelabeler', 'catalog.sqlite'))
+
+
+def _rows(table, fields):
+    # rows of sqlite values (None for missing or NaN values)
+    columns = []
+    for name in fields:
+        if name not in table:
+            columns.append([None] * len(table))
+            continue
+        values = table[name]
+        if values.dtype.kind == 'f':
+            values = np.where(np.isnan(values), None, values.astype(object))
+        columns.append(values.tolist())
+    return zip(*columns)
+
+
+class CatalogStore():
+    r"""Persistent catalog database shared across runs.
+    Arrivals of every query (ISC query, benchmark) are stored once in
+    normalized events, stations and arrivals tables, indexed on time,
+    station, event and magnitude, and linked to the query names
+    (e.g. 'recordings42'). Produced samples are stored per dataset. Later
+    runs, map generation and metadata merging then read indexed queries
+    instead of the CSV folders.
+
+    Parameters
+    ----------
+    path : str, optional
+        SQLite file. The default is ~/.quakelabeler/catalog.sqlite.
+    """
+    def __init__(self, path=None):
+        self.path = path or default_store_path()
+        folder = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        self.connection = sqlite3.connect(self.path)
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def queries(self):
+        r"""Names of the stored queries.
+        """
+        return [name for (name,) in
+                self.connection.execute('SELECT NAME FROM queries')]
+
+    def __contains__(self, name):
+        return self.connection.execute(
+            'SELECT 1 FROM queries WHERE NAME = ?', (name,)).fetchone() \
+            is not None
+
+    def _station_ids(self, table):
+        # station ids of the arrivals, inserting new stations
+        known = {}
+        for row in self.connection.execute(
+                'SELECT STATION_ID, STA, ARRIVAL_LAT, ARRIVAL_LON, '
+                'ARRIVAL_ELEV FROM stations'):
+            known[row[1:]] = row[0]
+        ids = []
+        for key in _rows(table, STATION_FIELDS):
+            station = known.get(key)
+            if station is None:
+                station = known[key] = self.connection.execute(
+                    'INSERT INTO stations (STA, ARRIVAL_LAT, ARRIVAL_LON, '
+                    'ARRIVAL_ELEV) VALUES (?, ?, ?, ?)', key).lastrowid
+            ids.append(station)
+        return ids
+
+    def add_arrivals(self, table, name, params=None):
+        r"""Store the arrivals of query `name` (an `ArrivalTable` with epoch
+        columns). Arrivals and events already stored are not duplicated.
+        """
+        fields = ('EVENTID', 'CHN', 'ISCPHASE', 'REPPHASE', 'ARRIVAL_DIST',
+                  'ARRIVAL_BAZ', 'ARRIVAL_DATE', 'ARRIVAL_TIME',
+                  'ARRIVAL_EPOCH')
+        # one row per event (its arrivals repeat it)
+        events = dict((row[0], row) for row in _rows(table, EVENT_FIELDS))
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO events VALUES (?, ?, ?, ?, ?, ?, ?, '
+                '?, ?)', events.values())
+            stations = self._station_ids(table)
+            self.connection.execute(
+                'CREATE TEMP TABLE IF NOT EXISTS new_arrivals (STATION_ID '
+                'INTEGER, {0})'.format(', '.join(fields)))
+            self.connection.execute('DELETE FROM new_arrivals')
+            self.connection.executemany(
+                'INSERT INTO new_arrivals VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, '
+                '?)', ((station,) + row for station, row in
+                       zip(stations, _rows(table, fields))))
+            columns = ', '.join(('STATION_ID',) + fields)
+            self.connection.execute(
+                'INSERT OR IGNORE INTO arrivals ({0}) SELECT {0} FROM '
+                'new_arrivals'.format(columns))
+            self.connection.execute(
+                'INSERT OR REPLACE INTO queries VALUES (?, ?, ?)',
+                (name, json.dumps(params or {}, sort_keys=True),
+                 time.time()))
+            self.connection.execute(
+                'INSERT OR IGNORE INTO query_arrivals SELECT ?, a.ARRIVAL_ID '
+                'FROM new_arrivals n JOIN arrivals a ON '
+                'a.EVENTID = n.EVENTID AND a.STATION_ID = n.STATION_ID AND '
+                'a.CHN IS n.CHN AND a.ISCPHASE IS n.ISCPHASE AND '
+                'a.REPPHASE IS n.REPPHASE AND '
+                'a.ARRIVAL_DATE IS n.ARRIVAL_DATE AND '
+                'a.ARRIVAL_TIME IS n.ARRIVAL_TIME', (name,))
+            self.connection.execute('DELETE FROM new_arrivals')
+
+    def _where(self, name=None, start=None, end=None, sta=None, eventid=None,
+               min_mag=None, max_mag=None):
+        clauses = []
+        args = []
+        if name is not None:
+            clauses.append('ARRIVAL_ID IN (SELECT ARRIVAL_ID FROM '
+                           'query_arrivals WHERE NAME = ?)')
+            args.append(name)
+        for clause, value in (('ORIGIN_EPOCH >= ?', start),
+                              ('ORIGIN_EPOCH <= ?', end),
+                              ('STA = ?', sta), ('EVENTID = ?', eventid),
+                              ('EVENT_MAG >= ?', min_mag),
+                              ('EVENT_MAG <= ?', max_mag)):
+            if value is not None:
+                clauses.append(clause)
+                args.append(value)
+        where = ' WHERE ' + ' AND '.join(clauses) if clauses else ''
+        return where, args
+
+    def frame(self, distinct=None, **conditions):
+        r"""Stored arrivals as a pandas.DataFrame. `conditions` are the
+        query `name`, origin time range (`start`, `end` in POSIX seconds),
+        `sta`, `eventid` and magnitude limits (`min_mag`, `max_mag`). With
+        `distinct` (e.g. 'EVENTID'), only the first stored arrival of each
+        value is returned.
+        """
+        where, args = self._where(**conditions)
+        if distinct:
+            where = ' WHERE ARRIVAL_ID IN (SELECT MIN(ARRIVAL_ID) FROM ' \
+                'records{0} GROUP BY {1})'.format(where, distinct)
+        return pd.read_sql_query(
+            'SELECT {0} FROM records{1} ORDER BY ARRIVAL_ID'.format(
+                ', '.join(RECORD_FIELDS), where),
+            self.connection, params=args)
+
+    def arrivals(self, **conditions):
+        r"""Stored arrivals as an `ArrivalTable` (see `frame`).
+        """
+        data = self.frame(**conditions)
+        if len(data) == 0:
+            return ArrivalTable.from_records([], RECORD_FIELDS)
+        return ArrivalTable.from_dataframe(data)
+
+    def stations(self, name=None):
+        r"""Stations recorded by query `name` (or by every query).
+        """
+        where, args = self._where(name=name)
+        return pd.read_sql_query(
+            'SELECT * FROM stations WHERE STATION_ID IN (SELECT STATION_ID '
+            'FROM arrivals{0})'.format(where), self.connection, params=args)
+
+    def add_samples(self, dataset, samples):
+        r"""Store the produced samples (dicts of
+        `QuakeLabeler.available_samples`) of `dataset`.
+        """
+        now = time.time()
+        rows = [tuple([dataset] + [sample.get(field) for field in
+                                   SAMPLE_FIELDS] + [now])
+                for sample in samples]
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO samples (DATASET, {0}, CREATED) '
+                'VALUES ({1})'.format(', '.join(SAMPLE_FIELDS),
+                                      ', '.join('?' * (len(SAMPLE_FIELDS)
+                                                       + 2))), rows)
+
+    def samples(self, dataset=None):
+        r"""Stored samples (of one `dataset`) as a pandas.DataFrame.
+        """
+        if dataset is None:
+            return pd.read_sql_query('SELECT * FROM samples', self.connection)
+        return pd.read_sql_query('SELECT * FROM samples WHERE DATASET = ?',
+                                 self.connection, params=(dataset,))
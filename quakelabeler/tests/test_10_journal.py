@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+# MIT License
+#
+# Copyright (c) 2021 Hao Mai & Pascal Audet
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import os
+import numpy as np
+import pytest
+from obspy import UTCDateTime, Stream, Trace
+from quakelabeler.arrivals import ArrivalTable
+from quakelabeler.classes import QuakeLabeler, REQUEST_FAILED
+from quakelabeler.journal import SampleJournal
+
+def test_journal(tmp_path):
+	path = str(tmp_path / 'journal.jsonl')
+	journal = SampleJournal(path)
+	journal.attempted('1|A|P')
+	journal.done('1|A|P', [{'filename': 'CN.A', 'arr_point': np.float64(10.5), 'pair_arr_point': np.nan}])
+	journal.failed('2|A|P')
+	journal.failed('3|A|P', transient=True)
+	journal.attempted('4|A|P')
+	journal.close()
+	# a write interrupted by a crash
+	with open(path, 'a') as fp:
+		fp.write('{"key": "5|A|P", "sta')
+	journal = SampleJournal(path, resume=True)
+	assert journal.samples() == [{'filename': 'CN.A', 'arr_point': 10.5, 'pair_arr_point': None}]
+	assert journal.records['1|A|P']['files'] == ['CN.A']
+	assert [journal.pending('%d|A|P' % i) for i in range(1, 6)] == [False, False, True, True, True]
+	journal.close()
+	# without resume the journal starts again
+	assert SampleJournal(path).samples() == []
+
+class Labeler(QuakeLabeler):
+	def __init__(self, stop=None):
+		self.custom_dataset = {'volume': 'MAX', 'fixed_length': False}
+		self.custom_waveform = {'label_type': True}
+		self.custom_export = {'export_filename': 'Dataset', 'export_type': 'NPZ',
+			'single_trace': False, 'export_inout': False, 'export_arrival_csv': True}
+		self.store = None
+		self.stop = stop
+		self.requested = []
+	def plan_windows(self, clientname="IRIS", stations=()):
+		self.availability = type('Availability', (), {'skipped': 0})()
+	def iter_waveforms(self, records, *args, **kwargs):
+		for thread in records:
+			if thread['EVENTID'] == self.stop:
+				raise KeyboardInterrupt
+			self.requested.append(thread['EVENTID'])
+			if thread['EVENTID'] == 3:
+				yield thread, REQUEST_FAILED
+				continue
+			trace = Trace(np.zeros(100))
+			trace.stats.network, trace.stats.station, trace.stats.channel = 'CN', thread['STA'], 'BHZ'
+			trace.stats.starttime = UTCDateTime(thread['ARRIVAL_EPOCH']) - 10
+			self.eventtime = UTCDateTime(thread['ARRIVAL_EPOCH'])
+			yield thread, self.accept_waveform(Stream([trace]))
+
+def make_records():
+	return ArrivalTable.from_records([{'EVENTID': i, 'STA': 'S%d' % i, 'ISCPHASE': 'P',
+		'ARRIVAL_EPOCH': 1262304000.0 + 600 * i} for i in range(1, 6)])
+
+def test_resume(tmp_path, monkeypatch):
+	monkeypatch.chdir(tmp_path)
+	labeler = Labeler(stop=4)
+	with pytest.raises(KeyboardInterrupt):
+		labeler.fetch_all_waveforms(make_records())
+	# the samples before the interruption are in the CSV
+	assert os.getcwd() == str(tmp_path)
+	with open('Dataset_features.csv') as fp:
+		assert len(fp.readlines()) == 3
+	labeler = Labeler()
+	labeler.fetch_all_waveforms(make_records(), resume=True)
+	# done records are kept, the failed request is retried
+	assert labeler.requested == [3, 4, 5]
+	assert [sample['EVENTID'] for sample in labeler.available_samples] == [1, 2, 4, 5]
+	assert len(os.listdir('Dataset')) == 5
+
+def test_extend(tmp_path, monkeypatch):
+	monkeypatch.chdir(tmp_path)
+	labeler = Labeler()
+	labeler.custom_dataset['volume'] = 2
+	labeler.fetch_all_waveforms(make_records())
+	labeler.csv_writer()
+	assert labeler.requested == [1, 2]
+	# a larger volume only requests and appends the new samples
+	labeler = Labeler()
+	labeler.fetch_all_waveforms(make_records(), extend=True)
+	labeler.csv_writer()
+	assert labeler.requested == [3, 4, 5]
+	with open('Dataset_features.csv') as fp:
+		lines = fp.readlines()
+	assert len(lines) == 5
+	# datasets without a journal are read from their features CSV
+	os.remove(os.path.join('Dataset', 'journal.jsonl'))
+	labeler = Labeler()
+	labeler.fetch_all_waveforms(make_records(), extend=True)
+	labeler.csv_writer()
+	assert labeler.requested == [3]
+	with open('Dataset_features.csv') as fp:
+		assert len(fp.readlines()) == 5
+
+def test_extend_split_dataset(tmp_path, monkeypatch):
+	monkeypatch.chdir(tmp_path)
+	labeler = Labeler()
+	labeler.fetch_all_waveforms(make_records())
+	labeler.csv_writer()
+	labeler.subfolder()
+	assert os.path.exists(os.path.join('Dataset', 'journal.jsonl'))
+	# the samples were moved to the sub-sets: refused, nothing requested
+	labeler = Labeler()
+	with pytest.raises(ValueError):
+		labeler.fetch_all_waveforms(make_records(), extend=True)
+	assert labeler.requested == []
+	assert os.getcwd() == str(tmp_path)
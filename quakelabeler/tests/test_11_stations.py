@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+# MIT License
+#
+# Copyright (c) 2021 Hao Mai & Pascal Audet
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+from obspy import UTCDateTime
+from obspy.core.inventory import Inventory, Network, Station
+from obspy.clients.fdsn.header import FDSNNoDataException
+from quakelabeler.spatial import StationIndex
+from quakelabeler.stations import NetworkResolver
+
+STATIONS = """#Network | Station | Latitude | Longitude | Elevation | Sitename | StartTime | EndTime
+IU|ANMO|34.9459|-106.4572|1850.0|Albuquerque|1989-08-29T00:00:00|2599-12-31T23:59:59
+SR|ANMO|34.946201|-106.456703|1740.0|Albuquerque|1974-08-28T00:00:00|1989-08-30T00:00:00
+AC|SRN|41.2|19.8|100.0|Albania|2009-12-22T00:00:00|2599-12-31T23:59:59
+CI|SRN|33.8|-117.8|100.0|California|2000-01-01T00:00:00|2599-12-31T23:59:59
+"""
+
+class FakeClient():
+	def __init__(self):
+		self.requests = []
+	def get_stations(self, network, station, **kwargs):
+		self.requests.append(station)
+		if 'NEW' not in station:
+			raise FDSNNoDataException('No data')
+		return Inventory([Network('XX', stations=[Station('NEW', 10.0, 20.0, 0.0,
+			start_date=UTCDateTime(2015, 1, 1))])], 'test')
+
+def make_index(tmp_path):
+	path = tmp_path / 'stations.txt'
+	path.write_text(STATIONS)
+	return NetworkResolver(StationIndex.from_file(str(path)), cache=str(tmp_path / 'inventory.json'))
+
+def test_station_index(tmp_path):
+	index = make_index(tmp_path)
+	# station epochs and arrival coordinates pick the network
+	assert index.network('ANMO', 34.95, -106.46, UTCDateTime(2010, 1, 1)) == 'IU'
+	assert index.network('ANMO', 34.95, -106.46, UTCDateTime(1980, 1, 1).timestamp) == 'SR'
+	assert index.networks('SRN') == ['AC', 'CI']
+	assert index.network('SRN', 33.81, -117.79) == 'CI'
+	assert index.network('SRN', '41.2', '19.8', '2010-01-01T00:00:00') == 'AC'
+	# unknown stations and coordinates keep the wildcard
+	assert index.network('SRN', 0.0, 0.0) == '*'
+	assert index.network('XYZ') == '*'
+
+def test_station_inventory(tmp_path):
+	index = make_index(tmp_path)
+	client = FakeClient()
+	index.prefetch(client, ['ANMO', 'NEW', 'OLD'])
+	# only the stations missing from the station list are requested
+	assert client.requests == ['NEW,OLD']
+	assert index.network('NEW', 10.0, 20.0, UTCDateTime(2020, 1, 1)) == 'XX'
+	assert index.network('OLD') == '*'
+	# the inventory is kept on disk
+	index = make_index(tmp_path)
+	index.prefetch(client, ['NEW', 'OLD'])
+	assert client.requests == ['NEW,OLD']
+	assert index.network('NEW', 10.0, 20.0) == 'XX'
+
+def test_station_list(tmp_path):
+	index = NetworkResolver(cache=str(tmp_path / 'inventory.json'))
+	assert index.network('ANMO', 34.94591, -106.4572, UTCDateTime(2010, 1, 1)) == 'IU'
+
+def test_unresolved_warning(tmp_path, caplog):
+	index = make_index(tmp_path)
+	with caplog.at_level('WARNING', logger='quakelabeler.stations'):
+		assert index.network('SRN', 0.0, 0.0) == '*'
+		assert index.network('SRN', 0.0, 0.0) == '*'
+	# the wildcard fallback is reported once per station
+	assert len([record for record in caplog.records if 'SRN' in record.getMessage()]) == 1
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+# MIT License
+#
+# Copyright (c) 2021 Hao Mai & Pascal Audet
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import math
+from quakelabeler.isc import ArrivalParser, ARRIVAL_FIELDS
+
+# ISC arrivals page (web-db-v4 layout), trimmed to two rows
+page_v4 = """<pre>
+  EVENTID,REPORTER,STA  ,LAT     ,LON      ,ELEV  ,CHN,DIST  ,BAZ  ,ISCPHASE,REPPHASE,ARRIVAL_DATE,ARRIVAL_TIME,RES ,TDEF,AMPLITUDE,PER,AMP_TYPE,ORIGIN_DATE,ORIGIN_TIME,ORIGIN_LAT,ORIGIN_LON,ORIGIN_DEPTH,AUTHOR,EVENT_TYPE,MAG 
+  15916123,ISC     ,LLLB ,50.6090 ,-121.8815,  190.0,BHZ, 2.31 ,220.1,Pn      ,P       ,2010-09-07  ,01:23:45.12 , 0.3,T   ,         ,   ,        ,2010-09-07 ,01:23:10.00,48.7000   ,-123.1000 ,  25.0      ,ISC   ,ke        ,3.4
+  15916123,ISC     ,PHC  ,50.7069 ,-127.4314,   15.0,   , 3.20 ,310.5,Sn      ,S       ,2010-09-07  ,01:24:05.50 ,-0.4,T   ,         ,   ,        ,2010-09-07 ,01:23:10.00,48.7000   ,-123.1000 ,            ,ISC   ,ke        ,
+STOP
+</pre>"""
+
+# newer web-db-run layout with an extra column and shared LAT/LON names
+page_run = """<pre>
+EVENTID,REPORTER,PICKID,STA,LAT,LON,ELEV,CHN,DIST,BAZ,ISCPHASE,REPPHASE,DATE,TIME,RES,TDEF,AMPLITUDE,PER,AMP_TYPE,DATE,TIME,LAT,LON,DEPTH,AUTHOR,ETYPE,MAG
+600516598,ISC,1,NLWA,47.3920,-123.8690,278.0,BHZ,0.71,212.7,Pg,P,2010-09-07,01:23:21.40,0.1,T,,,,2010-09-07,01:23:10.00,48.7000,-123.1000,25.0,ISC,ke,3.4
+Agencies whose data contributed to this bulletin
+</pre>"""
+
+no_data_page = "<p>No phase data was found.</p>"
+
+def test_parse_v4_header():
+	parser = ArrivalParser(ARRIVAL_FIELDS)
+	records = list(parser.parse(page_v4.splitlines()))
+	assert len(records) == 2
+	assert records[0]['EVENTID'] == 15916123
+	assert records[0]['STA'] == 'LLLB'
+	assert records[0]['ISCPHASE'] == 'Pn'
+	assert records[0]['ARRIVAL_TIME'] == '01:23:45.12'
+	assert records[0]['ORIGIN_LAT'] == 48.7
+	assert records[0]['EVENT_MAG'] == 3.4
+	assert math.isnan(records[1]['ORIGINL_DEPTH'])
+	assert math.isnan(records[1]['EVENT_MAG'])
+	assert parser.finished
+
+def test_parse_run_header():
+	parser = ArrivalParser(ARRIVAL_FIELDS)
+	records = list(parser.parse(page_run.splitlines()))
+	assert len(records) == 1
+	assert records[0]['STA'] == 'NLWA'
+	assert records[0]['ARRIVAL_LAT'] == 47.392
+	assert records[0]['ORIGIN_LAT'] == 48.7
+	assert records[0]['ARRIVAL_DATE'] == '2010-09-07'
+	assert records[0]['ORIGIN_TIME'] == '01:23:10.00'
+	assert records[0]['EVENT_TYPE'] == 'ke'
+
+def test_parse_no_data():
+	parser = ArrivalParser(ARRIVAL_FIELDS)
+	assert list(parser.parse([no_data_page])) == []
+	assert parser.no_data
+
+from datetime import datetime
+import quakelabeler.isc as isc
+
+query_params = {'request':'STNARRIVALS', 'out_format':'CSV',
+	'stnsearch':'RECT', 'stn_bot_lat':'40.00', 'stn_top_lat':'55.00',
+	'stn_left_lon':'-130.00', 'stn_right_lon':'-120.00',
+	'start_year':'2010', 'start_month':'1', 'start_day':'1', 'start_time':'00:00:00',
+	'end_year':'2010', 'end_month':'3', 'end_day':'1', 'end_time':'00:00:00'}
+
+header_v4 = page_v4.splitlines()[1]
+row_v4 = page_v4.splitlines()[2]
+
+def fake_stream(rows_per_tile):
+	# fake ISC service: one row per event day in the tile, overflowing
+	# tiles longer than 10 days
+	def stream_lines(url, params, **kwargs):
+		start = isc.param_time(params, 'start')
+		end = isc.param_time(params, 'end')
+		yield '<pre>'
+		yield header_v4
+		days = (end - start).days
+		for i in range(rows_per_tile if days > 10 else days + 1):
+			yield row_v4.replace('15916123', str(start.toordinal() + i), 1)
+		yield 'STOP'
+	return stream_lines
+
+def test_planner_tiles():
+	planner = isc.QueryPlanner('url', query_params, tile_days=31)
+	tiles = planner.plan()
+	assert len(tiles) == 2
+	assert tiles[0].start == datetime(2010, 1, 1)
+	assert tiles[1].end == datetime(2010, 3, 1)
+	assert tiles[1].params['start_month'] == '2'
+	halves = planner.split(tiles[0])
+	assert halves[0].end == halves[1].start
+
+def test_planner_space_split():
+	planner = isc.QueryPlanner('url', query_params, min_span=isc.timedelta(days=365))
+	tile = planner.plan()[0]
+	halves = planner.split(tile)
+	# the longer side (latitude) is halved
+	assert halves[0].params['stn_top_lat'] == '47.5000'
+	assert halves[1].params['stn_bot_lat'] == '47.5000'
+	assert halves[1].params['stn_left_lon'] == '-130.0000'
+
+def test_planner_run(monkeypatch):
+	monkeypatch.setattr(isc, 'stream_lines', fake_stream(100))
+	planner = isc.QueryPlanner('url', query_params, tile_days=31,
+		max_rows=50, delay=0, min_span=isc.timedelta(days=1))
+	records = planner.run()
+	eventids = [record['EVENTID'] for record in records]
+	# one arrival per day (boundaries are deduplicated) in time order
+	assert eventids == sorted(set(eventids))
+	assert len(eventids) == (datetime(2010, 3, 1) - datetime(2010, 1, 1)).days + 1
+
+def test_query_failure_reported(monkeypatch, capsys):
+	import requests
+	from quakelabeler.classes import QueryArrival
+	def run(self):
+		raise requests.exceptions.Timeout('ISC did not answer')
+	monkeypatch.setattr(isc.QueryPlanner, 'run', run)
+	# a failed query is reported, not raised
+	query = QueryArrival(**query_params)
+	assert 'Request failed' in capsys.readouterr().out
+	assert not hasattr(query, 'arrival_recordings')
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+# MIT License
+#
+# Copyright (c) 2021 Hao Mai & Pascal Audet
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import quakelabeler.isc as isc
+import numpy as np
+from obspy import UTCDateTime, Stream, Trace
+from quakelabeler.cache import QueryCache, WaveformCache, canonical_params
+from quakelabeler.tests.test_2_isc import query_params, fake_stream
+
+def make_record(eventid, date, clock):
+	return {'EVENTID': eventid, 'STA': 'LLLB', 'ISCPHASE': 'P',
+		'ORIGIN_DATE': date, 'ORIGIN_TIME': clock}
+
+def with_time(params, start, end):
+	params = dict(params)
+	isc.set_param_time(params, 'start', start)
+	isc.set_param_time(params, 'end', end)
+	return params
+
+def test_canonical_params():
+	a = canonical_params({'stn_bot_lat': '40.00', 'min_mag': '3'})
+	b = canonical_params({'min_mag': 3.0, 'stn_bot_lat': ' 40 '})
+	assert a == b
+
+def test_exact_and_covered_hits(tmp_path):
+	cache = QueryCache(str(tmp_path))
+	first = with_time(query_params, isc.datetime(2010, 1, 1), isc.datetime(2010, 2, 1))
+	second = with_time(query_params, isc.datetime(2010, 2, 1), isc.datetime(2010, 3, 1))
+	cache.put(first, [make_record(1, '2010-01-05', '10:00:00.00')])
+	cache.put(second, [make_record(2, '2010-02-05', '10:00:00.00')])
+	assert cache.get(first)[0]['EVENTID'] == 1
+	# a new cache instance reads the same folder
+	cache = QueryCache(str(tmp_path))
+	inside = with_time(query_params, isc.datetime(2010, 1, 3), isc.datetime(2010, 2, 10))
+	assert [r['EVENTID'] for r in cache.get(inside)] == [1, 2]
+	outside = with_time(query_params, isc.datetime(2010, 1, 3), isc.datetime(2010, 4, 1))
+	assert cache.get(outside) is None
+	other = dict(inside, min_mag='5.0')
+	assert cache.get(other) is None
+
+def test_ttl_and_eviction(tmp_path):
+	cache = QueryCache(str(tmp_path), ttl=60)
+	params = with_time(query_params, isc.datetime(2010, 1, 1), isc.datetime(2010, 2, 1))
+	cache.put(params, [make_record(1, '2010-01-05', '10:00:00')])
+	cache.index[cache.key(params)]['created'] -= 120
+	assert cache.get(params) is None
+	cache = QueryCache(str(tmp_path), max_bytes=1)
+	cache.put(params, [make_record(1, '2010-01-05', '10:00:00')])
+	assert cache.size() <= 1
+
+def test_planner_uses_cache(tmp_path, monkeypatch):
+	monkeypatch.setattr(isc, 'stream_lines', fake_stream(100))
+	cache = QueryCache(str(tmp_path))
+	planner = isc.QueryPlanner('url', query_params, max_rows=50, delay=0,
+		min_span=isc.timedelta(days=1), cache=cache)
+	records = planner.run()
+	def offline(*args, **kwargs):
+		raise AssertionError('cached query went online')
+	monkeypatch.setattr(isc, 'stream_lines', offline)
+	planner = isc.QueryPlanner('url', query_params, max_rows=50, delay=0,
+		cache=QueryCache(str(tmp_path)))
+	assert planner.run().to_dataframe().equals(records.to_dataframe())
+
+def make_stream(station, start, npts=600):
+	trace = Trace(np.arange(npts, dtype=np.int32))
+	trace.stats.network = 'CN'
+	trace.stats.station = station
+	trace.stats.channel = 'BHZ'
+	trace.stats.sampling_rate = 10.0
+	trace.stats.starttime = UTCDateTime(start)
+	return Stream([trace])
+
+def test_waveform_cache(tmp_path):
+	cache = WaveformCache(str(tmp_path))
+	start = UTCDateTime('2010-01-01')
+	window = ('CN', 'LLLB', '*', 'BH?', start, start + 60)
+	assert cache.get(window) is None
+	cache.put(window, make_stream('LLLB', start))
+	cache.close()
+	# a window inside the cached span is read back from disk
+	cache = WaveformCache(str(tmp_path))
+	st = cache.get(('CN', 'LLLB', '*', 'BH?', start + 10, start + 20))
+	assert st[0].stats.starttime == start + 10
+	assert list(st[0].data[:3]) == [100, 101, 102]
+	assert cache.get(('CN', 'LLLB', '*', 'BH?', start + 10, start + 70)) is None
+	assert cache.get(('CN', 'PGC', '*', 'BH?', start + 10, start + 20)) is None
+	assert (cache.hits, cache.misses) == (1, 2)
+
+def test_waveform_cache_eviction(tmp_path):
+	cache = WaveformCache(str(tmp_path))
+	start = UTCDateTime('2010-01-01')
+	for i, station in enumerate(['A', 'B', 'C']):
+		cache.put(('CN', station, '*', 'BH?', start, start + 60), make_stream(station, start))
+		cache.index[cache.key(('CN', station, '*', 'BH?', start, start + 60))]['used'] = i
+	# B was used last: A is evicted first
+	cache.get(('CN', 'A', '*', 'BH?', start, start + 10))
+	cache.max_bytes = cache.size() - 1
+	cache.prune()
+	assert cache.get(('CN', 'B', '*', 'BH?', start, start + 10)) is None
+	assert cache.get(('CN', 'A', '*', 'BH?', start, start + 10)) is not None
+	assert len(list(tmp_path.glob('*.mseed'))) == 2
+
+def test_waveform_cache_sync(tmp_path):
+	cache = WaveformCache(str(tmp_path), sync_every=3)
+	start = UTCDateTime('2010-01-01')
+	windows = [('CN', station, '*', 'BH?', start, start + 60) for station in 'ABCD']
+	for window in windows[:2]:
+		cache.put(window, make_stream(window[1], start))
+	# the index is not rewritten for every window
+	assert not (tmp_path / 'index.json').exists()
+	cache.put(windows[2], make_stream('C', start))
+	assert len(WaveformCache(str(tmp_path)).index) == 3
+	cache.put(windows[3], make_stream('D', start))
+	cache.max_bytes = cache.size() - 1
+	cache.close()
+	# pruned and written on close
+	assert len(WaveformCache(str(tmp_path)).index) == 3
+	assert cache.size() == sum(entry['size'] for entry in cache.index.values())
+
+def test_waveform_cache_orphans(tmp_path):
+	cache = WaveformCache(str(tmp_path), sync_every=2)
+	start = UTCDateTime('2010-01-01')
+	windows = [('CN', station, '*', 'BH?', start, start + 60) for station in 'ABC']
+	for window in windows:
+		cache.put(window, make_stream(window[1], start))
+	(tmp_path / (cache.key(windows[0]) + '.mseed.1.tmp')).write_bytes(b'partial')
+	# killed before the third window was indexed
+	cache = WaveformCache(str(tmp_path))
+	assert sorted(path.name for path in tmp_path.iterdir()) == \
+		sorted(['index.json'] + [cache.key(window) + '.mseed' for window in windows[:2]])
+	assert cache.size() == sum(entry['size'] for entry in cache.index.values())
+	assert cache.get(windows[2]) is None
+	assert len(cache.get(windows[0])) == 1
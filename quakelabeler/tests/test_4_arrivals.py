@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+# MIT License
+#
+# Copyright (c) 2021 Hao Mai & Pascal Audet
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import numpy as np
+import pandas as pd
+from obspy import UTCDateTime
+from quakelabeler.arrivals import ArrivalTable, PhaseIndex, arrival_epoch
+
+def make_records():
+	return [
+		{'EVENTID': 2, 'STA': 'LLLB', 'ISCPHASE': 'S', 'ARRIVAL_TIME': '10:00:05.10', 'DIST': 1.5},
+		{'EVENTID': 1, 'STA': 'PGC', 'ISCPHASE': 'P', 'ARRIVAL_TIME': '09:00:01.00', 'DIST': 0.8},
+		{'EVENTID': 2, 'STA': 'LLLB', 'ISCPHASE': 'P', 'ARRIVAL_TIME': '10:00:01.20', 'DIST': 1.5},
+		{'EVENTID': 2, 'STA': 'LLLB', 'ISCPHASE': 'P', 'ARRIVAL_TIME': '10:00:01.20', 'DIST': 1.5}]
+
+def test_columns_and_rows():
+	table = ArrivalTable.from_records(make_records())
+	assert len(table) == 4
+	assert table.is_categorical('STA')
+	assert table.codes('STA').dtype == np.int32
+	assert list(table.categories('STA')) == ['LLLB', 'PGC']
+	assert table['EVENTID'].dtype.kind == 'i'
+	assert table[1].copy() == make_records()[1]
+	assert [row['STA'] for row in table] == ['LLLB', 'PGC', 'LLLB', 'LLLB']
+
+def test_filter_sort_group():
+	table = ArrivalTable.from_records(make_records())
+	assert len(table.filter(STA='LLLB', ISCPHASE='P')) == 2
+	assert list(table.sort('EVENTID', 'ARRIVAL_TIME')['ISCPHASE']) == ['P', 'P', 'P', 'S']
+	groups = table.groupby('EVENTID', 'STA')
+	assert sorted(len(index) for index in groups.values()) == [1, 3]
+	assert len(table.drop_duplicates()) == 3
+
+def test_concat_and_dataframe():
+	records = make_records()
+	table = ArrivalTable.concat([ArrivalTable.from_records(records[:2]),
+		ArrivalTable.from_records(records[2:])])
+	assert [row.copy() for row in table] == records
+	frame = table.to_dataframe()
+	assert isinstance(frame['STA'].dtype, pd.CategoricalDtype)
+	assert ArrivalTable.from_dataframe(frame).to_records() == records
+	assert len(ArrivalTable.from_records([], ('EVENTID', 'STA'))) == 0
+
+def test_save_and_load(tmp_path):
+	table = ArrivalTable.from_records(make_records())
+	path = str(tmp_path / 'recordings.npz')
+	table.save(path)
+	loaded = ArrivalTable.load(path)
+	assert isinstance(loaded.codes('STA'), np.memmap)
+	assert loaded.to_records() == make_records()
+	assert ArrivalTable.load(path, mmap=False).to_records() == make_records()
+	empty = ArrivalTable.from_records([], ('EVENTID', 'STA'))
+	empty.save(path)
+	assert ArrivalTable.load(path).fields == ('EVENTID', 'STA')
+
+def test_epoch_columns():
+	records = [dict(record, ARRIVAL_DATE='2010-01-05', ORIGIN_DATE='2010-01-05',
+		ORIGIN_TIME='09:59:50.00') for record in make_records()]
+	records[1]['ARRIVAL_TIME'] = ''
+	table = ArrivalTable.from_records(records).with_epochs()
+	epochs = table['ARRIVAL_EPOCH']
+	assert epochs[0] == UTCDateTime('2010-01-05T10:00:05.10').timestamp
+	assert np.isnan(epochs[1])
+	assert table['ORIGIN_EPOCH'][2] == UTCDateTime('2010-01-05T09:59:50').timestamp
+	assert arrival_epoch(table[2]) == arrival_epoch(records[2])
+	assert table.with_epochs() is table
+
+def test_phase_index():
+	table = ArrivalTable.from_records(make_records()).drop_duplicates('EVENTID', 'STA', 'ISCPHASE')
+	index = PhaseIndex(table)
+	assert len(index) == 2
+	assert index.find(table[0], 'P')['ARRIVAL_TIME'] == '10:00:01.20'
+	assert index.find(table[1], 'S') is None
+	assert sorted(index.phases({'EVENTID': 2, 'STA': 'LLLB'})) == ['P', 'S']
+	assert len(index.rows({'EVENTID': 3, 'STA': 'LLLB'})) == 0
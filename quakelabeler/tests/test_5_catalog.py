@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+# MIT License
+#
+# Copyright (c) 2021 Hao Mai & Pascal Audet
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+from datetime import datetime
+import quakelabeler.isc as isc
+from quakelabeler.catalog import ArrivalCatalog
+from quakelabeler.tests.test_2_isc import query_params, fake_stream
+from quakelabeler.tests.test_3_cache import with_time
+
+def dated_stream(rows_per_tile):
+	# fake ISC service with the events (and arrivals) on the requested days
+	stream = fake_stream(rows_per_tile)
+	def stream_lines(url, params, **kwargs):
+		for line in stream(url, params, **kwargs):
+			if line.startswith('  ') and ',ISC ' in line:
+				day = datetime.fromordinal(int(line.split(',')[0]))
+				line = line.replace('2010-09-07', day.strftime('%Y-%m-%d'))
+			yield line
+	return stream_lines
+
+def test_missing_and_add(tmp_path):
+	catalog = ArrivalCatalog(str(tmp_path / 'nightly'))
+	january = with_time(query_params, datetime(2010, 1, 1), datetime(2010, 2, 1))
+	march = with_time(query_params, datetime(2010, 3, 1), datetime(2010, 4, 1))
+	catalog.add(january)
+	catalog.add(march)
+	query = with_time(query_params, datetime(2010, 1, 10), datetime(2010, 4, 10))
+	assert catalog.missing(query) == [(datetime(2010, 2, 1), datetime(2010, 3, 1)),
+		(datetime(2010, 4, 1), datetime(2010, 4, 10))]
+	# another magnitude range is another slice
+	assert len(catalog.missing(dict(query, min_mag='5.0'))) == 1
+
+def test_refresh_fetches_only_the_delta(tmp_path, monkeypatch):
+	requested = []
+	stream = dated_stream(5)
+	def stream_lines(url, params, **kwargs):
+		requested.append((isc.param_time(params, 'start'), isc.param_time(params, 'end')))
+		return stream(url, params, **kwargs)
+	monkeypatch.setattr(isc, 'stream_lines', stream_lines)
+	name = str(tmp_path / 'nightly')
+	first = with_time(query_params, datetime(2010, 1, 1), datetime(2010, 1, 8))
+	recordings = ArrivalCatalog(name).refresh('url', first, delay=0)
+	# the query ends on 2010-01-08 00:00, before the event of that day
+	assert len(recordings) == 7
+	requested[:] = []
+	second = with_time(query_params, datetime(2010, 1, 1), datetime(2010, 1, 10))
+	catalog = ArrivalCatalog(name)
+	recordings = catalog.refresh('url', second, delay=0)
+	assert requested == [(datetime(2010, 1, 8), datetime(2010, 1, 10))]
+	# the boundary day is fetched twice but stored once
+	assert catalog.fetched == 3
+	assert len(recordings) == 9
+	assert len(ArrivalCatalog(name).load()) == 10
+	requested[:] = []
+	assert len(catalog.refresh('url', second, delay=0)) == 9
+	assert requested == []
+
+def test_refresh_returns_its_slice(tmp_path, monkeypatch):
+	monkeypatch.setattr(isc, 'stream_lines', dated_stream(5))
+	catalog = ArrivalCatalog(str(tmp_path / 'nightly'))
+	january = with_time(query_params, datetime(2010, 1, 1), datetime(2010, 1, 5))
+	march = with_time(query_params, datetime(2010, 3, 1), datetime(2010, 3, 5))
+	catalog.refresh('url', january, delay=0)
+	recordings = catalog.refresh('url', march, delay=0)
+	assert len(catalog.load()) == 10
+	# only the events of the refreshed query, not the stored January ones
+	assert sorted(set(recordings['EVENTID'])) == \
+		[datetime(2010, 3, day).toordinal() for day in range(1, 5)]
+	recordings = catalog.refresh('url', january, delay=0)
+	assert sorted(set(recordings['EVENTID'])) == \
+		[datetime(2010, 1, day).toordinal() for day in range(1, 5)]
+
+def test_local_select(tmp_path, monkeypatch):
+	monkeypatch.setattr(isc, 'stream_lines', fake_stream(5))
+	catalog = ArrivalCatalog(str(tmp_path / 'nightly'))
+	catalog.refresh('url', with_time(query_params, datetime(2010, 1, 1), datetime(2010, 1, 8)), delay=0)
+	# the fake arrivals all have their origin on 2010-09-07 01:23:10, M3.4
+	query = with_time(query_params, datetime(2010, 9, 7, 1, 23, 10), datetime(2010, 9, 7, 1, 23, 10))
+	assert len(catalog.select(query)) == len(catalog.load()) == 8
+	assert len(catalog.select(dict(query, min_mag='4.0'))) == 0
+	query = with_time(query_params, datetime(2010, 1, 2), datetime(2010, 1, 4))
+	assert len(catalog.select(query)) == 0
+
+def test_refresh_fe_region(tmp_path, monkeypatch):
+	stream = dated_stream(5)
+	def stream_lines(url, params, **kwargs):
+		# the arrivals of each FE region are recorded at its own station
+		for line in stream(url, params, **kwargs):
+			yield line.replace('LLLB ', params['srn'].ljust(5), 1)
+	monkeypatch.setattr(isc, 'stream_lines', stream_lines)
+	name = str(tmp_path / 'nightly')
+	january = with_time(query_params, datetime(2010, 1, 1), datetime(2010, 1, 5))
+	cascadia = dict(january, stnsearch='GLOBAL', searchshape='FE', srn='CASC')
+	alaska = dict(cascadia, srn='ALSK')
+	recordings = ArrivalCatalog(name).refresh('url', cascadia, delay=0)
+	assert set(recordings['STA']) == {'CASC'}
+	assert len(recordings) == 4
+	catalog = ArrivalCatalog(name)
+	recordings = catalog.refresh('url', alaska, delay=0)
+	assert set(recordings['STA']) == {'ALSK'}
+	assert len(catalog.load()) == 10
+	# a stored FE slice is selected without ISC, from its own arrivals
+	assert set(ArrivalCatalog(name).select(cascadia)['STA']) == {'CASC'}
+	assert len(catalog.select(with_time(cascadia, datetime(2010, 1, 1), datetime(2010, 1, 3)))) == 2
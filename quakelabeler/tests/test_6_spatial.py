@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+# MIT License
+#
+# Copyright (c) 2021 Hao Mai & Pascal Audet
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import numpy as np
+from quakelabeler.arrivals import ArrivalTable
+from quakelabeler.spatial import SpatialIndex, StationIndex, select_region
+
+def make_arrivals():
+	stations = [('PGC', 48.65, -123.45), ('LLLB', 50.61, -121.88),
+		('ANMO', 34.95, -106.46), ('PGC', 48.65, -123.45)]
+	return ArrivalTable.from_records([{'EVENTID': i, 'STA': sta,
+		'ARRIVAL_LAT': lat, 'ARRIVAL_LON': lon,
+		'ORIGIN_LAT': 49.0 + i, 'ORIGIN_LON': -125.0}
+		for i, (sta, lat, lon) in enumerate(stations)])
+
+def test_regions():
+	index = SpatialIndex([0.0, 0.0, 10.0, np.nan], [0.0, 179.5, 0.0, 0.0])
+	assert list(index.radius(0.0, 0.0, 10.0)) == [True, False, True, False]
+	assert list(index.radius(0.0, 0.0, 1000.0, units='km')) == [True, False, False, False]
+	assert list(index.rect(-1.0, 1.0, 170.0, -170.0)) == [False, True, False, False]
+	assert list(index.polygon([-1, 11, 11, -1], [-1, -1, 1, 1])) == [True, False, True, False]
+	rows, distance = index.nearest(9.0, 0.5)
+	assert rows[0] == 2 and distance[0] < 1.5
+
+def test_select_arrivals():
+	table = make_arrivals()
+	circ = {'stnsearch': 'CIRC', 'stn_ctr_lat': '49.0', 'stn_ctr_lon': '-123.0',
+		'stn_radius': '3.0', 'max_stn_dist_units': 'deg'}
+	assert list(select_region(table, circ)['EVENTID']) == [0, 1, 3]
+	events = dict(circ, searchshape='RECT', bot_lat='48', top_lat='50.5',
+		left_lon='-126', right_lon='-124')
+	assert list(select_region(table, events)['EVENTID']) == [0, 1]
+
+def test_station_file():
+	stations = StationIndex.from_file()
+	selected = stations.region({'stnsearch': 'RECT', 'stn_bot_lat': '40',
+		'stn_top_lat': '55', 'stn_left_lon': '-130', 'stn_right_lon': '-120'})
+	assert len(selected) > 0
+	assert selected['Latitude'].between(40, 55).all()
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+# MIT License
+#
+# Copyright (c) 2021 Hao Mai & Pascal Audet
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import numpy as np
+from quakelabeler.arrivals import ArrivalTable
+from quakelabeler.store import CatalogStore
+
+def make_table():
+	records = []
+	for eventid, mag in ((1, 3.0), (2, 5.0)):
+		for sta, phase, clock in (('LLLB', 'P', '10:00:01.00'), ('LLLB', 'S', '10:00:05.00'), ('PGC', 'P', '10:00:02.00')):
+			records.append({'EVENTID': eventid, 'STA': sta, 'CHN': 'BHZ',
+				'ISCPHASE': phase, 'REPPHASE': phase, 'ARRIVAL_LAT': 50.6,
+				'ARRIVAL_LON': -121.9, 'ARRIVAL_ELEV': np.nan, 'ARRIVAL_DIST': 2.3,
+				'ARRIVAL_BAZ': 220.1, 'ARRIVAL_DATE': '2010-0%d-07' % eventid,
+				'ARRIVAL_TIME': clock, 'ORIGIN_LAT': 48.7, 'ORIGIN_LON': -123.1,
+				'ORIGINL_DEPTH': 25.0, 'ORIGIN_DATE': '2010-0%d-07' % eventid,
+				'ORIGIN_TIME': '09:59:50.00', 'EVENT_TYPE': 'ke', 'EVENT_MAG': mag})
+	return ArrivalTable.from_records(records).with_epochs()
+
+def test_store_arrivals(tmp_path):
+	store = CatalogStore(str(tmp_path / 'catalog.sqlite'))
+	table = make_table()
+	store.add_arrivals(table, 'recordings1', {'min_mag': '3.0'})
+	store.add_arrivals(table.take(slice(0, 3)), 'recordings2')
+	assert sorted(store.queries()) == ['recordings1', 'recordings2']
+	assert 'recordings1' in store
+	# arrivals are stored once and shared by the queries
+	assert len(store.arrivals()) == 6
+	stored = store.arrivals(name='recordings1')
+	assert stored.to_dataframe().equals(table.to_dataframe())
+	assert len(store.arrivals(name='recordings2')) == 3
+	assert list(store.arrivals(min_mag=4.0)['EVENTID']) == [2, 2, 2]
+	assert len(store.arrivals(sta='PGC')) == 2
+	assert list(store.frame(name='recordings1', distinct='EVENTID')['EVENTID']) == [1, 2]
+	# the first stored arrival of each value
+	first = store.frame(distinct='STA', min_mag=4.0)
+	assert list(zip(first['STA'], first['ISCPHASE'], first['EVENTID'])) == [('LLLB', 'P', 2), ('PGC', 'P', 2)]
+	# one row per event
+	assert store.connection.execute('SELECT COUNT(*) FROM events').fetchone() == (2,)
+	assert sorted(store.stations('recordings1')['STA']) == ['LLLB', 'PGC']
+
+def test_store_samples(tmp_path):
+	store = CatalogStore(str(tmp_path / 'catalog.sqlite'))
+	sample = dict(make_table()[0].copy(), filename='CN.LLLB.BHZ', arr_point=1000.0,
+		npts=3000, sampling_rate=100.0, pair_phase='S', pair_arr_point=1400.0)
+	store.add_samples('MyDataset', [sample])
+	store.add_samples('MyDataset', [sample])
+	samples = store.samples('MyDataset')
+	assert len(samples) == 1
+	assert samples['pair_phase'][0] == 'S'
@@ -0,0 +1,498 @@
+# -*- coding: utf-8 -*-
+# MIT License
+#
+# Copyright (c) 2021 Hao Mai & Pascal Audet
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+from obspy import UTCDateTime, Stream, Trace
+from obspy.core.inventory import Inventory, Network, Station, Channel
+from obspy.clients.fdsn.header import FDSNException, FDSNNoDataException, \
+	FDSNTooManyRequestsException, FDSNServiceUnavailableException, FDSNTimeoutException
+import os
+import threading
+import time
+import numpy as np
+import pytest
+from quakelabeler import classes
+from quakelabeler.cache import WaveformCache
+from quakelabeler.classes import QuakeLabeler
+from quakelabeler.fdsn import AvailabilityIndex, WindowPlanner, PooledClient, get_client, demultiplex, fetch_bulk, fetch_segments, plan_segments, \
+	RoutedClient, RateController, parse_routes, provider_name
+
+def make_station(code, rates):
+	channels = [Channel('BH' + comp, '00', 50.0, -120.0, 0.0, 0.0,
+		sample_rate=rate, start_date=UTCDateTime(start), end_date=end and UTCDateTime(end))
+		for comp, (rate, start, end) in zip('ZNE', rates)]
+	return Station(code, 50.0, -120.0, 0.0, channels=channels)
+
+class FakeClient():
+	def __init__(self, stations):
+		self.stations = stations
+		self.requests = []
+	def get_stations(self, station, **kwargs):
+		self.requests.append(station)
+		found = [self.stations[code] for code in station.split(',') if code in self.stations]
+		if not found:
+			raise FDSNNoDataException('No data')
+		return Inventory([Network('CN', stations=found)], 'test')
+
+def test_window_planner():
+	client = FakeClient({'LLLB': make_station('LLLB', [(20.0, '2000-01-01', '2009-01-01'),
+		(40.0, '2009-01-01', None)]), 'PGC': make_station('PGC', [(100.0, '2000-01-01', None)])})
+	planner = WindowPlanner(client, chunk=2)
+	planner.prefetch(['PGC', 'LLLB', 'XXX', 'PGC'])
+	# one request per chunk of stations
+	assert client.requests == ['LLLB,PGC', 'XXX']
+	assert planner.sampling_rate('LLLB', '2005-01-01') == 20.0
+	assert planner.sampling_rate('LLLB', '2010-01-01') == 40.0
+	assert planner.sampling_rate('PGC') == 100.0
+	assert planner.sampling_rate('XXX') is None
+	assert planner.sampling_rate('ANMO') is None
+	assert client.requests[-1] == 'ANMO'
+
+def test_channel_priority(tmp_path):
+	channels = [Channel(code, loc, 50.0, -120.0, 0.0, 0.0, sample_rate=rate, start_date=UTCDateTime(start),
+		end_date=end and UTCDateTime(end)) for code, loc, rate, start, end in [
+		('BHZ', '00', 40.0, '2000-01-01', None), ('BHN', '00', 40.0, '2000-01-01', None),
+		('BHE', '00', 40.0, '2000-01-01', None), ('BHZ', '10', 20.0, '2000-01-01', None),
+		('BH1', '10', 20.0, '2000-01-01', None), ('BH2', '10', 20.0, '2000-01-01', None),
+		('HHZ', '', 100.0, '2005-01-01', None), ('HHN', '', 100.0, '2005-01-01', None),
+		('HHE', '', 100.0, '2005-01-01', None), ('EHZ', '00', 200.0, '2000-01-01', None)]]
+	client = FakeClient({'PGC': Station('PGC', 50.0, -120.0, 0.0, channels=channels)})
+	planner = WindowPlanner(client, channel='HH?,BH?,EH?', locations=('10', '00', ''))
+	# a complete 3-C set of the preferred band, then location
+	assert planner.select('PGC', '2010-01-01') == ('', 'HH?')
+	assert planner.sampling_rate('PGC', '2010-01-01') == 100.0
+	assert planner.select('PGC', '2002-01-01') == ('10', 'BH?')
+	assert planner.sampling_rate('PGC', '2002-01-01') == 20.0
+	planner = WindowPlanner(client, channel='BH?,HH?,EH?')
+	assert planner.select('PGC', '2010-01-01') == ('00', 'BH?')
+	# a single vertical component is not a set
+	assert WindowPlanner(client, channel='EH?').select('PGC') is None
+	# the channel codes are kept with the availability of the station
+	path = str(tmp_path / 'availability.json')
+	index = AvailabilityIndex(WindowPlanner(client, channel='HH?,BH?'), path)
+	index.service = False
+	index.prefetch(['PGC'])
+	index = AvailabilityIndex(WindowPlanner(None, channel='HH?,BH?'), path)
+	index.prefetch(['PGC'])
+	assert index.planner.select('PGC', '2010-01-01') == ('', 'HH?')
+
+class FakeResponse():
+	def __init__(self, status_code, content=b''):
+		self.status_code = status_code
+		self.content = content
+		self.reason = 'No Content'
+		self.text = ''
+
+def test_pooled_client_download():
+	client = PooledClient('IRIS', _discover_services=False)
+	calls = []
+	def get(url, **kwargs):
+		calls.append(url)
+		return FakeResponse(200 if 'ok' in url else 204, b'payload')
+	client._http.get = get
+	assert client._download('http://x/ok').read() == b'payload'
+	assert client._download('http://x/ok', return_string=True) == b'payload'
+	with pytest.raises(FDSNNoDataException):
+		client._download('http://x/none')
+	assert len(calls) == 3
+
+def test_shared_client():
+	clients = []
+	def worker():
+		clients.append(get_client('IRIS', _discover_services=False))
+	threads = [threading.Thread(target=worker) for i in range(4)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	assert all(client is clients[0] for client in clients)
+	assert get_client('IRIS', _discover_services=False, timeout=30) is not clients[0]
+
+def make_trace(station, start, npts=100, offset=0):
+	trace = Trace(np.arange(offset, offset + npts, dtype=float))
+	trace.stats.network = 'CN'
+	trace.stats.station = station
+	trace.stats.channel = 'BHZ'
+	trace.stats.sampling_rate = 1.0
+	trace.stats.starttime = UTCDateTime(start)
+	return trace
+
+class BulkClient():
+	def __init__(self, fail=False, error=ValueError):
+		self.fail = fail
+		self.error = error
+		self.bulk = []
+		self.single = []
+	def get_waveforms_bulk(self, bulk):
+		self.bulk.append(bulk)
+		if self.fail:
+			raise self.error('bad request')
+		return Stream([make_trace('LLLB', '2010-01-01'), make_trace('PGC', '2010-01-01')])
+	def get_waveforms(self, network, station, location, channel, start, end):
+		self.single.append(station)
+		if station == 'XXX':
+			raise FDSNNoDataException('No data')
+		return Stream([make_trace(station, start, int(end - start))])
+
+def test_demultiplex():
+	stream = Stream([make_trace('LLLB', '2010-01-01'), make_trace('LLLB', '2010-01-01T00:00:50', offset=50)])
+	part = demultiplex(stream, ('CN', 'LLLB', '*', 'BH?', UTCDateTime('2010-01-01T00:00:10'),
+		UTCDateTime('2010-01-01T00:01:00')))
+	# the same data returned twice is merged into one window
+	assert len(part) == 1
+	assert part[0].stats.starttime == UTCDateTime('2010-01-01T00:00:10')
+	assert part[0].stats.npts == 51
+	assert len(demultiplex(stream, ('CN', 'PGC', '*', 'BH?', UTCDateTime('2010-01-01'),
+		UTCDateTime('2010-01-02')))) == 0
+	# the bulk stream itself is not modified
+	assert stream[0].stats.npts == 100
+
+def test_fetch_bulk():
+	start = UTCDateTime('2010-01-01')
+	windows = [(0, ('CN', 'PGC', '*', 'BH?', start, start + 20)),
+		(1, ('CN', 'LLLB', '*', 'BH?', start + 10, start + 30)),
+		(2, ('CN', 'LLLB', '*', 'BH?', start, start + 20)),
+		(3, ('CN', 'XXX', '*', 'BH?', start, start + 20))]
+	client = BulkClient()
+	streams = fetch_bulk(client, windows)
+	# one request, sorted by station and time
+	assert len(client.bulk) == 1
+	assert [window[1] for window in client.bulk[0]] == ['LLLB', 'LLLB', 'PGC', 'XXX']
+	assert client.bulk[0][0][4] == start
+	assert streams[1][0].stats.starttime == start + 10
+	assert streams[0][0].stats.station == 'PGC'
+	assert len(streams[3]) == 0
+	# a failed bulk request is retried window by window
+	client = BulkClient(fail=True)
+	streams = fetch_bulk(client, windows)
+	assert client.single == ['PGC', 'LLLB', 'LLLB', 'XXX']
+	assert streams[2][0].stats.npts == 20
+	assert len(streams[3]) == 0
+	# an overloaded center fails every window, without a request per window
+	client = BulkClient(fail=True, error=FDSNServiceUnavailableException)
+	assert fetch_bulk(client, windows) == {0: None, 1: None, 2: None, 3: None}
+	assert client.single == []
+
+def test_fetch_bulk_cache(tmp_path):
+	start = UTCDateTime('2010-01-01')
+	windows = [(0, ('CN', 'PGC', '*', 'BH?', start, start + 20)),
+		(1, ('CN', 'LLLB', '*', 'BH?', start + 10, start + 30))]
+	cache = WaveformCache(str(tmp_path))
+	client = BulkClient()
+	fetch_bulk(client, windows, cache)
+	streams = fetch_bulk(client, windows + [(2, ('CN', 'LLLB', '*', 'BH?', start + 15, start + 25))], cache)
+	# every window is inside a cached span: no second request
+	assert len(client.bulk) == 1
+	assert streams[2][0].stats.starttime == start + 15
+
+class Labeler(QuakeLabeler):
+	def __init__(self):
+		self.custom_waveform = {'sample_rate': '', 'filter_type': '0', 'add_noise': 0, 'detrend': False}
+		self.custom_dataset = {'fixed_length': False}
+		self.waveform_cache = None
+		self.availability = None
+	def waveform_timewindow(self, thread):
+		self.eventtime = UTCDateTime(thread['time'])
+		return (self.eventtime, self.eventtime + 20)
+	def related_station_info(self, sta, thread=None):
+		return ('CN', sta, '*', 'BH?')
+
+def test_iter_waveforms(monkeypatch):
+	client = BulkClient(fail=True)
+	monkeypatch.setattr(classes, 'get_client', lambda name: client)
+	labeler = Labeler()
+	records = [{'STA': 'S%02d' % i, 'time': UTCDateTime('2010-01-01') + i * 100} for i in range(20)]
+	records[3]['STA'] = 'XXX'
+	results = list(labeler.iter_waveforms(records, bulk_size=3, max_workers=2, processes=0))
+	# streams come back in the order of the records, with their labels
+	assert [thread['STA'] for thread, st in results] == [record['STA'] for record in records]
+	assert results[3][1] == "No data available for request."
+	assert results[4][1][0].stats.station == 'S04'
+	assert labeler.eventtime == UTCDateTime(records[-1]['time'])
+	# stopping early does not request the remaining batches: max_workers
+	# downloads plus the batch being transformed
+	client = BulkClient(fail=True)
+	waveforms = labeler.iter_waveforms(records, bulk_size=3, max_workers=2, processes=0)
+	next(waveforms)
+	waveforms.close()
+	assert len(client.bulk) <= 3
+
+class AvailabilityClient(FakeClient):
+	base_url = 'http://service.test'
+	def __init__(self, stations, extents=None):
+		FakeClient.__init__(self, stations)
+		self.extents = extents
+		self.urls = []
+	def _download(self, url, return_string=False):
+		self.urls.append(url)
+		if self.extents is None:
+			raise FDSNException('Not Found')
+		return self.extents.encode()
+
+EXTENTS = """#Network Station Location Channel Quality SampleRate Earliest Latest Updated TimeSpans Restriction
+CN PGC -- BHZ M 100.0 2005-01-01T00:00:00.000000Z 2006-01-01T00:00:00.000000Z 2020-01-01T00:00:00Z 3 OPEN
+"""
+
+def test_availability_index(tmp_path):
+	stations = {'LLLB': make_station('LLLB', [(20.0, '2000-01-01', '2009-01-01')]),
+		'PGC': make_station('PGC', [(100.0, '2000-01-01', None)])}
+	client = AvailabilityClient(stations, EXTENTS)
+	path = str(tmp_path / 'availability.json')
+	index = AvailabilityIndex(WindowPlanner(client), path)
+	index.prefetch(['LLLB', 'PGC', 'XXX'])
+	assert len(client.requests) == 1 and len(client.urls) == 1
+	# inside a channel epoch and an extent
+	assert index.available('PGC', '2005-06-01', '2005-06-01T00:01:00')
+	# channel open, but no data in the availability extents
+	assert not index.available('PGC', '2010-06-01', '2010-06-01T00:01:00')
+	# the service knows nothing of LLLB, no channel for XXX
+	assert not index.available('LLLB', '2005-06-01', '2005-06-01T00:01:00')
+	assert not index.available('XXX', '2005-06-01', '2005-06-01T00:01:00')
+	# a new run reads the stations from disk
+	client = AvailabilityClient(stations)
+	index = AvailabilityIndex(WindowPlanner(client), path)
+	index.prefetch(['LLLB', 'PGC'])
+	assert client.requests == [] and client.urls == []
+	assert index.available('PGC', '2005-06-01', '2005-06-01T00:01:00')
+	assert index.planner.sampling_rate('LLLB', '2005-01-01') == 20.0
+
+class FailingClient(AvailabilityClient):
+	def get_stations(self, station, **kwargs):
+		self.requests.append(station)
+		raise FDSNTimeoutException('Timed Out')
+
+def test_availability_failed_metadata(tmp_path):
+	path = str(tmp_path / 'availability.json')
+	client = FailingClient({}, EXTENTS)
+	index = AvailabilityIndex(WindowPlanner(client), path)
+	index.prefetch(['PGC'])
+	# unknown, not unavailable: the window is requested
+	assert index.available('PGC', '2010-06-01', '2010-06-01T00:01:00')
+	assert index.planner.sampling_rate('PGC') is None
+	assert index.available('PGC', '2010-07-01', '2010-07-01T00:01:00')
+	# not retried in this run, and not cached for the next ones
+	assert client.requests == ['PGC'] and client.urls == []
+	assert not os.path.exists(path)
+	stations = {'PGC': make_station('PGC', [(100.0, '2000-01-01', None)])}
+	client = AvailabilityClient(stations, EXTENTS)
+	index = AvailabilityIndex(WindowPlanner(client), path)
+	index.prefetch(['PGC', 'XXX'])
+	assert client.requests == ['PGC,XXX']
+	assert index.planner.sampling_rate('PGC') == 100.0
+	# no data is an answer: kept as no epochs
+	assert not index.available('XXX', '2005-06-01', '2005-06-01T00:01:00')
+	assert 'XXX' in AvailabilityIndex(WindowPlanner(client), path).index
+
+def test_availability_without_service(tmp_path):
+	client = AvailabilityClient({'LLLB': make_station('LLLB', [(20.0, '2000-01-01', '2009-01-01')])})
+	index = AvailabilityIndex(WindowPlanner(client), str(tmp_path / 'availability.json'))
+	index.prefetch(['LLLB'])
+	assert not index.service
+	# only the channel epochs are checked
+	assert index.available('LLLB', '2005-06-01', '2005-06-01T00:01:00')
+	assert not index.available('LLLB', '2010-06-01', '2010-06-01T00:01:00')
+
+def test_iter_waveforms_availability(monkeypatch, tmp_path):
+	client = BulkClient()
+	monkeypatch.setattr(classes, 'get_client', lambda name: client)
+	labeler = Labeler()
+	stations = {'LLLB': make_station('LLLB', [(20.0, '2000-01-01', None)])}
+	labeler.availability = AvailabilityIndex(WindowPlanner(AvailabilityClient(stations)),
+		str(tmp_path / 'availability.json'))
+	records = [{'STA': sta, 'time': UTCDateTime('2010-01-01')} for sta in ['LLLB', 'PGC', 'LLLB']]
+	results = list(labeler.iter_waveforms(records, bulk_size=5, processes=0))
+	# PGC has no channel: it is neither requested nor yielded
+	assert [thread['STA'] for thread, st in results] == ['LLLB', 'LLLB']
+	assert [window[1] for window in client.bulk[0]] == ['LLLB', 'LLLB']
+	assert labeler.availability.skipped == 1
+
+def test_plan_segments():
+	start = UTCDateTime('2010-01-01')
+	windows = [(0, ('CN', 'PGC', '*', 'BH?', start, start + 60)),
+		(1, ('CN', 'LLLB', '*', 'BH?', start + 600, start + 660)),
+		(2, ('CN', 'PGC', '*', 'BH?', start + 1800, start + 1860)),
+		(3, ('CN', 'PGC', '*', 'BH?', start + 9000, start + 9060)),
+		(4, ('CN', 'PGC', '*', 'BH?', start + 30, start + 90))]
+	segments = plan_segments(windows)
+	assert [(segment[1], keys) for segment, keys in segments] == \
+		[('LLLB', [1]), ('PGC', [0, 4, 2]), ('PGC', [3])]
+	assert segments[1][0][4:] == (start, start + 1860)
+	# a short maximum length splits the segment, a pad extends it
+	assert len(plan_segments(windows, max_length=600)) == 4
+	assert plan_segments(windows, pad=3600)[0][0][4] == start + 600 - 3600
+
+class SegmentClient(BulkClient):
+	def get_waveforms_bulk(self, bulk):
+		self.bulk.append(bulk)
+		return Stream([make_trace(window[1], window[4], int(window[5] - window[4]) + 1) for window in bulk])
+
+def test_fetch_segments(tmp_path):
+	start = UTCDateTime('2010-01-01')
+	windows = [(key, ('CN', 'PGC', '*', 'BH?', start + 600 * key, start + 600 * key + 60)) for key in range(5)]
+	client = SegmentClient()
+	cache = WaveformCache(str(tmp_path))
+	streams = fetch_segments(client, windows, cache, pad=300)
+	# one segment for the five samples
+	assert len(client.bulk) == 1 and len(client.bulk[0]) == 1
+	assert [streams[key][0].stats.starttime for key in range(5)] == [start + 600 * key for key in range(5)]
+	assert all(streams[key][0].stats.npts == 61 for key in range(5))
+	# the padded noise windows come from the cached segment
+	noise = fetch_bulk(client, [(0, ('CN', 'PGC', '*', 'BH?', start + 1000, start + 1060))], cache)
+	assert len(client.bulk) == 1
+	assert noise[0][0].stats.starttime == start + 1000
+
+def test_iter_waveforms_segments(monkeypatch):
+	client = SegmentClient()
+	monkeypatch.setattr(classes, 'get_client', lambda name: client)
+	labeler = Labeler()
+	records = [{'STA': sta, 'time': UTCDateTime('2010-01-01') + i * 600}
+		for i, sta in enumerate(['PGC', 'LLLB', 'PGC', 'PGC', 'LLLB'])]
+	results = list(labeler.iter_waveforms(records, bulk_size=2, processes=0, segments=True))
+	# sorted by station, one segment per station, the stations not split
+	assert [thread['STA'] for thread, st in results] == ['LLLB', 'LLLB', 'PGC', 'PGC', 'PGC']
+	assert [[window[1] for window in bulk] for bulk in client.bulk] == [['LLLB'], ['PGC']]
+	assert results[3][1][0].stats.starttime == UTCDateTime(records[2]['time'])
+
+ROUTES = """DATACENTER=GEOFON,http://geofon.gfz-potsdam.de
+DATASELECTSERVICE=http://geofon.gfz-potsdam.de/fdsnws/dataselect/1/
+GE WLF -- BHZ 2010-01-01T00:00:00 2020-01-01T00:00:00
+
+DATACENTER=IRISDMC,http://ds.iris.edu
+DATASELECTSERVICE=http://service.iris.edu/fdsnws/dataselect/1/
+STATIONSERVICE=http://service.iris.edu/fdsnws/station/1/
+IU ANMO 00 BHZ 2010-01-01T00:00:00 2020-01-01T00:00:00
+GE WLF -- BHN 2010-01-01T00:00:00 2020-01-01T00:00:00
+"""
+
+def test_parse_routes():
+	assert provider_name('http://service.iris.edu/fdsnws/dataselect/1/') == 'IRIS'
+	assert provider_name('https://ws.resif.fr/fdsnws/dataselect/1/') == 'RESIF'
+	assert provider_name('http://example.org/fdsnws/dataselect/1/') == 'http://example.org'
+	assert parse_routes(ROUTES) == {'WLF': ['GFZ', 'IRIS'], 'ANMO': ['IRIS']}
+
+class Center():
+	def __init__(self, name, fail=False, delay=0.0, error=FDSNException):
+		self.name = name
+		self.fail = fail
+		self.delay = delay
+		self.error = error
+		self.calls = []
+	def get_waveforms_bulk(self, bulk):
+		self.calls.append([line[1] for line in bulk])
+		time.sleep(self.delay)
+		if self.fail:
+			raise self.error('Service unavailable')
+		return Stream([make_trace(line[1], line[4], 10) for line in bulk])
+	def get_waveforms(self, network, station, location, channel, start, end):
+		return self.get_waveforms_bulk([(network, station, location, channel, start, end)])
+
+def routed_client(tmp_path, centers):
+	client = RoutedClient(['IRIS', 'GFZ'], path=str(tmp_path / 'routes.json'))
+	client.routes = {'WLF': {'providers': ['GFZ', 'IRIS'], 'fetched': time.time()},
+		'ANMO': {'providers': ['IRIS'], 'fetched': time.time()},
+		'PGC': {'providers': [], 'fetched': time.time()}}
+	client.client = lambda provider: centers[provider]
+	return client
+
+def test_routed_client(tmp_path):
+	centers = {'IRIS': Center('IRIS'), 'GFZ': Center('GFZ', fail=True)}
+	client = routed_client(tmp_path, centers)
+	start = UTCDateTime('2010-01-01')
+	bulk = [('*', sta, '*', 'BH?', start, start + 10) for sta in ['WLF', 'ANMO', 'PGC']]
+	stream = client.get_waveforms_bulk(bulk)
+	assert sorted(tr.stats.station for tr in stream) == ['ANMO', 'PGC', 'WLF']
+	# WLF failed over from GFZ to IRIS, PGC (no route) went to IRIS first
+	assert centers['GFZ'].calls == [['WLF']]
+	assert ['WLF'] in centers['IRIS'].calls
+	assert client.candidates('WLF') == ['IRIS', 'GFZ']
+	assert client.failures['GFZ'] == 1
+
+def test_routed_client_unavailable(tmp_path):
+	centers = {'IRIS': Center('IRIS', fail=True, error=FDSNServiceUnavailableException),
+		'GFZ': Center('GFZ', fail=True, error=FDSNServiceUnavailableException)}
+	client = routed_client(tmp_path, centers)
+	start = UTCDateTime('2010-01-01')
+	bulk = [('*', 'WLF', '*', 'BH?', start, start + 10)]
+	# a center that is down did not answer "no data"
+	with pytest.raises(FDSNServiceUnavailableException):
+		client.get_waveforms_bulk(bulk)
+	assert fetch_bulk(client, [(0, bulk[0])]) == {0: None}
+
+def test_routed_client_latency(tmp_path):
+	centers = {'IRIS': Center('IRIS', delay=0.05), 'GFZ': Center('GFZ')}
+	client = routed_client(tmp_path, centers)
+	start = UTCDateTime('2010-01-01')
+	client.get_waveforms('*', 'ANMO', '*', 'BH?', start, start + 10)
+	client.get_waveforms('*', 'WLF', '*', 'BH?', start, start + 10)
+	# the faster center is preferred for the stations it serves
+	assert client.candidates('WLF') == ['GFZ', 'IRIS']
+	assert client.candidates('PGC') == ['GFZ', 'IRIS']
+	assert client.candidates('ANMO') == ['IRIS']
+
+def test_routed_shared_client():
+	assert get_client(['IRIS', 'GFZ']) is get_client(('IRIS', 'GFZ'))
+	assert isinstance(get_client(['IRIS', 'GFZ']), RoutedClient)
+
+def test_rate_controller():
+	controller = RateController(start=2, maximum=4, retries=2, backoff=0.0)
+	answers = [FDSNTooManyRequestsException('429'), FDSNTimeoutException('timeout'), 'data']
+	def request():
+		answer = answers.pop(0)
+		if isinstance(answer, Exception):
+			raise answer
+		return answer
+	# throttled twice (limit halved down to 1), then served (+1)
+	assert controller.call('IRIS', 'ANMO', request) == 'data'
+	assert controller.limit('IRIS') == 2
+	# healthy answers raise the limit again, up to the maximum
+	for i in range(50):
+		controller.call('IRIS', None, lambda: None)
+	assert controller.limit('IRIS') == 4
+	assert controller.active['IRIS'] == 0
+	with pytest.raises(FDSNServiceUnavailableException):
+		controller.call('GFZ', None, lambda: (_ for _ in ()).throw(FDSNServiceUnavailableException('503')))
+	assert controller.limit('GFZ') == 1
+
+def test_rate_controller_station_limit():
+	controller = RateController(start=8, station_limit=1)
+	running = []
+	peak = []
+	def request():
+		running.append(1)
+		peak.append(len(running))
+		time.sleep(0.02)
+		running.pop()
+	threads = [threading.Thread(target=controller.call, args=('IRIS', 'ANMO', request)) for i in range(4)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	assert max(peak) == 1
+
+def test_pooled_client_retry():
+	client = PooledClient('IRIS', _discover_services=False,
+		controller=RateController(retries=3, backoff=0.0))
+	codes = [429, 503, 200]
+	def get(url, **kwargs):
+		return FakeResponse(codes.pop(0), b'payload')
+	client._http.get = get
+	assert client._download('http://x/query?station=ANMO').read() == b'payload'
+	assert codes == []
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+# MIT License
+#
+# Copyright (c) 2021 Hao Mai & Pascal Audet
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+from obspy import UTCDateTime, Stream, Trace
+import numpy as np
+import warnings
+from quakelabeler.process import StreamProcessor, filter_design, filter_streams, transform_stream, transform_streams, trim_stream
+
+def make_stream(npts=6000, rate=100.0):
+	traces = []
+	for comp in 'ZNE':
+		trace = Trace(np.sin(np.arange(npts) / 10.0) + np.arange(npts) * 0.01)
+		trace.stats.channel = 'HH' + comp
+		trace.stats.sampling_rate = rate
+		trace.stats.starttime = UTCDateTime('2010-01-01')
+		traces.append(trace)
+	return Stream(traces)
+
+WAVEFORM = {'sample_rate': '50.0', 'filter_type': '3', 'filter_freqmin': 1.0,
+	'filter_freqmax': 20.0, 'add_noise': 0.1, 'detrend': True}
+DATASET = {'fixed_length': True, 'sample_length': 2000}
+
+def test_trim_stream():
+	st = make_stream()
+	st[1].data = st[1].data[:100]
+	st = trim_stream(st, DATASET)
+	assert [tr.stats.npts for tr in st] == [2000, 2000]
+	assert len(trim_stream(make_stream(), {'fixed_length': False})[0]) == 6000
+
+def test_transform_stream():
+	st = transform_stream(make_stream(), WAVEFORM, DATASET, seed=1)
+	assert len(st) == 3
+	assert st[0].stats.sampling_rate == 50.0
+	assert st[0].stats.npts == 2000
+	# same seed, same noise
+	again = transform_stream(make_stream(), WAVEFORM, DATASET, seed=1)
+	assert np.array_equal(st[0].data, again[0].data)
+
+def test_stream_processor():
+	np.random.seed(0)
+	inline = StreamProcessor(WAVEFORM, DATASET, processes=0)
+	expected = [inline.submit(make_stream()).result() for i in range(4)]
+	np.random.seed(0)
+	processor = StreamProcessor(WAVEFORM, DATASET, processes=2)
+	try:
+		futures = [processor.submit(make_stream()) for i in range(4)]
+		results = [future.result() for future in futures]
+	finally:
+		processor.shutdown()
+	for result, stream in zip(results, expected):
+		assert np.allclose(result[2].data, stream[2].data)
+
+def test_filter_streams():
+	for kind, options, freqs in [('lowpass', {'freq': 5.0, 'corners': 2, 'zerophase': True}, (5.0, None)),
+			('highpass', {'freq': 1.0, 'zerophase': True}, (1.0, None)),
+			('bandpass', {'freqmin': 1.0, 'freqmax': 20.0}, (1.0, 20.0)),
+			# at Nyquist of the 40 Hz stream: left to ObsPy
+			('bandpass', {'freqmin': 1.0, 'freqmax': 20.0, 'zerophase': True}, (1.0, 20.0))]:
+		streams = [make_stream(), make_stream(npts=3000), make_stream(rate=40.0)]
+		expected = [st.copy() for st in streams]
+		with warnings.catch_warnings():
+			warnings.simplefilter('ignore')
+			for st in expected:
+				st.filter(kind, **options)
+			filter_streams(streams, kind, *freqs, corners=options.get('corners', 4),
+				zerophase=options.get('zerophase', False))
+		for st, reference in zip(streams, expected):
+			for tr, tr_ref in zip(st, reference):
+				assert np.allclose(tr.data, tr_ref.data)
+	# one design per filter
+	assert filter_design('bandpass', 4, 100.0, 1.0, 20.0) is filter_design('bandpass', 4, 100.0, 1.0, 20.0)
+	assert filter_design('bandpass', 4, 40.0, 1.0, 20.0) is None
+
+def test_transform_streams():
+	streams = transform_streams([make_stream(), make_stream(npts=5000)], WAVEFORM, DATASET, seeds=[1, 2])
+	for st, npts, seed in zip(streams, [6000, 5000], [1, 2]):
+		expected = transform_stream(make_stream(npts=npts), WAVEFORM, DATASET, seed=seed)
+		assert [tr.stats.npts for tr in st] == [tr.stats.npts for tr in expected]
+		assert np.array_equal(st[0].data, expected[0].data)
+	processor = StreamProcessor(WAVEFORM, DATASET, processes=0)
+	assert len(processor.submit_batch([make_stream(), make_stream()]).result()) == 2